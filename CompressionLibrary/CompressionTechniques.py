@@ -7,15 +7,22 @@
 # Size of source mod 2**32: 57841 bytes
 
 import math, tensorflow as tf, tensorflow.keras.backend as K, numpy as np, logging
+from collections import defaultdict
 from datetime import datetime
 from CompressionLibrary.custom_callbacks import AddSparseConnectionsCallback
 from CompressionLibrary.custom_constraints import kNonZeroes, SparseWeights
 from CompressionLibrary.custom_layers import DenseSVD, SparseSVD, FireLayer, MLPConv, ConvSVD, SparseConvolution2D, SparseConnectionsConv2D
+from CompressionLibrary.custom_layers import QuantizedDense, QuantizedConv2D, QuantizedDenseSVD, QuantizedMLPConv, quantize_per_channel
+from CompressionLibrary.custom_layers import ClusteredDense, ClusteredConv2D, kmeans_1d, cluster_index_dtype
+from CompressionLibrary.custom_layers import TuckerConv2D, TTDense, HashedDense, HashedConv2D, hash_buckets, block_connections
+from CompressionLibrary.model_passes import rebuild_model, dense_to_sparse
+from CompressionLibrary.xla import compile_model
+from CompressionLibrary.cost_model import make_cost, add_costs, layer_cost, get_layer_config, current_layer_cost, planned_layer_config_cost, conv_output_shape, to_pair
 
 class ModelCompression:
     __doc__ = '\n    Base class for compressing a deep learning model. The class takes a tensorflow\n    model and a dataset that will be used to fit a regression.\n    '
 
-    def __init__(self, model, optimizer, loss, metrics, input_shape, dataset, fine_tuning=False, tuning_verbose=1, tuning_epochs=10, num_batches=None, callbacks = None, strategy=None):
+    def __init__(self, model, optimizer, loss, metrics, input_shape, dataset, fine_tuning=False, tuning_verbose=1, tuning_epochs=10, num_batches=None, callbacks = None, strategy=None, jit_compile=False):
         """
 
         :param model: tensorflow model that will be optimized.
@@ -26,6 +33,7 @@ class ModelCompression:
         :param fine_tuning: flag to select if the optimized model will be trained.
         :param tuning_epochs: number of epochs of the fine-tuning.
         :param num_batches: number of batches to be used for compression.
+        :param jit_compile: compiles the optimized model with XLA if all its layers can be compiled.
         """
         self.model = model
         self.optimizer = optimizer
@@ -43,6 +51,7 @@ class ModelCompression:
         self.num_batches = num_batches
         self.callbacks = callbacks
         self.strategy = strategy
+        self.jit_compile = jit_compile
         if num_batches is not None:
             self.dataset = self.dataset.take(num_batches)
 
@@ -73,22 +82,114 @@ class ModelCompression:
     def get_new_layer(self, old_layer):
         pass
 
-    def replace_layer(self, new_layer, layer_name):
+    @classmethod
+    def estimate(cls, layer_config, params):
+        """
+        Estimates the cost of the layer that would replace a layer without creating it or reading any weight.
+        :param layer_config: config of the layer, see cost_model.get_layer_config.
+        :param params: arguments that would be passed to compress_layer.
+        :return: dictionary with the number of weights, bytes and FLOPs of the new layer.
+        """
+        raise NotImplementedError(f'{cls.__name__} does not have a cost model.')
+
+    @classmethod
+    def estimate_in_model(cls, model, layer_name, params, configs=None):
+        """
+        Returns the current cost of a layer of the model and the estimated cost after compressing it.
+        :param configs: optional dictionary with the configs of the layers modified by previous steps of a plan.
+        """
+        layer_config, before = planned_layer_config_cost(model.get_layer(layer_name), configs)
+        return before, cls.estimate(layer_config, params)
+
+    def get_input_model(self, layer_name):
+        """
+        Creates a model that returns the input of a layer of the current model.
+        :param layer_name: name of the layer.
+        :return: Keras model.
+        """
         inputs = tf.keras.layers.Input(shape=self.input_shape)
         if isinstance(self.model.layers[0], tf.keras.layers.InputLayer):
-            x = self.model.layers[1](inputs)
-            start = 2
-        else:
-            x = self.model.layers[0](inputs)
             start = 1
+        else:
+            start = 0
+        x = inputs
         for layer in self.model.layers[start:]:
             if layer.name == layer_name:
-                x = new_layer(x)
-            else:
-                x = layer(x)
-            
+                break
+            x = layer(x)
         return tf.keras.Model(inputs, x)
 
+    def layer_inputs(self, layer_name, dataset=None, num_batches=None):
+        """
+        Yields the input of a layer for every batch of the dataset without storing them.
+        :param layer_name: name of the layer.
+        :param dataset: dataset of (images, labels). Uses the dataset of the compressor if None.
+        :param num_batches: maximum number of batches.
+        """
+        if dataset is None:
+            dataset = self.dataset
+        if num_batches is not None:
+            dataset = dataset.take(num_batches)
+        input_model = self.get_input_model(layer_name)
+        for x, _ in dataset:
+            yield input_model(x, training=False)
+
+    def input_covariance(self, layer_name, patch_config=None):
+        """
+        Accumulates X^T X of the inputs of a layer over the dataset of the compressor one batch at a time, so the
+        activations of the whole dataset are never stored.
+        :param layer_name: name of the layer.
+        :param patch_config: config of a convolutional layer. If given, X has a row per patch of the input.
+        :return: X^T X and the number of rows of X.
+        """
+        covariance = None
+        num_rows = 0
+        for inputs in self.layer_inputs(layer_name):
+            if patch_config is not None:
+                fh, fw = patch_config['kernel_size']
+                stride_v, stride_h = patch_config['strides']
+                inputs = tf.image.extract_patches(images=inputs, sizes=[1, fh, fw, 1], strides=[1, stride_v, stride_h, 1],
+                                                  rates=[1, 1, 1, 1], padding=patch_config['padding'].upper())
+            x = tf.reshape(inputs, [-1, inputs.shape[-1]])
+            batch_covariance = tf.matmul(x, x, transpose_a=True).numpy().astype(np.float64)
+            covariance = batch_covariance if covariance is None else covariance + batch_covariance
+            num_rows += x.shape[0]
+
+        self.logger.debug(f'Covariance of the inputs of {layer_name} was calculated using {num_rows} rows.')
+        return covariance, num_rows
+
+    def calibration_activations(self, old_layer):
+        """
+        Returns the inputs of a convolutional layer on the calibration batches of the compressor (the dataset if
+        calibration_dataset is None) and its outputs before the activation.
+        """
+        inputs = tf.concat(list(self.layer_inputs(old_layer.name, getattr(self, 'calibration_dataset', None),
+                                                  getattr(self, 'num_calibration_batches', None))), axis=0)
+        outputs = old_layer.convolution_op(inputs, old_layer.kernel)
+        if old_layer.use_bias:
+            outputs = tf.nn.bias_add(outputs, old_layer.bias)
+        return inputs, outputs
+
+    def get_new_layers(self, old_layers):
+        """
+        Creates the replacement of every layer in old_layers. Compressors that can share work between layers
+        override this method.
+        :param old_layers: list of layers that will be replaced.
+        :return: list of tuples (new_layer, new_layer_name, weights_before, weights_after).
+        """
+        return [self.get_new_layer(old_layer) for old_layer in old_layers]
+
+    def replace_layers(self, new_layers: dict):
+        """
+        Creates a new model in which every layer whose name is a key of new_layers is replaced by its value.
+        :param new_layers: dictionary that maps the name of a layer to the layer that replaces it.
+        :return: Keras model.
+        """
+        return rebuild_model(self.model, new_layers, self.input_shape)
+
+    def replace_layer(self, new_layer, layer_name):
+        return self.replace_layers({layer_name: new_layer})
+
     def compress_layer(self, layer_name: str, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
@@ -105,7 +206,7 @@ class ModelCompression:
         # Create the new model.
         self.model = self.replace_layer(new_layer, layer_name)
 
-        self.model.compile(optimizer=self.optimizer, loss=self.loss_object, metrics=self.metrics)
+        compile_model(self.model, self.optimizer, self.loss_object, self.metrics, self.jit_compile)
 
         self.new_layer_name = new_layer_name
         
@@ -139,12 +240,286 @@ class ModelCompression:
 
         self.logger.debug('Finished compression')
 
+    def compress_layers(self, layer_names: list, **kwargs):
+        """
+        Compresses several layers at once. The new layers are created together by get_new_layers, so compressors
+        that optimize the replacement of each layer can batch that work, and the model is rebuilt only once.
+        :param layer_names: names of the layers that will be compressed.
+        """
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+        self.logger.debug(f'Using method {self.get_technique()} to compress {layer_names}.')
+        old_layers = [self.model.layers[self.find_layer(layer_name)] for layer_name in layer_names]
+        results = self.get_new_layers(old_layers)
+
+        self.model = self.replace_layers({layer_name: new_layer for layer_name, (new_layer, _, _, _) in zip(layer_names, results)})
+        compile_model(self.model, self.optimizer, self.loss_object, self.metrics, self.jit_compile)
+
+        self.new_layer_names = [new_layer_name for _, new_layer_name, _, _ in results]
+        self.new_layer_name = self.new_layer_names[-1]
+
+        fake_input = tf.zeros(shape=self.input_shape, dtype=tf.float32)
+        fake_input = tf.expand_dims(fake_input, axis=0)
+        self.model(fake_input)
+
+        if self.fine_tuning:
+            self.model.fit(self.dataset, epochs=self.tuning_epochs, callbacks=self.callbacks, verbose=self.tuning_verbose)
+
+        for layer_name, (_, _, layer_weights_before, layer_weight_after) in zip(layer_names, results):
+            w_diff = layer_weights_before - layer_weight_after
+            self.logger.debug(f'Removed layer {layer_name} had {layer_weights_before} weights. New layer has {layer_weight_after} weights. Difference is {w_diff}')
+
+        self.logger.debug('Finished compression')
+
+
+def apply_plan(model, plan, **compressor_kwargs):
+    """
+    Compresses a model with a plan, a list of (layer_name, compressor, params) as in cost_model.dry_run.
+    Consecutive steps with the same compressor and params are applied with a single call to compress_layers, so
+    compressors that share work between layers (e.g. SparseConvolutionCompression) compress them together.
+    :param compressor_kwargs: arguments of the compressors (optimizer, loss, metrics, input_shape, dataset, etc.).
+    :return: compressed model.
+    """
+    logger = logging.getLogger(__name__)
+    batches = []
+    for layer_name, compressor, params in plan:
+        if isinstance(compressor, str):
+            compressor = globals()[compressor]
+        if batches and batches[-1][0] is compressor and batches[-1][2] == params:
+            batches[-1][1].append(layer_name)
+        else:
+            batches.append((compressor, [layer_name], params))
+
+    for compressor_class, layer_names, params in batches:
+        logger.debug(f'Compressing {layer_names} with {compressor_class.__name__}.')
+        compressor = compressor_class(model=model, **compressor_kwargs)
+        if len(layer_names) == 1:
+            compressor.compress_layer(layer_names[0], **params)
+        else:
+            compressor.compress_layers(layer_names, **params)
+        model = compressor.get_model()
+    return model
+
+
+def minimize_loss(loss_fn, variables, iterations, learning_rate=1e-3, constraints=None, tolerance=None, patience=100,
+                  time_budget=None, jit_compile=False, verbose=False, log_every=100, name='loss'):
+    """
+    Minimizes loss_fn with Adam inside a compiled tf.while_loop instead of dispatching one tf.function per
+    iteration. The optimizer state is carried as loop variables, so the whole loop can be compiled with XLA.
+
+    :param loss_fn: function that receives the values of the variables and returns a scalar loss.
+    :param variables: list of tf.Variable that will be optimized. They are assigned the final values.
+    :param iterations: maximum number of iterations.
+    :param learning_rate: learning rate of Adam.
+    :param constraints: list with a constraint (or None) per variable, applied after every update.
+    :param tolerance: stop when the loss improved less than this fraction during the last patience iterations.
+    :param patience: number of iterations between convergence checks.
+    :param time_budget: maximum number of seconds. Checked every log_every iterations.
+    :param jit_compile: compile the loop with XLA.
+    :param verbose: log the loss every log_every iterations.
+    :param log_every: number of iterations run per compiled call when verbose or time_budget are used.
+    :param name: name used when logging the loss.
+    :return: final loss and number of iterations that were run.
+    """
+    logger = logging.getLogger(__name__)
+    beta_1, beta_2, epsilon = 0.9, 0.999, 1e-7
+    if constraints is None:
+        constraints = [None] * len(variables)
+    if tolerance is None:
+        tolerance = -np.inf
+
+    @tf.function(jit_compile=jit_compile)
+    def run(values, m, v, step, ref_loss, num_iterations):
+
+        def cond(i, values, m, v, step, ref_loss, loss, converged):
+            return tf.logical_and(i < num_iterations, tf.logical_not(converged))
+
+        def body(i, values, m, v, step, ref_loss, loss, converged):
+            with tf.GradientTape() as tape:
+                tape.watch(values)
+                loss = loss_fn(*values)
+            gradients = tape.gradient(loss, values)
+            step = step + 1.0
+            lr = learning_rate * tf.sqrt(1.0 - beta_2 ** step) / (1.0 - beta_1 ** step)
+            m = [beta_1 * m_i + (1.0 - beta_1) * g for m_i, g in zip(m, gradients)]
+            v = [beta_2 * v_i + (1.0 - beta_2) * tf.square(g) for v_i, g in zip(v, gradients)]
+            values = [value - lr * m_i / (tf.sqrt(v_i) + epsilon) for value, m_i, v_i in zip(values, m, v)]
+            values = [value if constraint is None else constraint(value) for value, constraint in zip(values, constraints)]
+
+            # Compare against the loss of patience iterations ago.
+            ref_loss = tf.where(ref_loss < 0.0, loss, ref_loss)
+            check = tf.equal(tf.math.floormod(step, patience), 0.0)
+            converged = tf.logical_and(check, ref_loss - loss <= tolerance * ref_loss)
+            ref_loss = tf.where(check, loss, ref_loss)
+            return i + 1, values, m, v, step, ref_loss, loss, converged
+
+        loop_vars = (tf.constant(0), values, m, v, step, ref_loss, tf.constant(np.inf, dtype=tf.float32), tf.constant(False))
+        return tf.while_loop(cond, body, loop_vars=loop_vars)
+
+    values = [tf.convert_to_tensor(variable) for variable in variables]
+    m = [tf.zeros_like(value) for value in values]
+    v = [tf.zeros_like(value) for value in values]
+    step = tf.constant(0.0)
+    ref_loss = tf.constant(-1.0)
+
+    # Without logging or time budget the whole optimization is a single compiled call.
+    chunk = log_every if verbose or time_budget is not None else iterations
+    start_time = datetime.now()
+    iteration = 0
+    loss = np.inf
+    while iteration < iterations:
+        num_iterations = tf.constant(min(chunk, iterations - iteration))
+        i, values, m, v, step, ref_loss, loss, converged = run(values, m, v, step, ref_loss, num_iterations)
+        iteration += int(i)
+        if verbose:
+            logger.info(f'Iteration {iteration} of {name} loss: {loss}')
+        if converged:
+            logger.debug(f'{name} converged after {iteration} iterations.')
+            break
+        if time_budget is not None and (datetime.now() - start_time).total_seconds() > time_budget:
+            logger.debug(f'{name} stopped after {iteration} iterations due to the time budget of {time_budget} secs.')
+            break
+
+    for variable, value in zip(variables, values):
+        variable.assign(value)
+
+    return float(loss), iteration
+
+def low_rank_hidden_units(input_size, units, default_units, percentage=None, hidden_units=None):
+    """
+    Returns the rank of the factorization of a (input_size, units) kernel. If percentage is an int it is a
+    percentage, and if it is a float a fraction, of the highest rank that does not increase the number of weights.
+    :return: rank and the percentage of units it represents.
+    """
+    if percentage is None:
+        if hidden_units is None:
+            hidden_units = default_units
+        return hidden_units, 100 * hidden_units / units
+
+    # Max number of hidden units in order to have almost the same number of weights.
+    max_units = (input_size * units)//(input_size+units)
+    if isinstance(percentage, (float, np.floating)):
+        return math.ceil(max_units * percentage), 100 * percentage
+    return math.ceil(max_units * (percentage/100)), percentage
+
+def truncated_svd(weights, hidden_units):
+    """
+    Returns the factors u, with shape (input_size, hidden_units), and n = S V^T, with shape (hidden_units, units),
+    of the best rank hidden_units approximation of the kernel.
+    """
+    try:
+        s, u, v = tf.linalg.svd(weights, full_matrices=False)
+    except Exception as e:
+        print(e)
+        with tf.device('/CPU:0'):
+            s, u, v = tf.linalg.svd(weights, full_matrices=False)
+
+    u = u[:, :hidden_units]
+    # Transpose V as V is returned as V^T.
+    n = tf.linalg.matrix_transpose(v)[:hidden_units] * s[:hidden_units, None]
+    return u.numpy(), n.numpy()
+
+def data_aware_svd(weights, hidden_units, covariance, damping=1e-3):
+    """
+    Returns the factors u and n of the rank hidden_units kernel W' that minimizes the error of the outputs
+    ||XW - XW'||, which only depends on X through the covariance C = X^T X. As the error is ||C^1/2 (W - W')||,
+    W' = C^-1/2 U_r S_r V_r^T where U S V^T is the SVD of C^1/2 W.
+    :param weights: kernel with shape (input_size, units).
+    :param hidden_units: rank of the approximation.
+    :param covariance: X^T X with shape (input_size, input_size).
+    :param damping: fraction of the mean eigenvalue added to all of them, so that inputs that are (almost)
+    constant do not make C singular.
+    :return: u, with shape (input_size, hidden_units), and n, with shape (hidden_units, units).
+    """
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    eigenvalues = np.maximum(eigenvalues, 0.0)
+    eigenvalues += damping * np.mean(eigenvalues) + np.finfo(np.float32).tiny
+    sqrt_covariance = (eigenvectors * np.sqrt(eigenvalues)) @ eigenvectors.T
+    inv_sqrt_covariance = (eigenvectors / np.sqrt(eigenvalues)) @ eigenvectors.T
+
+    u, s, vt = np.linalg.svd(sqrt_covariance @ weights.astype(np.float64), full_matrices=False)
+    u = inv_sqrt_covariance @ u[:, :hidden_units]
+    n = s[:hidden_units, None] * vt[:hidden_units]
+    return u.astype(np.float32), n.astype(np.float32)
+
+def relative_output_error(weights, new_weights, covariance):
+    """
+    Returns ||X(W - W')||^2 / ||XW||^2 using the covariance C = X^T X.
+    """
+    difference = weights - new_weights
+    return np.trace(difference.T @ covariance @ difference) / np.trace(weights.T @ covariance @ weights)
+
+def least_squares(features, targets, damping=1e-6):
+    """
+    Returns W and b that minimize ||XW + b - Y||^2, solving the normal equations with a damping fraction of the
+    mean eigenvalue added to the diagonal.
+    :param features: X with shape (rows, input_size).
+    :param targets: Y with shape (rows, units).
+    :return: W with shape (input_size, units) and b with shape (units,).
+    """
+    x = np.asarray(features, dtype=np.float64)
+    x = np.concatenate([x, np.ones([x.shape[0], 1])], axis=1)
+    covariance = x.T @ x
+    covariance += damping * np.trace(covariance) / covariance.shape[0] * np.eye(covariance.shape[0])
+    solution = np.linalg.solve(covariance, x.T @ np.asarray(targets, dtype=np.float64))
+    return solution[:-1].astype(np.float32), solution[-1].astype(np.float32)
+
+def reconstruction_error(outputs, targets):
+    return float(tf.reduce_mean(tf.square(outputs - targets)))
+
+def set_reconstruction_settings(compressor):
+    """
+    Adds the settings used by compressors that initialize the new layer by reconstructing the outputs of the
+    original layer on calibration batches. With initialization set to random the new layer is not initialized.
+    """
+    compressor.initialization = 'least_squares'
+    compressor.calibration_dataset = None
+    compressor.num_calibration_batches = 4
+    compressor.new_layer_iterations = 200
+    compressor.new_layer_time_budget = 30
+    compressor.new_layer_jit_compile = False
+    compressor.new_layer_verbose = False
+    compressor.reconstruction_mse = None
+
+def refine_reconstruction(compressor, preactivation_fn, variables, targets, name='reconstruction'):
+    """
+    Minimizes the MSE between preactivation_fn(*variables) and the targets using the settings of the compressor
+    (see set_reconstruction_settings).
+    :return: final MSE.
+    """
+    logger = logging.getLogger(__name__)
+    loss_before = reconstruction_error(preactivation_fn(*variables), targets)
+    start_time = datetime.now()
+    _, iterations = minimize_loss(lambda *values: tf.reduce_mean(tf.square(preactivation_fn(*values) - targets)), variables,
+                                  compressor.new_layer_iterations, time_budget=compressor.new_layer_time_budget,
+                                  jit_compile=compressor.new_layer_jit_compile, verbose=compressor.new_layer_verbose, name=name)
+    loss = reconstruction_error(preactivation_fn(*variables), targets)
+    training_time = (datetime.now() - start_time).total_seconds()
+    logger.info(f'{name} MSE went from {loss_before} to {loss} in {iterations} iterations ({training_time} secs).')
+    return loss
+
 class DeepCompression(ModelCompression):
-    __doc__ = '\n    Compression technique that sets to 0 all weights that are below a threshold in\n    a Dense layer. No clustering and Huffman encoding is performed.\n    '
+    __doc__ = '\n    Compression technique that sets to 0 all weights that are below a threshold in\n    a Dense layer. Clustering is done by WeightClustering and entropy coding by storage.py. If the density of\n    the pruned kernel is at most sparse_density_threshold, the layer is stored as a\n    SparseDense layer that only keeps the non-zero weights.\n    '
 
     def __init__(self, **kwargs):
         (super(DeepCompression, self).__init__)(**kwargs)
         self.target_layer_type = 'dense'
+        self.sparse_density_threshold = None
+
+    @classmethod
+    def estimate(cls, layer_config, params):
+        """
+        As the number of weights below the threshold is not known without the kernel, params can have the
+        expected density (fraction of weights that are kept).
+        """
+        features, units = layer_config['input_shape'][-1], layer_config['units']
+        nnz = math.ceil(params.get('density', 1.0) * features * units)
+        sparse_density_threshold = params.get('sparse_density_threshold')
+        if sparse_density_threshold is not None and params.get('density', 1.0) <= sparse_density_threshold:
+            # SparseDense stores the values and two int32 indices per non-zero weight.
+            return make_cost(nnz + units, 2 * nnz, bytes=nnz * 12 + units * 4)
+        return make_cost(nnz + units, 2 * features * units, bytes=(features * units + units) * 4)
 
     def get_new_layer(self, old_layer):
         weights, bias = old_layer.get_weights()
@@ -169,12 +544,138 @@ class DeepCompression(ModelCompression):
 
         new_layer.set_weights([new_weights, bias])
         
+        if self.sparse_density_threshold is not None:
+            density = tf.math.count_nonzero(new_weights).numpy() / tf.size(new_weights).numpy()
+            if density <= self.sparse_density_threshold:
+                self.logger.debug(f'Storing DeepComp layer as sparse due to a density of {density}.')
+                new_layer = dense_to_sparse(new_layer)
 
         self.logger.debug(f'Replaced layer was using {weights_before} weights.')
         self.logger.debug(f'DeepComp  is using {weights_after} weights.')
 
         return new_layer, new_layer.name, weights_before, weights_after
 
+class WeightClustering(ModelCompression):
+    __doc__ = '\n    Compression technique that clusters the weights of a Dense or Conv2D layer with k-means so\n    that they share num_clusters values, which is the second stage of Deep Compression. The\n    kernel is stored as a codebook and the index of the centroid of every weight. The weights\n    pruned by DeepCompression are assigned to a centroid fixed to 0. Only the centroids and the\n    bias are fine-tuned. The indices are entropy coded when the model is saved with storage.py.\n    '
+
+    def __init__(self, **kwargs):
+        (super(WeightClustering, self).__init__)(**kwargs)
+        self.target_layer_type = 'any'
+        self.num_clusters = 16
+        self.kmeans_iterations = 20
+
+    @classmethod
+    def estimate(cls, layer_config, params):
+        """
+        params can have the density of a pruned kernel, whose zeroes are not counted as weights.
+        """
+        num_clusters = params.get('num_clusters', 16)
+        cost = layer_cost(layer_config)
+        outputs = layer_config['units'] if 'units' in layer_config else layer_config['filters']
+        kernel_size = cost['weights'] - outputs
+        index_bytes = 1 if cluster_index_dtype(num_clusters) == 'uint8' else 4
+        nnz = math.ceil(params.get('density', 1.0) * kernel_size)
+        return make_cost(nnz + outputs, cost['flops'], bytes=kernel_size * index_bytes + (num_clusters + outputs) * 4)
+
+    def get_new_layer(self, old_layer):
+        config = old_layer.get_config()
+        kernel, bias = old_layer.get_weights()[:2]
+        keep_zero = bool(np.any(kernel == 0.0))
+        centroids, indices = kmeans_1d(kernel, self.num_clusters, self.kmeans_iterations, keep_zero)
+
+        if isinstance(old_layer, tf.keras.layers.Dense):
+            new_layer = ClusteredDense(units=config['units'], num_clusters=self.num_clusters, activation=config['activation'],
+                                       keep_zero=keep_zero, name=old_layer.name + '/Clustered')
+            new_layer(old_layer.input)
+            new_layer.bias0.assign(bias)
+        elif type(old_layer) == tf.keras.layers.Conv2D:
+            new_layer = ClusteredConv2D(filters=config['filters'], kernel_size=config['kernel_size'], num_clusters=self.num_clusters,
+                                        strides=config['strides'], padding=config['padding'], activation=config['activation'],
+                                        keep_zero=keep_zero, name=old_layer.name + '/Clustered')
+            new_layer(old_layer.input)
+            new_layer.bias.assign(bias)
+        else:
+            raise ValueError(f'Layer {old_layer.name} of type {type(old_layer).__name__} cannot be clustered.')
+
+        new_layer.centroids.assign(centroids)
+        new_layer.kernel_indices.assign(indices.astype(cluster_index_dtype(self.num_clusters)))
+
+        # Every weight keeps its position, so only the pruned weights are not counted.
+        weights_before = np.sum([K.count_params(w) for w in old_layer.trainable_weights])
+        weights_after = np.count_nonzero(new_layer.get_kernel().numpy()) + bias.size
+
+        self.logger.debug(f'Clustered {kernel.size} weights of layer {old_layer.name} in {self.num_clusters} clusters.')
+        self.logger.debug(f'Replaced layer was using {weights_before} weights.')
+        self.logger.debug(f'Clustered layer is using {weights_after} weights.')
+
+        return new_layer, new_layer.name, weights_before, weights_after
+
+class HashedWeightSharing(ModelCompression):
+    __doc__ = '\n    Compression technique that replaces a Dense or Conv2D layer by a HashedDense or HashedConv2D\n    layer (HashedNets), whose kernel is indexed by a hash into num_buckets shared weights, so the\n    number of weights does not depend on the size of the layer. The number of buckets is\n    num_buckets, a percentage (int) or fraction (float) of the kernel size given by percentage,\n    or the kernel size divided by compression_factor. Every bucket is initialized with the\n    average of the (signed) weights that are hashed to it.\n    '
+
+    def __init__(self, **kwargs):
+        (super(HashedWeightSharing, self).__init__)(**kwargs)
+        self.target_layer_type = 'any'
+        self.num_buckets = None
+        self.percentage = None
+        self.compression_factor = 8
+        self.seed = 0
+
+    @staticmethod
+    def get_num_buckets(kernel_size, num_buckets=None, percentage=None, compression_factor=8):
+        if num_buckets is not None:
+            return int(num_buckets)
+        if percentage is not None:
+            if not isinstance(percentage, (float, np.floating)):
+                percentage = percentage / 100
+            return max(1, math.ceil(kernel_size * percentage))
+        return max(1, math.ceil(kernel_size / compression_factor))
+
+    @classmethod
+    def estimate(cls, layer_config, params):
+        cost = layer_cost(layer_config)
+        outputs = layer_config['units'] if 'units' in layer_config else layer_config['filters']
+        num_buckets = cls.get_num_buckets(cost['weights'] - outputs, params.get('num_buckets'), params.get('percentage'),
+                                          params.get('compression_factor', 8))
+        return make_cost(num_buckets + outputs, cost['flops'])
+
+    def get_new_layer(self, old_layer):
+        config = old_layer.get_config()
+        kernel, bias = old_layer.get_weights()[:2]
+        num_buckets = self.get_num_buckets(kernel.size, self.num_buckets, self.percentage, self.compression_factor)
+
+        if isinstance(old_layer, tf.keras.layers.Dense):
+            new_layer = HashedDense(units=config['units'], num_buckets=num_buckets, seed=self.seed, activation=config['activation'],
+                                    name=old_layer.name + '/Hashed')
+            new_layer(old_layer.input)
+            new_layer.bias0.assign(bias)
+        elif type(old_layer) == tf.keras.layers.Conv2D:
+            new_layer = HashedConv2D(filters=config['filters'], kernel_size=config['kernel_size'], num_buckets=num_buckets, seed=self.seed,
+                                     strides=config['strides'], padding=config['padding'], activation=config['activation'],
+                                     name=old_layer.name + '/Hashed')
+            new_layer(old_layer.input)
+            new_layer.bias.assign(bias)
+        else:
+            raise ValueError(f'Layer {old_layer.name} of type {type(old_layer).__name__} cannot be hashed.')
+
+        # Average of the weights of every bucket, with the sign that the layer applies to each of them.
+        buckets, signs = hash_buckets(kernel.size, num_buckets, self.seed)
+        buckets, signs = buckets.numpy(), signs.numpy()
+        counts = np.bincount(buckets, minlength=num_buckets)
+        sums = np.bincount(buckets, weights=kernel.ravel() * signs, minlength=num_buckets)
+        new_layer.buckets.assign((sums / np.maximum(counts, 1)).astype(np.float32))
+
+        loss = tf.reduce_mean(tf.square(kernel - new_layer.get_kernel()))
+        self.logger.debug(f'Hashed {kernel.size} weights of layer {old_layer.name} in {num_buckets} buckets with MSE of {loss}.')
+
+        weights_before = np.sum([K.count_params(w) for w in old_layer.trainable_weights])
+        weights_after = np.sum([K.count_params(w) for w in new_layer.trainable_weights])
+
+        self.logger.debug(f'Replaced layer was using {weights_before} weights.')
+        self.logger.debug(f'Hashed layer is using {weights_after} weights.')
+
+        return new_layer, new_layer.name, weights_before, weights_after
+
 class ReplaceDenseWithGlobalAvgPool(ModelCompression):
     __doc__ = '\n    Compression technique that replaces all dense and flatten layers\n    between the last convolutional layer and the softmax layer with a GlobalAveragePooling2D layer.\n    '
 
@@ -182,6 +683,28 @@ class ReplaceDenseWithGlobalAvgPool(ModelCompression):
         (super(ReplaceDenseWithGlobalAvgPool, self).__init__)(**kwargs)
         self.target_layer_type = 'dense'
 
+    @classmethod
+    def estimate(cls, layer_config, params):
+        """
+        layer_config is the config of the output layer and params must have the input_shape of the flatten layer.
+        """
+        height, width, channels = params['input_shape']
+        num_classes = layer_config['units']
+        cost = make_cost(channels * num_classes + num_classes, 2 * channels * num_classes)
+        # Average of every channel.
+        cost['flops'] += height * width * channels
+        return cost
+
+    @classmethod
+    def estimate_in_model(cls, model, layer_name, params, configs=None):
+        # All the layers after flatten are replaced.
+        names = [layer.name for layer in model.layers]
+        flatten_idx = names.index('flatten')
+        before = add_costs(*[planned_layer_config_cost(layer, configs)[1] for layer in model.layers[flatten_idx:]])
+        flatten_config = planned_layer_config_cost(model.layers[flatten_idx], configs)[0]
+        params = dict(params, input_shape=flatten_config['input_shape'])
+        return before, cls.estimate(planned_layer_config_cost(model.layers[-1], configs)[0], params)
+
     def replace_layer(self, new_layer, layer_name):
         """
         New layer is a list that has Global Avg Pooling and Output layer. 
@@ -240,45 +763,33 @@ class InsertDenseSVD(ModelCompression):
     def __init__(self, **kwargs):
         (super(InsertDenseSVD, self).__init__)(**kwargs)
         self.target_layer_type = 'dense'
+        self.percentage = None
+        self.hidden_units = None
+
+    @classmethod
+    def estimate(cls, layer_config, params):
+        features, units = layer_config['input_shape'][-1], layer_config['units']
+        hidden_units, _ = low_rank_hidden_units(features, units, units//12, params.get('percentage'), params.get('hidden_units'))
+        return layer_cost(dict(layer_config, class_name='DenseSVD', hidden_units=hidden_units))
+
+    def decompose(self, old_layer, weights, hidden_units):
+        """
+        Returns the factors u and n of the rank hidden_units approximation of the kernel.
+        """
+        u, n = truncated_svd(weights, hidden_units)
+        loss = tf.reduce_mean(tf.square(weights - tf.matmul(u, n)))
+        self.logger.debug(f'New weights have MSE of {loss}.')
+        return u, n
 
     def get_new_layer(self, old_layer):
         weights, bias = old_layer.get_weights()
         input_size , units = weights.shape
-        if self.percentage is None:
-            if self.hidden_units is None:
-                hidden_units = units//12
-                self.percentage = 100 * hidden_units / units
-            else:
-                hidden_units = self.hidden_units
-                self.percentage = 100 * hidden_units / units
-        else:
-            max_units = (input_size * units)//(input_size+units)
-            if isinstance(self.percentage, int):
-                hidden_units = math.ceil(max_units * (self.percentage/100))
-            elif isinstance(self.percentage, float) or isinstance(self.percentage, np.floating):
-                # Max number of hidden units in order to have almost the same number of weights.
-                hidden_units = math.ceil(max_units*self.percentage)
-                self.percentage *= 100
+        hidden_units, percentage = low_rank_hidden_units(input_size, units, units//12, self.percentage, self.hidden_units)
         
         activation = old_layer.get_config()['activation']
         
-        self.logger.debug(f'SVD is being calculated for shape {weights.shape} using {hidden_units} singular values ({self.percentage}%).')
-        try:
-            s, u, v = tf.linalg.svd(weights, full_matrices=False)
-        except Exception as e:
-            print(e)
-            with tf.device('/CPU:0'):
-                s, u, v = tf.linalg.svd(weights, full_matrices=False)
-                
-        u = tf.slice(u, begin=[0, 0], size=[weights.shape[0], hidden_units])
-        s = tf.slice(s, begin=[0], size=[hidden_units])
-
-        # Transpose V as V is returned as V^T.
-        v = tf.slice(tf.linalg.matrix_transpose(v), begin=[0, 0], size=[hidden_units, units])
-        n = tf.matmul(tf.linalg.diag(s), v)
-        new_weights = tf.matmul(u, n)
-        loss = tf.reduce_mean(tf.square(weights - new_weights))
-        self.logger.debug(f'New weights have MSE of {loss}.')
+        self.logger.debug(f'SVD is being calculated for shape {weights.shape} using {hidden_units} singular values ({percentage}%).')
+        u, n = self.decompose(old_layer, weights, hidden_units)
 
         new_layer = DenseSVD(units=units, hidden_units=hidden_units,
                   activation=activation,
@@ -286,7 +797,7 @@ class InsertDenseSVD(ModelCompression):
 
         new_layer(old_layer.input)
 
-        new_layer.set_weights([u.numpy(), n, bias])
+        new_layer.set_weights([u, n, bias])
         
         weights_before = np.sum([K.count_params(w) for w in old_layer.trainable_weights])
         weights_after = np.sum([K.count_params(w) for w in new_layer.trainable_weights])
@@ -296,6 +807,134 @@ class InsertDenseSVD(ModelCompression):
 
         return new_layer, new_layer.name, weights_before, weights_after
 
+class DataAwareDenseSVD(InsertDenseSVD):
+    __doc__ = '\n    Compression technique that inserts a DenseSVD layer whose factors minimize the error of the\n    outputs of the layer for the inputs of the dataset instead of the error of the kernel. The\n    covariance of the inputs is accumulated using the batches of the dataset (see num_batches).\n    '
+
+    def __init__(self, **kwargs):
+        (super(DataAwareDenseSVD, self).__init__)(**kwargs)
+        self.damping = 1e-3
+
+    def decompose(self, old_layer, weights, hidden_units):
+        covariance, _ = self.input_covariance(old_layer.name)
+        u, n = data_aware_svd(weights, hidden_units, covariance, self.damping)
+        # Comparing with the SVD of the kernel needs another decomposition, so it is only done when it is logged.
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f'Relative output error is {relative_output_error(weights, u @ n, covariance)}, '
+                              f'{relative_output_error(weights, np.matmul(*truncated_svd(weights, hidden_units)), covariance)} using SVD.')
+        return u, n
+
+
+def factorize_dim(dim, num_modes):
+    """
+    Factorizes dim as the product of num_modes integers of similar size, in descending order.
+    """
+    primes = []
+    remainder, factor = dim, 2
+    while factor * factor <= remainder:
+        while remainder % factor == 0:
+            primes.append(factor)
+            remainder //= factor
+        factor += 1
+    if remainder > 1:
+        primes.append(remainder)
+
+    modes = [1] * num_modes
+    for prime in sorted(primes, reverse=True):
+        modes[int(np.argmin(modes))] *= prime
+    return sorted(modes, reverse=True)
+
+def tt_ranks(input_modes, output_modes, tt_rank):
+    """
+    Returns the ranks of the tensor-train cores, tt_rank limited by the size of every unfolding.
+    """
+    sizes = [n * m for n, m in zip(input_modes, output_modes)]
+    ranks = [1]
+    for k in range(1, len(sizes)):
+        ranks.append(int(min(tt_rank, np.prod(sizes[:k]), np.prod(sizes[k:]))))
+    return ranks + [1]
+
+def tt_max_rank(input_modes, output_modes):
+    """
+    Returns the highest rank of the cores that does not increase the number of weights of the kernel.
+    """
+    sizes = [n * m for n, m in zip(input_modes, output_modes)]
+    # sizes[0]*r + sum(sizes[1:-1])*r^2 + sizes[-1]*r = prod(sizes).
+    a, b, c = sum(sizes[1:-1]), sizes[0] + sizes[-1], np.prod(sizes)
+    if a == 0:
+        return max(1, int(c // b))
+    return max(1, int((-b + math.sqrt(b**2 + 4 * a * c)) / (2 * a)))
+
+def tt_svd(kernel, input_modes, output_modes, ranks):
+    """
+    Returns the tensor-train cores of a (features, units) kernel computed with sequential truncated SVDs.
+    :return: list of cores with shape (ranks[k], input_modes[k], output_modes[k], ranks[k+1]).
+    """
+    num_modes = len(input_modes)
+    tensor = np.reshape(kernel.astype(np.float64), list(input_modes) + list(output_modes))
+    # Interleave the modes as (n_1, m_1, n_2, m_2, ...).
+    tensor = np.transpose(tensor, [axis for k in range(num_modes) for axis in (k, num_modes + k)])
+
+    cores = []
+    for k in range(num_modes - 1):
+        tensor = np.reshape(tensor, [ranks[k] * input_modes[k] * output_modes[k], -1])
+        u, s, vt = np.linalg.svd(tensor, full_matrices=False)
+        cores.append(np.reshape(u[:, :ranks[k+1]], [ranks[k], input_modes[k], output_modes[k], ranks[k+1]]))
+        tensor = s[:ranks[k+1], None] * vt[:ranks[k+1]]
+    cores.append(np.reshape(tensor, [ranks[-2], input_modes[-1], output_modes[-1], 1]))
+    return [core.astype(np.float32) for core in cores]
+
+class InsertDenseTT(ModelCompression):
+    __doc__ = '\n    Compression technique that replaces a dense layer by a TTDense layer. The features and units\n    are factorized in num_modes modes and the kernel is decomposed in a tensor train with TT-SVD.\n    The rank of the cores is tt_rank or, if percentage is given, that percentage of the highest\n    rank that does not increase the number of weights.\n    '
+
+    def __init__(self, **kwargs):
+        (super(InsertDenseTT, self).__init__)(**kwargs)
+        self.target_layer_type = 'dense'
+        self.num_modes = 4
+        self.percentage = None
+        self.tt_rank = 8
+
+    @staticmethod
+    def get_tt_config(features, units, num_modes=4, percentage=None, tt_rank=8):
+        """
+        Returns the input modes, output modes and ranks of the cores.
+        """
+        input_modes = factorize_dim(features, num_modes)
+        output_modes = factorize_dim(units, num_modes)
+        if percentage is not None:
+            if not isinstance(percentage, (float, np.floating)):
+                percentage = percentage / 100
+            tt_rank = max(1, math.ceil(tt_max_rank(input_modes, output_modes) * percentage))
+        return input_modes, output_modes, tt_ranks(input_modes, output_modes, tt_rank)
+
+    @classmethod
+    def estimate(cls, layer_config, params):
+        input_modes, output_modes, ranks = cls.get_tt_config(layer_config['input_shape'][-1], layer_config['units'], params.get('num_modes', 4),
+                                                             params.get('percentage'), params.get('tt_rank', 8))
+        return layer_cost(dict(layer_config, class_name='TTDense', input_modes=input_modes, output_modes=output_modes, tt_ranks=ranks))
+
+    def get_new_layer(self, old_layer):
+        weights, bias = old_layer.get_weights()
+        features, units = weights.shape
+        input_modes, output_modes, ranks = self.get_tt_config(features, units, self.num_modes, self.percentage, self.tt_rank)
+
+        self.logger.debug(f'TT-SVD of kernel {weights.shape} with modes {input_modes} and {output_modes} and ranks {ranks}.')
+        cores = tt_svd(weights, input_modes, output_modes, ranks)
+
+        new_layer = TTDense(units=units, input_modes=input_modes, output_modes=output_modes, tt_ranks=ranks,
+                  activation=old_layer.get_config()['activation'], name=old_layer.name + '/TTDense')
+        new_layer(old_layer.input)
+        new_layer.set_weights(cores + [bias])
+
+        loss = tf.reduce_mean(tf.square(weights - new_layer.get_kernel()))
+        self.logger.debug(f'New kernel has MSE of {loss}.')
+
+        weights_before = np.sum([K.count_params(w) for w in old_layer.trainable_weights])
+        weights_after = np.sum([K.count_params(w) for w in new_layer.trainable_weights])
+
+        self.logger.debug(f'Replaced layer was using {weights_before} weights.')
+        self.logger.debug(f'TTDense is using {weights_after} weights.')
+
+        return new_layer, new_layer.name, weights_before, weights_after
 
 class InsertDenseSparse(ModelCompression):
     __doc__ = '\n    Compression technique that inserts a Dense layer inbetween two Dense layers.\n    By inserting a smaller layer with C units, the number of weights is reduced\n    from MxN to (M+N)xC. The weights are obtained by fitting a neural network to\n    predict the same output as the original model.\n    '
@@ -304,6 +943,16 @@ class InsertDenseSparse(ModelCompression):
         (super(InsertDenseSparse, self).__init__)(**kwargs)
         self.target_layer_type = 'dense'
 
+    @classmethod
+    def estimate(cls, layer_config, params):
+        units = layer_config['units']
+        basis_vectors = units//6
+        k_basis_vectors = basis_vectors//3
+        cost = layer_cost(dict(layer_config, class_name='SparseSVD', basis_vectors=basis_vectors))
+        # Only k_basis_vectors weights per unit of the sparse dictionary are not zero, but it is stored dense.
+        cost['weights'] -= (basis_vectors - k_basis_vectors) * units
+        return cost
+
     def get_new_layer(self, old_layer):
         weights, bias = old_layer.get_weights()
         features, units = weights.shape
@@ -362,12 +1011,41 @@ class InsertDenseSparse(ModelCompression):
 
 
 
+def spatial_svd(kernel, hidden_filters):
+    """
+    Returns the kx1 and 1xk kernels whose composition is the best approximation of a (kh, kw, C, F) kernel
+    with hidden_filters intermediate channels. The kernel is reshaped as a (kh*C, kw*F) matrix, whose rank
+    hidden_filters truncated SVD gives the two factors.
+    :return: vertical kernel with shape (kh, 1, C, hidden_filters) and horizontal kernel with shape
+    (1, kw, hidden_filters, F).
+    """
+    kh, kw, channels, filters = kernel.shape
+    weights = np.reshape(np.transpose(kernel, [0, 2, 1, 3]), [kh * channels, kw * filters])
+    u, n = truncated_svd(weights, hidden_filters)
+    vertical = np.reshape(u, [kh, 1, channels, hidden_filters])
+    horizontal = np.transpose(np.reshape(n, [hidden_filters, 1, kw, filters]), [1, 2, 0, 3])
+    return vertical, horizontal
+
 class InsertSVDConv(ModelCompression):
-    __doc__ = '\n    Compression techniques that reduces the number of weights in a filter by\n    applying the filter in two steps, one horizontal and one vertical. Instead of\n    using a DxD filter, a Dx1 is used followed by a 1xD filter. Thus, reducing the\n    number of required weights. The process to find the weights of the one\n    dimensional filters is by regressing a convolutional neural network and\n    setting the output of the original filter as the target of the regression\n    model.\n    '
+    __doc__ = '\n    Compression techniques that reduces the number of weights in a filter by\n    applying the filter in two steps, one vertical and one horizontal. Instead of\n    using a DxD filter, a Dx1 is used followed by a 1xD filter. Thus, reducing the\n    number of required weights. The weights of the one dimensional filters are\n    the truncated SVD of the kernel reshaped as a (D*channels, D*filters) matrix,\n    so the new layer starts close to the original one.\n    '
 
     def __init__(self, **kwargs):
         (super(InsertSVDConv, self).__init__)(**kwargs)
         self.target_layer_type = 'conv'
+        self.percentage = None
+        self.hidden_filters = None
+
+    @staticmethod
+    def get_hidden_filters(kernel_size, channels, filters, percentage=None, hidden_filters=None):
+        kh, kw = to_pair(kernel_size)
+        hidden_filters, percentage = low_rank_hidden_units(kh * channels, kw * filters, max(1, filters//12), percentage, hidden_filters)
+        return max(1, hidden_filters), percentage
+
+    @classmethod
+    def estimate(cls, layer_config, params):
+        hidden_filters, _ = cls.get_hidden_filters(layer_config['kernel_size'], layer_config['input_shape'][-1], layer_config['filters'],
+                                                   params.get('percentage'), params.get('hidden_filters'))
+        return layer_cost(dict(layer_config, class_name='ConvSVD', hidden_filters=hidden_filters))
 
     def get_new_layer(self, old_layer):
         config = old_layer.get_config()
@@ -375,33 +1053,192 @@ class InsertSVDConv(ModelCompression):
         padding = config['padding']
         strides = config['strides']
         kernel_size = config['kernel_size']
-        units = filters //12
+        kernel, bias = old_layer.get_weights()
+        units, percentage = self.get_hidden_filters(kernel_size, kernel.shape[2], filters, self.percentage, self.hidden_filters)
+
+        self.logger.debug(f'Spatial SVD is being calculated for kernel {kernel.shape} using {units} hidden filters ({percentage}%).')
+        vertical, horizontal = spatial_svd(kernel, units)
 
-        new_layer = ConvSVD(hidden_filters=units, filters=filters, strides=strides, kernel_size=kernel_size, padding=padding,name=old_layer.name + '/SVDConv')
+        new_layer = ConvSVD(hidden_filters=units, filters=filters, strides=strides, kernel_size=kernel_size, padding=padding,
+                            activation=config['activation'], name=old_layer.name + '/SVDConv')
         new_layer._name = old_layer.name + '/SVDConv'
 
         new_layer(old_layer.input)
+        new_layer.set_weights([vertical, horizontal, bias])
+
         weights_before = np.sum([K.count_params(w) for w in old_layer.trainable_weights])
         weights_after =  np.sum([K.count_params(w) for w in new_layer.trainable_weights])
         
         return new_layer, new_layer.name, weights_before, weights_after
   
+def energy_rank(singular_values, energy):
+    """
+    Returns the smallest rank whose singular values keep the given fraction of the energy (sum of squares).
+    """
+    cumulative_energy = np.cumsum(np.square(singular_values))
+    return int(np.searchsorted(cumulative_energy, energy * cumulative_energy[-1]) + 1)
+
+def tucker2_ranks(kernel_shape, percentage=None, input_rank=None, output_rank=None, kernel=None, energy=0.9):
+    """
+    Returns the ranks of the input and output channels of the Tucker-2 decomposition of a conv kernel. If
+    percentage is given (int as a percentage and float as a fraction), both ranks are that fraction of the
+    highest ranks, with the same ratio to the channels, that do not increase the number of weights. Otherwise,
+    the ranks that are not given keep the energy fraction of the singular values of the unfolded kernel.
+    """
+    kh, kw, channels, filters = kernel_shape
+    if percentage is not None:
+        if not isinstance(percentage, (float, np.floating)):
+            percentage = percentage / 100
+        # Largest r such that C*rC + kh*kw*rC*rF + rF*F = kh*kw*C*F.
+        a = kh * kw * channels * filters
+        b = channels**2 + filters**2
+        ratio = min(1.0, (-b + math.sqrt(b**2 + 4 * a * a)) / (2 * a))
+        return max(1, math.ceil(channels * ratio * percentage)), max(1, math.ceil(filters * ratio * percentage))
+
+    if input_rank is None or output_rank is None:
+        if kernel is None:
+            raise ValueError('The kernel is needed to select the ranks by energy.')
+        s_in, s_out = tucker2_factors(kernel)[1::2]
+        if input_rank is None:
+            input_rank = energy_rank(s_in, energy)
+        if output_rank is None:
+            output_rank = energy_rank(s_out, energy)
+    return input_rank, output_rank
+
+def tucker2_factors(kernel):
+    """
+    Returns the left singular vectors and the singular values of the unfoldings of the kernel along the input and
+    output channels.
+    :return: u_in with shape (C, C), s_in, u_out with shape (F, F) and s_out.
+    """
+    kh, kw, channels, filters = kernel.shape
+    unfolded_in = np.reshape(np.transpose(kernel, [2, 0, 1, 3]), [channels, -1]).astype(np.float64)
+    unfolded_out = np.reshape(np.transpose(kernel, [3, 0, 1, 2]), [filters, -1]).astype(np.float64)
+    u_in, s_in, _ = np.linalg.svd(unfolded_in, full_matrices=False)
+    u_out, s_out, _ = np.linalg.svd(unfolded_out, full_matrices=False)
+    return u_in, s_in, u_out, s_out
+
+def hosvd_tucker2(kernel, input_rank, output_rank):
+    """
+    Returns the factors of the truncated HOSVD of a (kh, kw, C, F) kernel along its channels, so that
+    kernel ~ core x_3 u_in x_4 u_out.
+    :return: u_in with shape (C, input_rank), core with shape (kh, kw, input_rank, output_rank) and u_out with
+    shape (F, output_rank).
+    """
+    u_in, _, u_out, _ = tucker2_factors(kernel)
+    u_in, u_out = u_in[:, :input_rank], u_out[:, :output_rank]
+    core = np.einsum('hwcf,cr,fs->hwrs', kernel.astype(np.float64), u_in, u_out)
+    return u_in.astype(np.float32), core.astype(np.float32), u_out.astype(np.float32)
+
+class TuckerDecomposition(ModelCompression):
+    __doc__ = '\n    Compression technique that replaces a convolutional layer by a TuckerConv2D layer: a 1x1\n    convolution that reduces the channels, a smaller core convolution and a 1x1 convolution that\n    restores the filters. The factors are the truncated HOSVD of the kernel, so the layer\n    approximates the original output without training. The ranks are set by percentage (as the\n    action of ModelCompressionSVDIntEnv), by input_rank and output_rank or by the energy of the\n    singular values.\n    '
+
+    def __init__(self, **kwargs):
+        (super(TuckerDecomposition, self).__init__)(**kwargs)
+        self.target_layer_type = 'conv'
+        self.percentage = None
+        self.input_rank = None
+        self.output_rank = None
+        # Fraction of the energy of the singular values kept when the ranks are not given.
+        self.energy = 0.9
+
+    @classmethod
+    def estimate(cls, layer_config, params):
+        kh, kw = to_pair(layer_config['kernel_size'])
+        input_rank, output_rank = tucker2_ranks((kh, kw, layer_config['input_shape'][-1], layer_config['filters']), params.get('percentage'),
+                                                params.get('input_rank'), params.get('output_rank'))
+        return layer_cost(dict(layer_config, class_name='TuckerConv2D', input_rank=input_rank, output_rank=output_rank))
+
+    @classmethod
+    def estimate_in_model(cls, model, layer_name, params, configs=None):
+        layer = model.get_layer(layer_name)
+        layer_config, before = planned_layer_config_cost(layer, configs)
+        if params.get('percentage') is None and (params.get('input_rank') is None or params.get('output_rank') is None):
+            # The ranks selected by energy depend on the kernel.
+            kernel = layer.get_weights()[0]
+            input_rank, output_rank = tucker2_ranks(kernel.shape, None, params.get('input_rank'), params.get('output_rank'),
+                                                    kernel, params.get('energy', 0.9))
+            params = dict(params, input_rank=input_rank, output_rank=output_rank)
+        return before, cls.estimate(layer_config, params)
+
+    def get_new_layer(self, old_layer):
+        if type(old_layer) != tf.keras.layers.Conv2D:
+            raise ValueError(f'Layer {old_layer.name} of type {type(old_layer).__name__} cannot be decomposed.')
+        config = old_layer.get_config()
+        kernel, bias = old_layer.get_weights()
+        input_rank, output_rank = tucker2_ranks(kernel.shape, self.percentage, self.input_rank, self.output_rank, kernel, self.energy)
+
+        self.logger.debug(f'HOSVD of kernel {kernel.shape} with ranks {input_rank} and {output_rank}.')
+        u_in, core, u_out = hosvd_tucker2(kernel, input_rank, output_rank)
+
+        new_layer = TuckerConv2D(filters=config['filters'], input_rank=input_rank, output_rank=output_rank,
+                  kernel_size=config['kernel_size'], strides=config['strides'], padding=config['padding'],
+                  activation=config['activation'], name=old_layer.name + '/Tucker')
+        new_layer(old_layer.input)
+        new_layer.set_weights([u_in[None, None], core, u_out.T[None, None], bias])
+
+        loss = tf.reduce_mean(tf.square(kernel - new_layer.get_kernel()))
+        self.logger.debug(f'New kernel has MSE of {loss}.')
+
+        weights_before = np.sum([K.count_params(w) for w in old_layer.trainable_weights])
+        weights_after = np.sum([K.count_params(w) for w in new_layer.trainable_weights])
+
+        self.logger.debug(f'Replaced layer was using {weights_before} weights.')
+        self.logger.debug(f'TuckerConv2D is using {weights_after} weights.')
+
+        return new_layer, new_layer.name, weights_before, weights_after
+
 class DepthwiseSeparableConvolution(ModelCompression):
-    __doc__ = '\n    Compression techniques that reduces the number of weights in a filter by\n    applying the filter in two steps, one horizontal and one vertical. Instead of\n    using a DxD filter, a Dx1 is used followed by a 1xD filter. Thus, reducing the\n    number of required weights. The process to find the weights of the one\n    dimensional filters is by regressing a convolutional neural network and\n    setting the output of the original filter as the target of the regression\n    model.\n    '
+    __doc__ = '\n    Compression technique that replaces a convolutional layer by a depthwise separable\n    convolution, a DxD depthwise convolution followed by a 1x1 pointwise convolution. With\n    initialization set to least_squares, the depthwise kernel of every channel is the rank 1 SVD\n    of its slice of the kernel, the pointwise kernel is the least squares fit of the outputs\n    of the original layer on the calibration batches and both are refined during at most\n    new_layer_iterations iterations or new_layer_time_budget seconds.\n    '
 
     def __init__(self, **kwargs):
         (super(DepthwiseSeparableConvolution, self).__init__)(**kwargs)
         self.target_layer_type = 'conv'
+        set_reconstruction_settings(self)
+
+    @classmethod
+    def estimate(cls, layer_config, params):
+        return layer_cost(dict(layer_config, class_name='SeparableConv2D', depth_multiplier=1))
+
+    def initialize_weights(self, old_layer, new_layer):
+        """
+        Sets the weights of the SeparableConv2D layer so that it reconstructs the outputs of old_layer.
+        """
+        config = new_layer.get_config()
+        strides = [1] + list(config['strides']) + [1]
+        padding = config['padding'].upper()
+        kernel = old_layer.get_weights()[0]
+        kh, kw, channels, filters = kernel.shape
+
+        # Rank 1 approximation of the (kh*kw, filters) kernel of every input channel.
+        u, s, vt = np.linalg.svd(np.transpose(np.reshape(kernel, [kh * kw, channels, filters]), [1, 0, 2]), full_matrices=False)
+        depthwise_kernel = np.reshape(np.transpose(u[:, :, 0]), [kh, kw, channels, 1]).astype(np.float32)
+
+        inputs, targets = self.calibration_activations(old_layer)
+        features = tf.nn.depthwise_conv2d(inputs, depthwise_kernel, strides=strides, padding=padding)
+        pointwise_kernel, bias = least_squares(tf.reshape(features, [-1, channels]), tf.reshape(targets, [-1, filters]))
+        self.logger.debug(f'Least squares fit of the pointwise kernel has MSE of {reconstruction_error(features @ pointwise_kernel + bias, targets)}.')
+
+        variables = [tf.Variable(depthwise_kernel), tf.Variable(pointwise_kernel[None, None]), tf.Variable(bias)]
+
+        def preactivation(depthwise_kernel, pointwise_kernel, bias):
+            x = tf.nn.separable_conv2d(inputs, depthwise_kernel, pointwise_kernel, strides=strides, padding=padding)
+            return tf.nn.bias_add(x, bias)
+
+        self.reconstruction_mse = refine_reconstruction(self, preactivation, variables, targets, name='Separable reconstruction')
+        new_layer.set_weights([variable.numpy() for variable in variables])
 
     def get_new_layer(self, old_layer):
         config = old_layer.get_config()
         filters = config['filters']
         kernel_size = config['kernel_size']
         padding = config['padding']
-        new_layer = tf.keras.layers.SeparableConv2D(filters=filters, kernel_size=kernel_size, padding=padding,
-                  name=old_layer.name + '/DepthwiseSeparableLayer')
+        new_layer = tf.keras.layers.SeparableConv2D(filters=filters, kernel_size=kernel_size, strides=config['strides'], padding=padding,
+                  activation=config['activation'], name=old_layer.name + '/DepthwiseSeparableLayer')
 
         new_layer(old_layer.input)
+        if self.initialization == 'least_squares':
+            self.initialize_weights(old_layer, new_layer)
 
         weights_before = np.sum([K.count_params(w) for w in old_layer.trainable_weights])
         weights_after = np.sum([K.count_params(w) for w in new_layer.trainable_weights])
@@ -413,11 +1250,45 @@ class DepthwiseSeparableConvolution(ModelCompression):
 
 
 class FireLayerCompression(ModelCompression):
-    __doc__ = '\n    Compression techniques that replaces a convolutional layer by a fire layer,\n    which consists of 1x1 and 3x3 convolutions. A 1x1 is\n    '
+    __doc__ = '\n    Compression techniques that replaces a convolutional layer by a fire layer,\n    which consists of 1x1 and 3x3 convolutions. A 1x1 is\n    used to reduce the number of channels, which are expanded by a 1x1 convolution\n    (first half of the filters) and a DxD convolution (second half). With initialization\n    set to least_squares, the squeeze kernel projects the channels to the main singular\n    vectors of the kernel, the DxD expansion is the projected kernel and the 1x1 expansion is\n    the least squares fit of the outputs on the calibration batches. All of them are then\n    refined as in DepthwiseSeparableConvolution.\n    '
 
     def __init__(self, **kwargs):
         (super(FireLayerCompression, self).__init__)(**kwargs)
         self.target_layer_type = 'conv'
+        set_reconstruction_settings(self)
+
+    @classmethod
+    def estimate(cls, layer_config, params):
+        return layer_cost(dict(layer_config, class_name='FireLayer', squeeze_filters=layer_config['filters'] // 4))
+
+    def initialize_weights(self, old_layer, new_layer):
+        """
+        Sets the weights of the FireLayer so that it reconstructs the outputs of old_layer.
+        """
+        weights = old_layer.get_weights()
+        kernel = weights[0]
+        bias = weights[1] if len(weights) > 1 else np.zeros(kernel.shape[-1], dtype=np.float32)
+        kh, kw, channels, filters = kernel.shape
+        half = filters // 2
+        squeeze_filters = new_layer.squeeze_filters
+
+        u, _, _ = np.linalg.svd(np.reshape(np.transpose(kernel, [2, 0, 1, 3]), [channels, -1]), full_matrices=False)
+        squeeze_kernel = np.zeros([channels, squeeze_filters], dtype=np.float32)
+        rank = min(channels, squeeze_filters, u.shape[1])
+        squeeze_kernel[:, :rank] = u[:, :rank]
+        expand3x3_kernel = np.einsum('hwcf,cs->hwsf', kernel[..., half:2 * half], squeeze_kernel).astype(np.float32)
+        squeeze_kernel = squeeze_kernel[None, None]
+
+        inputs, targets = self.calibration_activations(old_layer)
+        squeezed = new_layer.squeeze(inputs, squeeze_kernel)
+        features = new_layer.expand1x1(squeezed, tf.eye(squeeze_filters)[None, None])
+        expand1x1_kernel, expand1x1_bias = least_squares(tf.reshape(features, [-1, squeeze_filters]), tf.reshape(targets[..., :half], [-1, half]))
+
+        variables = [tf.Variable(squeeze_kernel), tf.Variable(expand1x1_kernel[None, None]), tf.Variable(expand3x3_kernel),
+                     tf.Variable(np.concatenate([expand1x1_bias, bias[half:2 * half]]))]
+        self.reconstruction_mse = refine_reconstruction(self, lambda *values: new_layer.preactivation(inputs, *values), variables,
+                                                        targets[..., :2 * half], name='Fire reconstruction')
+        new_layer.set_weights([variable.numpy() for variable in variables])
 
     def get_new_layer(self, old_layer):
         config = old_layer.get_config()
@@ -436,6 +1307,11 @@ class FireLayerCompression(ModelCompression):
                   name=old_layer.name + '/FireLayer')
 
         new_layer(old_layer.input)
+        if self.initialization == 'least_squares':
+            if new_layer.output_shape == old_layer.output_shape:
+                self.initialize_weights(old_layer, new_layer)
+            else:
+                self.logger.warning(f'FireLayer output {new_layer.output_shape} does not match {old_layer.output_shape}, it will not be initialized.')
 
 
         weights_before = np.sum([K.count_params(w) for w in old_layer.trainable_weights])
@@ -453,6 +1329,25 @@ class MLPCompression(ModelCompression):
     def __init__(self, **kwargs):
         (super(MLPCompression, self).__init__)(**kwargs)
         self.target_layer_type = 'conv'
+        self.percentage = None
+        self.hidden_units = None
+
+    @classmethod
+    def estimate(cls, layer_config, params):
+        filters = layer_config['filters']
+        kh, kw = to_pair(layer_config['kernel_size'])
+        input_size = kh * kw * layer_config['input_shape'][-1]
+        hidden_units, _ = low_rank_hidden_units(input_size, filters, filters//6, params.get('percentage'), params.get('hidden_units'))
+        return layer_cost(dict(layer_config, class_name='MLPConv', hidden_units=hidden_units))
+
+    def decompose(self, old_layer, weights, hidden_units):
+        """
+        Returns the factors u and n of the rank hidden_units approximation of the kernel reshaped as a matrix.
+        """
+        u, n = truncated_svd(weights, hidden_units)
+        loss = tf.reduce_mean(tf.square(weights - tf.matmul(u, n)))
+        self.logger.info(f'New weights have MSE of {loss}.')
+        return u, n
 
     def get_new_layer(self, old_layer):
         config = old_layer.get_config()
@@ -463,41 +1358,12 @@ class MLPCompression(ModelCompression):
         
         kernel, bias = old_layer.get_weights()
 
-        weights = tf.reshape(kernel, shape=[-1, filters])
-        if self.percentage is None:
-            if self.hidden_units is None:
-                hidden_units = filters//6
-                self.percentage = 100 * hidden_units / filters
-            else:
-                hidden_units = self.hidden_units
-                self.percentage = 100 *  hidden_units / filters
-        else:
-            input_size, _ = weights.shape
-            max_filters = (input_size * filters)//(input_size+filters)
-            if isinstance(self.percentage, int):
-                hidden_units = math.ceil(max_filters*(self.percentage/100))
-            elif isinstance(self.percentage, float) or isinstance(self.percentage, np.floating):
-                hidden_units = math.ceil(max_filters*self.percentage)
-                self.percentage *= 100
+        weights = np.reshape(kernel, [-1, filters])
+        input_size, _ = weights.shape
+        hidden_units, percentage = low_rank_hidden_units(input_size, filters, filters//6, self.percentage, self.hidden_units)
             
-        self.logger.debug(f'MLP SVD is being calculated for shape {weights.shape} using {hidden_units} singular values ({self.percentage}% of units).')
-
-        try:
-            s, u, v = tf.linalg.svd(weights, full_matrices=False)
-        except Exception as e:
-            print(e)
-            with tf.device('/CPU:0'):
-                s, u, v = tf.linalg.svd(weights, full_matrices=False)
-
-        u = tf.slice(u, begin=[0, 0], size=[weights.shape[0], hidden_units])
-        s = tf.slice(s, begin=[0], size=[hidden_units])
-
-        # Transpose V as V is returned as V^T.
-        v = tf.slice(tf.linalg.matrix_transpose(v), begin=[0, 0], size=[hidden_units, filters])
-        n = tf.matmul(tf.linalg.diag(s), v)
-        new_weights = tf.matmul(u, n)
-        loss = tf.reduce_mean(tf.square(weights - new_weights))
-        self.logger.info(f'New weights have MSE of {loss}.')
+        self.logger.debug(f'MLP SVD is being calculated for shape {weights.shape} using {hidden_units} singular values ({percentage}% of units).')
+        u, n = self.decompose(old_layer, weights, hidden_units)
 
 
         new_layer = MLPConv(filters=filters, hidden_units=hidden_units, kernel_size=kernel_size, padding=padding,
@@ -516,14 +1382,55 @@ class MLPCompression(ModelCompression):
 
         return new_layer, new_layer.name, weights_before, weights_after
 
+class DataAwareMLPCompression(MLPCompression):
+    __doc__ = '\n    Compression technique that replaces a convolutional layer by a MLPConv layer whose factors\n    minimize the error of the outputs for the patches of the inputs of the dataset. See\n    DataAwareDenseSVD.\n    '
+
+    def __init__(self, **kwargs):
+        (super(DataAwareMLPCompression, self).__init__)(**kwargs)
+        self.damping = 1e-3
+
+    def decompose(self, old_layer, weights, hidden_units):
+        covariance, _ = self.input_covariance(old_layer.name, patch_config=old_layer.get_config())
+        u, n = data_aware_svd(weights, hidden_units, covariance, self.damping)
+        # Comparing with the SVD of the kernel needs another decomposition, so it is only done when it is logged.
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f'Relative output error is {relative_output_error(weights, u @ n, covariance)}, '
+                              f'{relative_output_error(weights, np.matmul(*truncated_svd(weights, hidden_units)), covariance)} using SVD.')
+        return u, n
+
 
 
 class SparseConnectionsCompression(ModelCompression):
-    __doc__ = '\n    Compression technique that sparsifies the connections between input channels\n    and output channels when applying filters in a convolutional layer.\n    '
+    __doc__ = '\n    Compression technique that sparsifies the connections between input channels\n    and output channels when applying filters in a convolutional layer. In block mode\n    the channels and filters are split in groups and whole (channels group, filters group)\n    blocks are connected, starting from the block diagonal of a grouped convolution, so\n    the layer can be exported as grouped convolutions.\n    '
 
     def __init__(self, **kwargs):
         (super(SparseConnectionsCompression, self).__init__)(**kwargs)
         self.target_layer_type = 'conv'
+        self.connection_mode = 'random'
+        self.groups = 4
+        # Fraction of the connections at the end of the fine-tuning and fraction added after every epoch.
+        self.target_perc = 0.75
+        self.conn_perc_per_epoch = 0.1
+
+    @staticmethod
+    def get_groups(channels, filters, groups):
+        """
+        Returns the largest number of groups, up to groups, that divides the channels and the filters.
+        """
+        return max(g for g in range(1, groups + 1) if channels % g == 0 and filters % g == 0)
+
+    @classmethod
+    def estimate(cls, layer_config, params):
+        """
+        Returns the number of weights once target_perc of the connections have been added. The kernel is stored
+        and applied dense, so the bytes and FLOPs do not change.
+        """
+        channels, filters = layer_config['input_shape'][-1], layer_config['filters']
+        kh, kw = to_pair(layer_config['kernel_size'])
+        cost = layer_cost(layer_config)
+        total_connections = filters * channels
+        cost['weights'] -= int(total_connections * (1-params.get('target_perc', 0.75))) * kh * kw
+        return cost
 
     def get_new_layer(self, old_layer):
         config = old_layer.get_config()
@@ -542,11 +1449,18 @@ class SparseConnectionsCompression(ModelCompression):
 
         total_connections = filters * input_channels
         self.logger.debug(f'Using {total_connections} connections')
-        connections = np.zeros(total_connections, dtype=(np.uint8))
-        remaining_connections = list(range(total_connections))
-        new_connections = np.random.choice(remaining_connections, (math.ceil(connections.shape[0] * self.conn_perc_per_epoch)),
-          replace=False)
-        connections[new_connections] = 1
+        groups = None
+        if self.connection_mode == 'block':
+            groups = self.get_groups(input_channels, filters, self.groups)
+            if groups < self.groups:
+                self.logger.warning(f'Using {groups} groups as {input_channels} channels and {filters} filters are not divisible by {self.groups}.')
+            connections = block_connections(np.eye(groups), input_channels, filters)
+        else:
+            connections = np.zeros(total_connections, dtype=(np.uint8))
+            remaining_connections = list(range(total_connections))
+            new_connections = np.random.choice(remaining_connections, (math.ceil(connections.shape[0] * self.conn_perc_per_epoch)),
+              replace=False)
+            connections[new_connections] = 1
         self.logger.debug(f'Starting sparse connnections with {np.sum(connections)} connections.')
 
 
@@ -556,7 +1470,7 @@ class SparseConnectionsCompression(ModelCompression):
                   name=old_layer.name + '/SparseConnectionsConv')
 
         self.logger.debug('Creating sparse callback.')
-        cb = AddSparseConnectionsCallback(new_layer.name, target_perc=self.target_perc, conn_perc_per_epoch=self.conn_perc_per_epoch)
+        cb = AddSparseConnectionsCallback(new_layer.name, target_perc=self.target_perc, conn_perc_per_epoch=self.conn_perc_per_epoch, groups=groups)
 
 
         if self.callbacks is None:
@@ -590,99 +1504,113 @@ class SparseConvolutionCompression(ModelCompression):
         (super(SparseConvolutionCompression, self).__init__)(**kwargs)
         self.bases = None
         self.target_layer_type = 'conv'
-
-    def find_pqs(self, layer):
+        self.new_layer_verbose = False
+        # Early stopping is opt-in, by default both stages run all their iterations.
+        self.new_layer_tolerance = None
+        self.new_layer_patience = 100
+        self.new_layer_time_budget = None
+        self.new_layer_jit_compile = False
+
+    @classmethod
+    def estimate(cls, layer_config, params):
+        """
+        params can have the expected density of S, whose zeroes are not counted as weights.
+        """
+        channels, filters = layer_config['input_shape'][-1], layer_config['filters']
+        kh, kw = to_pair(layer_config['kernel_size'])
+        bases = cls.get_bases((kh, kw, channels, filters))
+        cost = layer_cost(dict(layer_config, class_name='SparseConvolution2D', bases=bases))
+        cost['weights'] -= channels * bases * filters - math.ceil(params.get('density', 1.0) * channels * bases * filters)
+        return cost
+
+    @staticmethod
+    def get_bases(kernel_shape):
+        _, _, channels, filters = kernel_shape
+        return (9*channels*filters-channels**2)//(9*channels+channels*filters)
+
+    def find_pqs_batch(self, kernels, bases):
+        """
+        Finds matrices P, Q and S for several kernels of the same shape at once. The kernels are stacked in a
+        new leading dimension so that both optimization stages run a single compiled loop for all of them.
+        Since the loss is the sum of the losses of each kernel, every kernel is optimized independently.
+        :param kernels: list of kernels with the same shape.
+        :param bases: number of bases.
+        :return: lists of P, Q and S with one matrix per kernel.
+        """
         w_init = tf.random_normal_initializer()
-        identity_initializer = tf.initializers.Identity()
-        weights = tf.constant(layer.get_weights()[0])
-        
-        sh, sw, channels, filters = weights.shape
+        weights = tf.constant(np.stack(kernels))
+
+        n, sh, sw, channels, filters = weights.shape
         R = tf.Variable(name='R', initial_value=w_init(shape=(weights.shape), dtype='float32'),
           trainable=False)
         P = tf.Variable(
-            name='P', initial_value=identity_initializer(shape=(channels, channels), dtype='float32'), 
-            constraint=tf.keras.constraints.MaxNorm(max_value=channels, axis=-1),
+            name='P', initial_value=tf.eye(channels, batch_shape=[n], dtype='float32'),
             trainable=True)
-        self.logger.debug('Searching for matrix P.')
-
+        self.logger.debug(f'Searching for matrix P of {n} layers.')
 
-        @tf.function
-        def train_step_RP(R, P, weights):
-            with tf.GradientTape() as tape:
-                tape.watch([R,P])
-                pred = tf.einsum('hwcf,cp->hwpf',R,P)
-                loss = tf.reduce_mean(tf.square(((weights - pred))))
-            gradients = tape.gradient(loss, [R, P])
-            optimizer.apply_gradients(zip(gradients, [R,P]))
-            return loss
+        def loss_RP(R, P):
+            pred = tf.einsum('nhwcf,ncp->nhwpf', R, P)
+            return tf.reduce_sum(tf.reduce_mean(tf.square(weights - pred), axis=[1, 2, 3, 4]))
 
-        optimizer = tf.keras.optimizers.Adam()
         start_time = datetime.now()
-        for i in range(self.new_layer_iterations):
-            loss = train_step_RP(R, P, weights)
-            if self.new_layer_verbose and i % 100 == 0:
-                self.logger.info(f'Epoch {i} of RxP Loss: {loss}')
+        loss, iterations = minimize_loss(loss_RP, [R, P], self.new_layer_iterations, learning_rate=1e-3,
+                                         constraints=[None, tf.keras.constraints.MaxNorm(max_value=channels, axis=-1)],
+                                         tolerance=self.new_layer_tolerance, patience=self.new_layer_patience,
+                                         time_budget=self.new_layer_time_budget, jit_compile=self.new_layer_jit_compile,
+                                         verbose=self.new_layer_verbose, name='RxP')
 
         training_time = (datetime.now() - start_time).total_seconds()
-        self.logger.info(f'Took {training_time} secs for {self.new_layer_iterations} iterations and {loss} MSE.')
+        self.logger.info(f'Took {training_time} secs for {iterations} iterations and {loss} MSE.')
 
 
         self.logger.debug('Searching for matrices Q and S.')
         zeroes = tf.zeros_initializer()
-        S = tf.Variable(name='S', initial_value=zeroes(shape=(channels, self.bases, filters),
+        S = tf.Variable(name='S', initial_value=zeroes(shape=(n, channels, bases, filters),
           dtype='float32'),
-          constraint = SparseWeights(1e-6),
           trainable=True)
-        Q = tf.Variable(name='Q', initial_value=w_init(shape=(channels, sh, sw, self.bases),
-          dtype='float32'), constraint=tf.keras.constraints.MaxNorm(max_value=self.bases, axis=-1),
-          trainable=True)
-
+        Q = w_init(shape=(n, channels, sh, sw, bases), dtype='float32').numpy()
         for i in range(sh):
-            Q[:, i, i, :].assign(tf.ones(shape=(channels, self.bases)))
+            Q[:, :, i, i, :] = 1.0
+        Q = tf.Variable(name='Q', initial_value=Q, trainable=True)
 
+        expected_value = tf.constant(R)
 
-        @tf.function
-        def train_step_SQ(S, Q, expected_value):
-            with tf.GradientTape() as tape:
-                tape.watch([S,Q])
-                SQ = tf.einsum('chwb,cbf->hwcf', Q, S)
-                loss = tf.reduce_mean(tf.square(expected_value - SQ)) + tf.reduce_mean(tf.square(S))
-            gradients = tape.gradient(loss, [S, Q])
-            optimizer.apply_gradients(zip(gradients, [S, Q]))
-            return loss
-
-        optimizer = tf.keras.optimizers.Adam(1e-5)
+        def loss_SQ(S, Q):
+            SQ = tf.einsum('nchwb,ncbf->nhwcf', Q, S)
+            loss = tf.reduce_mean(tf.square(expected_value - SQ), axis=[1, 2, 3, 4]) + tf.reduce_mean(tf.square(S), axis=[1, 2, 3])
+            return tf.reduce_sum(loss)
 
-        expected_value = tf.constant(R)
         start_time = datetime.now()
-        for i in range(self.new_layer_iterations_sparse):
-            loss = train_step_SQ(S, Q, expected_value)
-            if self.new_layer_verbose and i % 1000 == 0:
-                self.logger.debug(f'Epoch {i} Loss: {loss}')
+        loss, iterations = minimize_loss(loss_SQ, [S, Q], self.new_layer_iterations_sparse, learning_rate=1e-5,
+                                         constraints=[SparseWeights(1e-6), tf.keras.constraints.MaxNorm(max_value=bases, axis=-1)],
+                                         tolerance=self.new_layer_tolerance, patience=self.new_layer_patience,
+                                         time_budget=self.new_layer_time_budget, jit_compile=self.new_layer_jit_compile,
+                                         verbose=self.new_layer_verbose, log_every=1000, name='SxQ')
 
         training_time = (datetime.now() - start_time).total_seconds()
-        self.logger.info(f'Took {training_time} secs for {self.new_layer_iterations_sparse} iterations and {loss} MSE.')
+        self.logger.info(f'Took {training_time} secs for {iterations} iterations and {loss} MSE.')
 
-        self.logger.debug(f'Matrix P has shape {P.shape}')
-        self.logger.debug(f'Matrix Q has shape {Q.shape}')
-        self.logger.debug(f'Matrix S has shape {S.shape}')
-        return P.numpy(), Q.numpy(), S.numpy()
+        self.logger.debug(f'Matrix P has shape {P.shape[1:]}')
+        self.logger.debug(f'Matrix Q has shape {Q.shape[1:]}')
+        self.logger.debug(f'Matrix S has shape {S.shape[1:]}')
+        return list(P.numpy()), list(Q.numpy()), list(S.numpy())
 
-    def get_new_layer(self, old_layer):
-        config = old_layer.get_config()
-        kernel, bias = old_layer.get_weights()
-        _, _, channels, filters = kernel.shape
-        self.bases = (9*channels*filters-channels**2)//(9*channels+channels*filters)
+    def find_pqs(self, layer):
+        P, Q, S = self.find_pqs_batch([layer.get_weights()[0]], self.bases)
+        return P[0], Q[0], S[0]
 
-        self.logger.debug(f'Using {self.bases} bases for {channels} input channels.')
+    def create_layer(self, old_layer, P, Q, S):
+        config = old_layer.get_config()
+        _, bias = old_layer.get_weights()
         activation = config['activation']
         kernel_size =config['kernel_size']
         padding = config['padding']
+        filters = config['filters']
+        bases = Q.shape[-1]
 
-        P, Q, S = self.find_pqs(old_layer)
         new_layer = SparseConvolution2D(kernel_size=kernel_size, filters=filters, padding=padding,
                   activation=activation,
-                  bases=(self.bases),
+                  bases=bases,
                   name=old_layer.name + '/SparseConv2D')
 
         new_layer(old_layer.input)
@@ -699,6 +1627,323 @@ class SparseConvolutionCompression(ModelCompression):
 
         return new_layer, new_layer.name, weights_before, weights_after
 
+    def get_new_layer(self, old_layer):
+        kernel, _ = old_layer.get_weights()
+        channels = kernel.shape[2]
+        self.bases = self.get_bases(kernel.shape)
+
+        self.logger.debug(f'Using {self.bases} bases for {channels} input channels.')
+
+        P, Q, S = self.find_pqs(old_layer)
+        return self.create_layer(old_layer, P, Q, S)
+
+    def get_new_layers(self, old_layers):
+        """
+        Layers whose kernels have the same shape are optimized together in a single batch.
+        """
+        groups = defaultdict(list)
+        for idx, old_layer in enumerate(old_layers):
+            groups[tuple(old_layer.get_weights()[0].shape)].append(idx)
+
+        results = [None] * len(old_layers)
+        for kernel_shape, indexes in groups.items():
+            self.bases = self.get_bases(kernel_shape)
+            self.logger.debug(f'Using {self.bases} bases for {len(indexes)} layers with kernel shape {kernel_shape}.')
+            kernels = [old_layers[idx].get_weights()[0] for idx in indexes]
+            P, Q, S = self.find_pqs_batch(kernels, self.bases)
+            for n, idx in enumerate(indexes):
+                results[idx] = self.create_layer(old_layers[idx], P[n], Q[n], S[n])
+
+        return results
+
         
 
+class PostTrainingQuantization(ModelCompression):
+    __doc__ = '\n    Compression technique that stores the kernels of a layer as 8-bit integers with a\n    float scale per output channel. The range of the inputs of the layer is calibrated\n    with a few batches so that they are fake quantized as well. Supports Dense, Conv2D,\n    DenseSVD and MLPConv layers and reduces the memory of their kernels 4 times.\n    '
+
+    def __init__(self, **kwargs):
+        (super(PostTrainingQuantization, self).__init__)(**kwargs)
+        self.target_layer_type = 'any'
+        self.calibration_dataset = None
+        self.num_calibration_batches = 10
+        self.quantize_inputs = True
+
+    @classmethod
+    def estimate(cls, layer_config, params):
+        cost = layer_cost(layer_config)
+        outputs = layer_config['units'] if 'units' in layer_config else layer_config['filters']
+        # Every kernel has a scale per column, the factorized layers have two kernels.
+        if layer_config['class_name'] in ['DenseSVD', 'MLPConv']:
+            scales = layer_config['hidden_units'] + outputs
+        else:
+            scales = outputs
+        cost['bytes'] = (cost['weights'] - outputs) + (scales + outputs) * 4
+        return cost
+
+    def calibrate(self, old_layer):
+        """
+        Finds the minimum and maximum value of the inputs of the layer in the calibration batches.
+        """
+        min_value, max_value = np.inf, -np.inf
+        for inputs in self.layer_inputs(old_layer.name, self.calibration_dataset, self.num_calibration_batches):
+            min_value = min(min_value, float(tf.reduce_min(inputs)))
+            max_value = max(max_value, float(tf.reduce_max(inputs)))
+        self.logger.debug(f'Inputs of {old_layer.name} are in the range [{min_value}, {max_value}].')
+        return [min(min_value, 0.0), max(max_value, 0.0)]
+
+    def get_new_layer(self, old_layer):
+        if isinstance(old_layer, (QuantizedDenseSVD, QuantizedMLPConv)):
+            raise ValueError(f'Layer {old_layer.name} is already quantized.')
+
+        config = old_layer.get_config()
+        input_range = self.calibrate(old_layer) if self.quantize_inputs else None
+        name = old_layer.name + '/Quantized'
+
+        if isinstance(old_layer, tf.keras.layers.Dense):
+            kernel, bias = old_layer.get_weights()
+            new_layer = QuantizedDense(units=config['units'], activation=config['activation'], input_range=input_range, name=name)
+            new_layer(old_layer.input)
+            kernel_q, kernel_scale = quantize_per_channel(kernel)
+            new_layer.kernel_q.assign(kernel_q)
+            new_layer.kernel_scale.assign(kernel_scale)
+            new_layer.bias0.assign(bias)
+        elif type(old_layer) == tf.keras.layers.Conv2D:
+            kernel, bias = old_layer.get_weights()
+            new_layer = QuantizedConv2D(filters=config['filters'], kernel_size=config['kernel_size'], strides=config['strides'],
+                                        padding=config['padding'], activation=config['activation'], input_range=input_range, name=name)
+            new_layer(old_layer.input)
+            kernel_q, kernel_scale = quantize_per_channel(kernel)
+            new_layer.kernel_q.assign(kernel_q)
+            new_layer.kernel_scale.assign(kernel_scale)
+            new_layer.bias.assign(bias)
+        elif isinstance(old_layer, DenseSVD):
+            u, n, bias = old_layer.get_weights()
+            new_layer = QuantizedDenseSVD(units=old_layer.units, hidden_units=old_layer.hidden_units, activation=old_layer.activation,
+                                          input_range=input_range, name=name)
+            new_layer(old_layer.input)
+            for factor, (factor_q, factor_scale) in zip([(new_layer.u_q, new_layer.u_scale), (new_layer.n_q, new_layer.n_scale)],
+                                                        [quantize_per_channel(u), quantize_per_channel(n)]):
+                factor[0].assign(factor_q)
+                factor[1].assign(factor_scale)
+            new_layer.bias0.assign(bias)
+        elif isinstance(old_layer, MLPConv):
+            w_0, w_1, bias = old_layer.get_weights()
+            new_layer = QuantizedMLPConv(filters=old_layer.filters, hidden_units=old_layer.hidden_units, kernel_size=old_layer.kernel_size,
+                                         strides=old_layer.strides, padding=old_layer.padding, activation=old_layer.activation,
+                                         input_range=input_range, name=name)
+            new_layer(old_layer.input)
+            for factor, (factor_q, factor_scale) in zip([(new_layer.w_0_q, new_layer.w_0_scale), (new_layer.w_1_q, new_layer.w_1_scale)],
+                                                        [quantize_per_channel(w_0), quantize_per_channel(w_1)]):
+                factor[0].assign(factor_q)
+                factor[1].assign(factor_scale)
+            new_layer.bias.assign(bias)
+        else:
+            raise ValueError(f'Layer {old_layer.name} of type {type(old_layer).__name__} cannot be quantized.')
+
+        # The number of weights does not change, only their size.
+        weights_before = np.sum([K.count_params(w) for w in old_layer.trainable_weights])
+        weights_after = weights_before
+
+        self.logger.debug(f'Quantized layer {old_layer.name} with input range {input_range}.')
+
+        return new_layer, new_layer.name, weights_before, weights_after
+
+class FilterPruning(ModelCompression):
+    __doc__ = '\n    Compression technique that removes the least important filters of a convolutional layer.\n    Filters are ranked by the L1 norm of their kernel or by the mean absolute activation of\n    their feature maps. The input channels of the next layer that uses them (Conv2D, Dense or\n    DenseSVD, after BatchNormalization, pooling and flatten layers) are removed as well, so the\n    pruned model only uses standard kernels with fewer channels. The downstream layers keep\n    their names.\n    '
+
+    def __init__(self, **kwargs):
+        (super(FilterPruning, self).__init__)(**kwargs)
+        self.target_layer_type = 'conv'
+        # Fraction (float) or percentage (int) of the filters that are kept.
+        self.percentage = 0.5
+        self.criterion = 'l1'
+        # Optional dictionary with the feature maps of the layers, used by the activation criterion.
+        self.feature_maps = None
+        self.downstream_layers = {}
+
+    # Layers between the pruned layer and the next layer with weights that keep the channels of their inputs.
+    channel_layers = (tf.keras.layers.Flatten, tf.keras.layers.MaxPooling2D, tf.keras.layers.AveragePooling2D,
+                      tf.keras.layers.GlobalMaxPooling2D, tf.keras.layers.GlobalAveragePooling2D,
+                      tf.keras.layers.Dropout, tf.keras.layers.Activation, tf.keras.layers.ReLU)
+
+    @staticmethod
+    def uses_filters(layer):
+        """
+        Returns whether the input channels of a layer can be removed, which makes it the last layer modified.
+        """
+        return type(layer) in (tf.keras.layers.Conv2D, DenseSVD) or isinstance(layer, tf.keras.layers.Dense)
+
+    @classmethod
+    def following_layers(cls, model, pruned_layer):
+        """
+        Yields the layers that use the filters of pruned_layer, from the layer that takes its outputs to the next
+        layer with weights.
+        :raises ValueError: if the filters are used by several layers or by a layer that cannot be pruned, e.g.
+        one that adds or concatenates them with the outputs of other layers.
+        """
+        layer = pruned_layer
+        while True:
+            next_layers = [next_layer for next_layer in model.layers
+                           if any(tensor is layer.output for tensor in tf.nest.flatten(next_layer.input))]
+            if not next_layers:
+                return
+            if len(next_layers) > 1:
+                raise ValueError(f'Filters of {pruned_layer.name} cannot be pruned as they are used by {[l.name for l in next_layers]}.')
+            layer = next_layers[0]
+            if not (isinstance(layer, (tf.keras.layers.BatchNormalization,) + cls.channel_layers) or cls.uses_filters(layer)):
+                raise ValueError(f'Filters of {pruned_layer.name} cannot be pruned as they are used by {layer.name} of type {type(layer).__name__}.')
+            yield layer
+            if cls.uses_filters(layer):
+                return
+
+    @staticmethod
+    def get_num_kept_filters(filters, percentage):
+        if isinstance(percentage, (float, np.floating)):
+            return max(1, math.ceil(filters * percentage))
+        return max(1, math.ceil(filters * percentage / 100))
+
+    @classmethod
+    def estimate(cls, layer_config, params):
+        kept_filters = cls.get_num_kept_filters(layer_config['filters'], params.get('percentage', 0.5))
+        return layer_cost(dict(layer_config, filters=kept_filters, output_shape=layer_config['output_shape'][:-1] + (kept_filters,)))
+
+    @classmethod
+    def estimate_in_model(cls, model, layer_name, params, configs=None):
+        if configs is None:
+            configs = {}
+        names = [layer.name for layer in model.layers]
+        idx = names.index(layer_name)
+        layer_config, before = planned_layer_config_cost(model.layers[idx], configs)
+        filters = layer_config['filters']
+        kept_filters = cls.get_num_kept_filters(filters, params.get('percentage', 0.5))
+
+        after = cls.estimate(layer_config, params)
+        configs[layer_name] = dict(layer_config, filters=kept_filters, output_shape=layer_config['output_shape'][:-1] + (kept_filters,))
+        # The layers between the pruned layer and the next layer with weights (BN, pooling, flatten) have fewer channels.
+        for next_layer in cls.following_layers(model, model.layers[idx]):
+            next_config, next_cost = planned_layer_config_cost(next_layer, configs)
+            input_shape, output_shape = next_config['input_shape'], next_config['output_shape']
+            if isinstance(next_layer, tf.keras.layers.Flatten):
+                output_shape = (output_shape[-1] // filters * kept_filters,)
+            elif not cls.uses_filters(next_layer):
+                output_shape = output_shape[:-1] + (kept_filters,)
+            if len(input_shape) == 1:
+                input_shape = (input_shape[-1] // filters * kept_filters,)
+            else:
+                input_shape = input_shape[:-1] + (kept_filters,)
+            configs[next_layer.name] = dict(next_config, input_shape=input_shape, output_shape=output_shape)
+            before = add_costs(before, next_cost)
+            after = add_costs(after, layer_cost(configs[next_layer.name]))
+        return before, after
+
+    def rank_filters(self, old_layer):
+        """
+        Returns the importance of every filter of the layer.
+        """
+        if self.criterion == 'l1':
+            kernel = old_layer.get_weights()[0]
+            return np.sum(np.abs(kernel), axis=(0, 1, 2))
+        if self.criterion == 'activation':
+            if self.feature_maps is not None and old_layer.name in self.feature_maps:
+                return np.mean(np.abs(self.feature_maps[old_layer.name]), axis=(0, 1, 2))
+            scores = np.zeros(old_layer.get_config()['filters'])
+            num_batches = 0
+            for inputs in self.layer_inputs(old_layer.name):
+                scores += tf.reduce_mean(tf.abs(old_layer(inputs)), axis=[0, 1, 2]).numpy()
+                num_batches += 1
+            return scores / max(num_batches, 1)
+        raise ValueError(f'Criterion {self.criterion} is not supported. Use l1 or activation.')
+
+    @staticmethod
+    def create_pruned_layer(old_layer, weights, input_shape, **config):
+        """
+        Creates a layer with the config of old_layer updated with config and sets its weights.
+        """
+        new_layer = old_layer.__class__.from_config(dict(old_layer.get_config(), **config))
+        new_layer.build(input_shape)
+        new_layer.set_weights(weights)
+        return new_layer
+
+    def prune_downstream_layers(self, old_layer, kept_filters):
+        """
+        Removes the input channels of the layers after old_layer that use the pruned filters.
+        :return: dictionary with the name of every modified layer and the layer that replaces it.
+        """
+        new_layers = {}
+        kept = kept_filters
+        for layer in self.following_layers(self.model, old_layer):
+            input_shape = list(layer.input_shape)
+            if isinstance(layer, tf.keras.layers.BatchNormalization):
+                input_shape[-1] = len(kept)
+                weights = [w[kept] for w in layer.get_weights()]
+                new_layers[layer.name] = self.create_pruned_layer(layer, weights, input_shape)
+            elif isinstance(layer, self.channel_layers):
+                if isinstance(layer, tf.keras.layers.Flatten):
+                    # The flattened position of channel c at (h, w) is (h*W + w)*C + c.
+                    height, width, channels = layer.input_shape[1:]
+                    kept = (np.arange(height * width)[:, None] * channels + kept[None, :]).ravel()
+                # A copy is used so that the layer does not have inbound nodes with different shapes.
+                new_layers[layer.name] = layer.__class__.from_config(layer.get_config())
+            elif type(layer) == tf.keras.layers.Conv2D:
+                input_shape[-1] = len(kept)
+                weights = layer.get_weights()
+                weights[0] = weights[0][:, :, kept, :]
+                new_layers[layer.name] = self.create_pruned_layer(layer, weights, input_shape)
+                break
+            elif isinstance(layer, tf.keras.layers.Dense):
+                input_shape[-1] = len(kept)
+                weights = layer.get_weights()
+                weights[0] = weights[0][kept]
+                new_layers[layer.name] = self.create_pruned_layer(layer, weights, input_shape)
+                break
+            elif type(layer) == DenseSVD:
+                u, n, bias = layer.get_weights()
+                new_layer = DenseSVD(units=layer.units, hidden_units=layer.hidden_units, activation=layer.activation, name=layer.name)
+                new_layer.build([None, len(kept)])
+                new_layer.set_weights([u[kept], n, bias])
+                new_layers[layer.name] = new_layer
+                break
+
+        return new_layers
+
+    def get_new_layer(self, old_layer):
+        if type(old_layer) != tf.keras.layers.Conv2D:
+            raise ValueError(f'Layer {old_layer.name} of type {type(old_layer).__name__} cannot be pruned.')
+
+        filters = old_layer.get_config()['filters']
+        num_kept = self.get_num_kept_filters(filters, self.percentage)
+        scores = self.rank_filters(old_layer)
+        kept_filters = np.sort(np.argsort(scores)[-num_kept:])
+        self.logger.debug(f'Keeping {num_kept} of {filters} filters of {old_layer.name} using {self.criterion} criterion.')
+
+        weights = old_layer.get_weights()
+        weights = [weights[0][..., kept_filters]] + [w[kept_filters] for w in weights[1:]]
+        new_layer = self.create_pruned_layer(old_layer, weights, old_layer.input_shape, filters=num_kept, name=old_layer.name + '/Pruned')
+
+        self.downstream_layers = self.prune_downstream_layers(old_layer, kept_filters)
+
+        weights_before = np.sum([K.count_params(w) for w in old_layer.trainable_weights])
+        weights_after = np.sum([K.count_params(w) for w in new_layer.trainable_weights])
+        for layer_name, downstream_layer in self.downstream_layers.items():
+            weights_before += np.sum([K.count_params(w) for w in self.model.get_layer(layer_name).trainable_weights])
+            weights_after += np.sum([K.count_params(w) for w in downstream_layer.trainable_weights])
+
+        self.logger.debug(f'Replaced layers were using {weights_before} weights.')
+        self.logger.debug(f'Pruned layers are using {weights_after} weights.')
+
+        return new_layer, new_layer.name, weights_before, weights_after
+
+    def replace_layer(self, new_layer, layer_name):
+        return self.replace_layers(dict(self.downstream_layers, **{layer_name: new_layer}))
+
+    def compress_layers(self, layer_names: list, **kwargs):
+        """
+        The layers are pruned one at a time, as pruning a layer changes the inputs of the next one.
+        """
+        new_layer_names = []
+        for layer_name in layer_names:
+            self.compress_layer(layer_name, **kwargs)
+            new_layer_names.append(self.new_layer_name)
+        self.new_layer_names = new_layer_names
+
 # okay decompiling CompressionTechniques.cpython-36.pyc
@@ -0,0 +1,75 @@
+import json
+import tensorflow as tf
+import numpy as np
+from timeit import default_timer as timer
+
+
+def time_function(fn, *args, warmup=5, repeats=50):
+    """
+    Measures the latency of a function. The result of every call is converted to numpy so that the time
+    includes the whole computation and not only its dispatch.
+    :param fn: function to measure.
+    :param args: arguments of the function.
+    :param warmup: number of calls that are not measured (tracing, allocation of buffers, etc.).
+    :param repeats: number of measured calls.
+    :return: dictionary with the mean, standard deviation, median and 90th percentile in milliseconds.
+    """
+    for _ in range(warmup):
+        tf.nest.map_structure(lambda t: t.numpy() if hasattr(t, 'numpy') else t, fn(*args))
+
+    times = []
+    for _ in range(repeats):
+        start = timer()
+        tf.nest.map_structure(lambda t: t.numpy() if hasattr(t, 'numpy') else t, fn(*args))
+        times.append((timer() - start) * 1000)
+
+    times = np.asarray(times)
+    return {'mean_ms': float(np.mean(times)), 'std_ms': float(np.std(times)),
+            'p50_ms': float(np.percentile(times, 50)), 'p90_ms': float(np.percentile(times, 90))}
+
+
+def variables_bytes(layer):
+    """
+    Returns the number of bytes used by the weights of a layer or model.
+    """
+    return int(np.sum([w.shape.num_elements() * w.dtype.size for w in layer.weights]))
+
+
+# Latency of the layers measured by layer_latency, indexed by the type, config and input shape of the layer.
+_latency_cache = {}
+
+
+def layer_latency(layer, batch_size=1, warmup=5, repeats=50):
+    """
+    Measures the CPU latency of a layer for a batch of random inputs. The measurements are cached by the type,
+    config (without the name) and input shape of the layer, so equal layers of different models are only measured
+    once.
+    :param layer: built Keras layer.
+    :param batch_size: batch size of the inputs.
+    :return: median latency in milliseconds.
+    """
+    if isinstance(layer, tf.keras.layers.InputLayer):
+        return 0.0
+
+    config = layer.get_config().copy()
+    config.pop('name', None)
+    # Layers with several inputs (Add, Concatenate, etc.) have a list of shapes.
+    input_shapes = layer.input_shape if isinstance(layer.input_shape, list) else [layer.input_shape]
+    input_shapes = tuple(tuple(shape[1:]) for shape in input_shapes)
+    key = (type(layer).__name__, json.dumps(config, sort_keys=True, default=str), input_shapes, batch_size)
+    if key not in _latency_cache:
+        with tf.device('/CPU:0'):
+            inputs = [tf.random.uniform((batch_size,) + shape) for shape in input_shapes]
+            if not isinstance(layer.input_shape, list):
+                inputs = inputs[0]
+            fn = tf.function(lambda x: layer(x, training=False))
+            _latency_cache[key] = time_function(fn, inputs, warmup=warmup, repeats=repeats)['p50_ms']
+    return _latency_cache[key]
+
+
+def model_latency(model, batch_size=1, warmup=5, repeats=50):
+    """
+    Returns the CPU latency of a model as the sum of the latency of its layers, and the latency of every layer.
+    """
+    layers_latency = {layer.name: layer_latency(layer, batch_size, warmup, repeats) for layer in model.layers}
+    return sum(layers_latency.values()), layers_latency
@@ -0,0 +1,250 @@
+import math
+import logging
+from CompressionLibrary.benchmark import variables_bytes
+
+# Analytic cost of the layers used by the compressors. A cost is a dictionary with the number of weights, the
+# bytes needed to store them and the FLOPs of a forward pass of one sample, where a multiply-add counts as 2 FLOPs.
+# Bias additions and activations are not counted. A layer config is the Keras config of a layer with its
+# class_name, input_shape and output_shape (without the batch dimension), see get_layer_config.
+
+FLOAT_BYTES = 4
+
+
+def make_cost(weights, flops, bytes=None):
+    if bytes is None:
+        bytes = weights * FLOAT_BYTES
+    return {'weights': int(weights), 'bytes': int(bytes), 'flops': int(flops)}
+
+
+def add_costs(*costs):
+    return {key: sum(cost[key] for cost in costs) for key in ['weights', 'bytes', 'flops']}
+
+
+def get_layer_config(layer):
+    """
+    Returns the config of a Keras layer with the information used by the cost model.
+    """
+    config = layer.get_config().copy()
+    config['class_name'] = type(layer).__name__
+    input_shape, output_shape = layer.input_shape, layer.output_shape
+    # Input layers and layers with several inputs have a list of shapes.
+    if isinstance(input_shape, list):
+        input_shape = input_shape[0]
+    if isinstance(output_shape, list):
+        output_shape = output_shape[0]
+    config['input_shape'] = tuple(input_shape[1:])
+    config['output_shape'] = tuple(output_shape[1:])
+    return config
+
+
+def to_pair(value):
+    if isinstance(value, int):
+        return value, value
+    return tuple(value)
+
+
+def conv_output_size(size, kernel_size, stride, padding):
+    if padding.upper() == 'SAME':
+        return math.ceil(size / stride)
+    return math.ceil((size - kernel_size + 1) / stride)
+
+
+def conv_output_shape(input_shape, kernel_size, strides, padding):
+    """
+    Returns the height and width of the output of a convolution.
+    """
+    height, width = input_shape[:2]
+    kh, kw = to_pair(kernel_size)
+    sh, sw = to_pair(strides)
+    return conv_output_size(height, kh, sh, padding), conv_output_size(width, kw, sw, padding)
+
+
+def dense_cost(features, units):
+    return make_cost(features * units + units, 2 * features * units)
+
+
+def conv2d_cost(kernel_size, channels, filters, output_hw):
+    kh, kw = to_pair(kernel_size)
+    out_h, out_w = output_hw
+    return make_cost(kh * kw * channels * filters + filters, 2 * out_h * out_w * kh * kw * channels * filters)
+
+
+def num_elements(shape):
+    return int(math.prod([dim for dim in shape if dim is not None]))
+
+
+def layer_cost(layer_config):
+    """
+    Returns the cost of a layer from its config. Layers that only reshape or select values (flatten, dropout,
+    input, etc.) and element-wise activations cost 0.
+    """
+    class_name = layer_config['class_name']
+    input_shape = layer_config['input_shape']
+    output_shape = layer_config['output_shape']
+
+    if class_name in ['Dense', 'QuantizedDense', 'ClusteredDense']:
+        cost = dense_cost(input_shape[-1], layer_config['units'])
+        if not layer_config.get('use_bias', True):
+            cost = make_cost(cost['weights'] - layer_config['units'], cost['flops'])
+        return cost
+    if class_name == 'HashedDense':
+        features, units = input_shape[-1], layer_config['units']
+        return make_cost(layer_config['num_buckets'] + units, 2 * features * units)
+    if class_name == 'SparseDense':
+        nnz = layer_config['nnz']
+        units = layer_config['units'] if layer_config.get('use_bias', True) else 0
+        return make_cost(nnz + units, 2 * nnz, bytes=nnz * 12 + units * 4)
+    if class_name in ['DenseSVD', 'QuantizedDenseSVD']:
+        features, units, hidden_units = input_shape[-1], layer_config['units'], layer_config['hidden_units']
+        return make_cost((features + units) * hidden_units + units, 2 * (features + units) * hidden_units)
+    if class_name == 'TTDense':
+        input_modes, output_modes, tt_ranks = layer_config['input_modes'], layer_config['output_modes'], layer_config['tt_ranks']
+        weights = sum(tt_ranks[k] * n * m * tt_ranks[k+1] for k, (n, m) in enumerate(zip(input_modes, output_modes)))
+        # Contracting core k multiplies the outputs already computed by the features not yet contracted.
+        flops = sum(2 * num_elements(output_modes[:k+1]) * num_elements(input_modes[k:]) * tt_ranks[k] * tt_ranks[k+1]
+                    for k in range(len(input_modes)))
+        return make_cost(weights + layer_config['units'], flops)
+    if class_name == 'SparseSVD':
+        features, units, basis_vectors = input_shape[-1], layer_config['units'], layer_config['basis_vectors']
+        return make_cost((features + units) * basis_vectors + units, 2 * (features + units) * basis_vectors)
+
+    if class_name in ['Conv2D', 'QuantizedConv2D', 'ClusteredConv2D', 'SparseConnectionsConv2D']:
+        # Every filter of a grouped convolution only sees the channels of its group.
+        channels = input_shape[-1] // layer_config.get('groups', 1)
+        cost = conv2d_cost(layer_config['kernel_size'], channels, layer_config['filters'], output_shape[:2])
+        if not layer_config.get('use_bias', True):
+            cost = make_cost(cost['weights'] - layer_config['filters'], cost['flops'])
+        return cost
+    if class_name == 'HashedConv2D':
+        cost = conv2d_cost(layer_config['kernel_size'], input_shape[-1], layer_config['filters'], output_shape[:2])
+        return make_cost(layer_config['num_buckets'] + layer_config['filters'], cost['flops'])
+    if class_name in ['SeparableConv2D', 'DepthwiseConv2D']:
+        kh, kw = to_pair(layer_config['kernel_size'])
+        depthwise_channels = input_shape[-1] * layer_config.get('depth_multiplier', 1)
+        weights = kh * kw * depthwise_channels
+        if class_name == 'SeparableConv2D':
+            weights += depthwise_channels * layer_config['filters']
+        bias = output_shape[-1] if layer_config.get('use_bias', True) else 0
+        return make_cost(weights + bias, 2 * num_elements(output_shape[:2]) * weights)
+    if class_name in ['MLPConv', 'QuantizedMLPConv']:
+        kh, kw = to_pair(layer_config['kernel_size'])
+        input_size = kh * kw * input_shape[-1]
+        filters, hidden_units = layer_config['filters'], layer_config['hidden_units']
+        return make_cost((input_size + filters) * hidden_units + filters, 2 * num_elements(output_shape[:2]) * (input_size + filters) * hidden_units)
+    if class_name == 'ConvSVD':
+        channels, filters, hidden_filters = input_shape[-1], layer_config['filters'], layer_config['hidden_filters']
+        kh, kw = to_pair(layer_config['kernel_size'])
+        # The kx1 convolution only reduces the height, the 1xk convolution the width.
+        vertical_hw = (output_shape[0], input_shape[1])
+        flops = 2 * hidden_filters * (num_elements(vertical_hw) * kh * channels + num_elements(output_shape[:2]) * kw * filters)
+        return make_cost(hidden_filters * (kh * channels + kw * filters) + filters, flops)
+    if class_name == 'TuckerConv2D':
+        channels, filters = input_shape[-1], layer_config['filters']
+        input_rank, output_rank = layer_config['input_rank'], layer_config['output_rank']
+        kh, kw = to_pair(layer_config['kernel_size'])
+        weights = channels * input_rank + kh * kw * input_rank * output_rank + output_rank * filters + filters
+        flops = 2 * (num_elements(input_shape[:2]) * channels * input_rank
+                     + num_elements(output_shape[:2]) * (kh * kw * input_rank + filters) * output_rank)
+        return make_cost(weights, flops)
+    if class_name == 'FireLayer':
+        channels, filters, squeeze_filters = input_shape[-1], layer_config['filters'], layer_config['squeeze_filters']
+        kh, kw = to_pair(layer_config['kernel_size'])
+        # The squeeze is applied to every pixel of the input. The fused kernel computes both expansions with a
+        # kxk convolution, so the zeroes around the 1x1 kernel are also multiplied.
+        expand_size = 2 * kh * kw if layer_config.get('kernel_mode', 'separate') == 'fused' else 1 + kh * kw
+        flops = 2 * (num_elements(input_shape[:2]) * channels * squeeze_filters
+                     + num_elements(output_shape[:2]) * expand_size * squeeze_filters * (filters//2))
+        weights = channels * squeeze_filters + (1 + kh * kw) * squeeze_filters * (filters//2) + filters
+        return make_cost(weights, flops)
+    if class_name == 'SparseConvolution2D':
+        channels, filters, bases = input_shape[-1], layer_config['filters'], layer_config['bases']
+        kh, kw = to_pair(layer_config['kernel_size'])
+        weights = channels * channels + channels * kh * kw * bases + channels * bases * filters + filters
+        flops = 2 * (num_elements(input_shape[:2]) * channels * channels + num_elements(output_shape[:2]) * channels * bases * (kh * kw + filters))
+        return make_cost(weights, flops)
+
+    if class_name == 'BatchNormalization':
+        # Gamma, beta, moving mean and variance. Inference is a multiply-add per element.
+        return make_cost(4 * input_shape[-1], 2 * num_elements(input_shape))
+    if class_name in ['MaxPooling2D', 'AveragePooling2D']:
+        return make_cost(0, num_elements(output_shape) * num_elements(to_pair(layer_config['pool_size'])))
+    if class_name in ['GlobalAveragePooling2D', 'GlobalMaxPooling2D']:
+        return make_cost(0, num_elements(input_shape))
+    if class_name in ['Add', 'Average', 'Maximum']:
+        return make_cost(0, num_elements(output_shape))
+    return make_cost(0, 0)
+
+
+def layer_flops(layer):
+    """
+    Returns the FLOPs of a layer of a model. Nested models (e.g. the grouped convolutions of
+    model_passes.sparse_connections_to_grouped) cost the sum of their layers.
+    """
+    if hasattr(layer, 'layers'):
+        return sum(layer_flops(nested_layer) for nested_layer in layer.layers)
+    return layer_cost(get_layer_config(layer))['flops']
+
+
+def model_flops(model):
+    """
+    Returns the FLOPs of a forward pass of one sample through the model and the FLOPs of every layer.
+    """
+    layers_flops = {layer.name: layer_flops(layer) for layer in model.layers}
+    return sum(layers_flops.values()), layers_flops
+
+
+def current_layer_cost(layer):
+    """
+    Returns the cost of a layer of a model. The weights and bytes are taken from its variables, so they include
+    the zeroes of pruned kernels.
+    """
+    return {'weights': layer.count_params(), 'bytes': variables_bytes(layer),
+            'flops': layer_flops(layer)}
+
+
+def planned_layer_config_cost(layer, configs=None):
+    """
+    Returns the config and the cost of a layer of a model. If the layer was modified by a previous step of a plan,
+    its config is taken from configs, a dictionary that maps the name of a layer to its config, and its cost is
+    estimated from it.
+    """
+    if configs is not None and layer.name in configs:
+        layer_config = configs[layer.name]
+        return layer_config, layer_cost(layer_config)
+    return get_layer_config(layer), current_layer_cost(layer)
+
+
+def dry_run(model, plan):
+    """
+    Estimates the cost of a model after applying a compression plan without creating any layer or reading any
+    weight.
+    :param model: Keras model.
+    :param plan: list of (layer_name, compressor, params), where compressor is a ModelCompression class or its
+    name and params are the arguments that would be passed to compress_layer. A layer can only appear once.
+    Compressors that modify other layers (e.g. FilterPruning) store their new configs, so later steps are
+    estimated on the modified layers.
+    :return: dictionary with the cost of the model before and after the plan and the cost of every step.
+    """
+    import CompressionLibrary.CompressionTechniques as CompressionTechniques
+
+    logger = logging.getLogger(__name__)
+    before = add_costs(*[current_layer_cost(layer) for layer in model.layers])
+
+    after = dict(before)
+    steps = []
+    compressed_layers = set()
+    configs = {}
+    for layer_name, compressor, params in plan:
+        if layer_name in compressed_layers:
+            raise ValueError(f'Layer {layer_name} appears more than once in the plan.')
+        compressed_layers.add(layer_name)
+        if isinstance(compressor, str):
+            compressor = getattr(CompressionTechniques, compressor)
+
+        step_before, step_after = compressor.estimate_in_model(model, layer_name, params, configs)
+        for key in after:
+            after[key] += step_after[key] - step_before[key]
+        logger.debug(f'{compressor.__name__} on {layer_name} changes {step_before} to {step_after}.')
+        steps.append({'layer_name': layer_name, 'compressor': compressor.__name__, 'before': step_before, 'after': step_after})
+
+    return {'before': before, 'after': after, 'steps': steps}
@@ -2,28 +2,41 @@ import tensorflow as tf
 import logging
 import numpy as np
 from CompressionLibrary import utils
+from CompressionLibrary import custom_layers
 import pandas as pd
 import os
 
 class AddSparseConnectionsCallback(tf.keras.callbacks.Callback):
 
-    def __init__(self, layer_name, target_perc=0.75, conn_perc_per_epoch=0.1):
+    def __init__(self, layer_name, target_perc=0.75, conn_perc_per_epoch=0.1, groups=None):
+        """
+        :param groups: if given, the connections are added in blocks of (channels/groups, filters/groups), see
+        custom_layers.block_connections.
+        """
         super(AddSparseConnectionsCallback, self).__init__()
         self.target_perc = target_perc
         self.conn_perc_per_epoch = conn_perc_per_epoch
         self.layer_name = layer_name
+        self.groups = groups
         self.logger = logging.getLogger(__name__)
        
     def on_epoch_end(self, epoch, logs=None):
         self.logger.debug(f'Updating sparse connections of layer {self.layer_name}.')
         names = [layer.name for layer in self.model.layers]
         layer_idx = names.index(self.layer_name)
-        connections = np.asarray(self.model.layers[layer_idx].get_connections())
+        layer = self.model.layers[layer_idx]
+        connections = np.asarray(layer.get_connections())
+        if self.groups is not None:
+            channels, filters = layer.connections.shape
+            connections = custom_layers.connection_blocks(connections, channels, filters, self.groups).ravel()
         total_connections = connections.shape[0]
         num_connections = np.sum(connections)
         perc_connections = num_connections / total_connections
         if perc_connections < self.target_perc:
             select_n = int(total_connections * self.conn_perc_per_epoch)
+            if self.groups is not None:
+                # There are few blocks, so at least one is added per epoch.
+                select_n = max(1, select_n)
             remaining_to_goal = int(total_connections * (self.target_perc - perc_connections))
             smallest = min(select_n, remaining_to_goal)
             missing_connections = np.argwhere(connections==0).flatten()
@@ -32,17 +45,25 @@ class AddSparseConnectionsCallback(tf.keras.callbacks.Callback):
               replace=False)
             connections[new_connections] = 1
             self.logger.debug(f'Number of activated connections {np.sum(connections)} of {connections.shape[0]}.')
-            self.model.layers[layer_idx].set_connections(connections.tolist())
+            if self.groups is not None:
+                connections = custom_layers.block_connections(np.reshape(connections, [self.groups, self.groups]), channels, filters)
+            layer.set_connections(connections.tolist())
 
 class RestoreBestWeights(tf.keras.callbacks.Callback):
 
-    def __init__(self, acc_before, weights_before, reward_func, verbose=0):
+    def __init__(self, acc_before, weights_before, reward_func, verbose=0, bytes_before=None, flops_before=None, latency_before=None):
         """
-        
+        :param bytes_before: bytes of the weights of the original model. If given, the bytes of the model are
+        also passed to the reward function.
+        :param flops_before: FLOPs of the original model. If given, the FLOPs of the model are also passed.
+        :param latency_before: CPU latency of the original model. If given, the latency of the model is also passed.
         """
         self.verbose = verbose
         self.weights_after = None
         self.weights_before = weights_before
+        self.bytes_before = bytes_before
+        self.flops_before = flops_before
+        self.latency_before = latency_before
         self.reward_func = reward_func
         self.acc_before = acc_before
         self.best_weights = None
@@ -53,6 +74,15 @@ class RestoreBestWeights(tf.keras.callbacks.Callback):
                       'weights_after':None, 
                       'accuracy_before':self.acc_before,
                       'accuracy_after': None}
+        if self.bytes_before is not None:
+            self.stats['bytes_before'] = self.bytes_before
+            self.stats['bytes_after'] = None
+        if self.flops_before is not None:
+            self.stats['flops_before'] = self.flops_before
+            self.stats['flops_after'] = None
+        if self.latency_before is not None:
+            self.stats['latency_before'] = self.latency_before
+            self.stats['latency_after'] = None
         
         self.save_name = './data/stats/fine_tuning_val_acc_stats.csv'
         
@@ -65,6 +95,13 @@ class RestoreBestWeights(tf.keras.callbacks.Callback):
         weights_after = utils.calculate_model_weights(self.model)
         self.stats['weights_after'] = weights_after
         self.stats['accuracy_after'] = self.stats['accuracy_before']
+        if self.bytes_before is not None:
+            self.stats['bytes_after'] = utils.calculate_model_bytes(self.model)
+        # The architecture does not change while fine-tuning, so the FLOPs and latency are only calculated once.
+        if self.flops_before is not None:
+            self.stats['flops_after'] = utils.calculate_model_flops(self.model)
+        if self.latency_before is not None:
+            self.stats['latency_after'] = utils.calculate_model_latency(self.model)
         self.best_reward = self.reward_func(self.stats)
         self.best_epoch = 0
             
@@ -122,6 +159,8 @@ class RestoreBestWeights(tf.keras.callbacks.Callback):
 
         self.stats['weights_after'] = weights_after
         self.stats['accuracy_after'] = acc_after
+        if self.bytes_before is not None:
+            self.stats['bytes_after'] = utils.calculate_model_bytes(self.model)
         reward = self.reward_func(self.stats)        
 
         return acc_after, reward, weights_after
@@ -9,6 +9,9 @@ class SparseWeights(tf.keras.constraints.Constraint):
         super(SparseWeights, self).__init__()
         self.min_value = min_value
 
+    def get_config(self):
+        return {'min_value': self.min_value}
+
     def __call__(self, weights):
         below_threshold = tf.abs(weights) < self.min_value
         new_weights = tf.where(below_threshold, 0.0, weights)
@@ -25,6 +28,9 @@ class kNonZeroes(tf.keras.constraints.Constraint):
         # Added flatten layer as a workaround for reshape not working in graph mode.
         self.flatten= tf.keras.layers.Flatten()
 
+    def get_config(self):
+        return {'k': self.k}
+
     def __call__(self, weights):
         
         # (inputs,units) to (units,inputs)
@@ -1,4 +1,6 @@
+import base64
 import tensorflow as tf
+import numpy as np
 from CompressionLibrary.custom_constraints import kNonZeroes, SparseWeights
 from CompressionLibrary.regularizers import L1L2SRegularizer
 
@@ -23,7 +25,8 @@ class DenseSVD(tf.keras.layers.Layer):
 
     def get_config(self):
         config = super(DenseSVD, self).get_config().copy()
-        config.update({'hidden_units': self.hidden_units, 'units':self.units})
+        config.update({'hidden_units': self.hidden_units, 'units':self.units,
+          'activation': tf.keras.activations.serialize(self.activation)})
         return config
 
     def call(self, inputs):
@@ -31,6 +34,78 @@ class DenseSVD(tf.keras.layers.Layer):
         x = tf.matmul(x, self.n)
         return self.activation(x+self.bias0)
 
+@tf.keras.utils.register_keras_serializable()
+class SparseDense(tf.keras.layers.Layer):
+    """
+    Dense layer that only stores the non-zero weights of its kernel in COO format. The indices are stored as
+    (unit, feature) pairs sorted by unit, which is the transposed kernel, so the product can be computed with
+    a sparse matmul. The gather kernel multiplies the gathered inputs by the values and sums them per unit.
+    As the indices are not trainable, the weights are ordered as values, bias and indices (values and indices
+    without bias).
+    """
+
+    def __init__(self, units, nnz, activation='relu', kernel_mode='sparse_matmul', use_bias=True, **kwargs):
+        (super(SparseDense, self).__init__)(**kwargs)
+        assert kernel_mode in ['sparse_matmul', 'gather']
+        self.units = units
+        self.nnz = nnz
+        self.use_bias = use_bias
+        self.kernel_mode = kernel_mode
+        self.activation = tf.keras.activations.get(activation)
+
+    def build(self, input_shape):
+        _, features = input_shape
+        self.features = features
+        zeros_init = tf.zeros_initializer()
+        self.indices = tf.Variable(name='indices', initial_value=zeros_init(shape=[self.nnz, 2], dtype='int32'),
+          trainable=False)
+        self.values = tf.Variable(name='values', initial_value=zeros_init(shape=[self.nnz], dtype='float32'),
+          trainable=True)
+        self.bias0 = None
+        if self.use_bias:
+            self.bias0 = tf.Variable(name='bias0', initial_value=zeros_init(shape=[self.units], dtype='float32'),
+              trainable=True)
+
+    def get_config(self):
+        config = super(SparseDense, self).get_config().copy()
+        config.update({'units': self.units, 'nnz': self.nnz, 'kernel_mode': self.kernel_mode, 'use_bias': self.use_bias,
+          'activation': tf.keras.activations.serialize(self.activation)})
+        return config
+
+    @staticmethod
+    def from_kernel(kernel):
+        """
+        Converts a dense kernel of shape (features, units) into the indices and values used by the layer.
+        """
+        units_idx, features_idx = np.nonzero(np.transpose(kernel))
+        indices = np.stack([units_idx, features_idx], axis=-1).astype(np.int32)
+        values = kernel[features_idx, units_idx].astype(np.float32)
+        return indices, values
+
+    def to_kernel(self):
+        """
+        Returns the dense kernel of shape (features, units).
+        """
+        indices, values = self.indices.numpy(), self.values.numpy()
+        kernel = np.zeros(shape=(self.features, self.units), dtype=np.float32)
+        kernel[indices[:, 1], indices[:, 0]] = values
+        return kernel
+
+    def density(self):
+        return self.nnz / (self.features * self.units)
+
+    def call(self, inputs):
+        if self.kernel_mode == 'sparse_matmul':
+            kernel_t = tf.SparseTensor(tf.cast(self.indices, tf.int64), self.values, dense_shape=[self.units, self.features])
+            x = tf.sparse.sparse_dense_matmul(kernel_t, inputs, adjoint_b=True)
+        else:
+            x = tf.gather(inputs, self.indices[:, 1], axis=1) * self.values
+            x = tf.math.unsorted_segment_sum(tf.transpose(x), self.indices[:, 0], num_segments=self.units)
+        x = tf.transpose(x)
+        if self.use_bias:
+            x = x + self.bias0
+        return self.activation(x)
+
 @tf.keras.utils.register_keras_serializable()
 class SparseSVD(tf.keras.layers.Layer):
 
@@ -55,7 +130,8 @@ class SparseSVD(tf.keras.layers.Layer):
 
     def get_config(self):
         config = super(SparseSVD, self).get_config().copy()
-        config.update({'units':self.units, 'basis_vectors': self.basis_vectors, 'k_basis_vectors': self.k_basis_vectors})
+        config.update({'units':self.units, 'basis_vectors': self.basis_vectors, 'k_basis_vectors': self.k_basis_vectors,
+          'activation': tf.keras.activations.serialize(self.activation)})
         return config
 
     def call(self, inputs):
@@ -65,6 +141,11 @@ class SparseSVD(tf.keras.layers.Layer):
 
 @tf.keras.utils.register_keras_serializable()
 class ConvSVD(tf.keras.layers.Layer):
+    """
+    Spatially separable convolution. A kx1 convolution with hidden_filters filters is followed by a 1xk
+    convolution with filters filters. The vertical stride is applied by the first one and the horizontal
+    stride by the second one, so the output has the shape of the output of the kxk convolution.
+    """
 
     def __init__(self, hidden_filters, filters, kernel_size, strides, padding='valid', activation='relu', **kwargs):
         (super(ConvSVD, self).__init__)(**kwargs)
@@ -72,12 +153,12 @@ class ConvSVD(tf.keras.layers.Layer):
         self.filters = filters
         self.padding = padding.upper()
         if isinstance(strides, int):
-            self.strides = list(strides, strides)
+            self.strides = (strides, strides)
         else:
             if isinstance(strides, tuple) or isinstance(strides, list):
                 self.strides = strides
         if isinstance(kernel_size, int):
-            kernel_size = list(kernel_size, kernel_size)
+            kernel_size = (kernel_size, kernel_size)
  
         self.kernel_size = kernel_size
         self.activation = tf.keras.activations.get(activation)
@@ -86,8 +167,8 @@ class ConvSVD(tf.keras.layers.Layer):
         _,_, _, channels = input_shape
         w_init = tf.random_normal_initializer()
         zeros_init = tf.zeros_initializer()
-        self.kernel0 =  tf.Variable(name='basis', initial_value=w_init(shape=[self.kernel_size[0], self.kernel_size[0],channels, self.hidden_filters]), dtype='float32', trainable=True)
-        self.kernel1 =  tf.Variable(name='basis', initial_value=w_init(shape=[self.kernel_size[0], self.kernel_size[0],self.hidden_filters, self.filters]), dtype='float32', trainable=True)
+        self.kernel0 =  tf.Variable(name='vertical_kernel', initial_value=w_init(shape=[self.kernel_size[0], 1, channels, self.hidden_filters]), dtype='float32', trainable=True)
+        self.kernel1 =  tf.Variable(name='horizontal_kernel', initial_value=w_init(shape=[1, self.kernel_size[1], self.hidden_filters, self.filters]), dtype='float32', trainable=True)
 
         self.bias = tf.Variable(name='bias', initial_value=zeros_init(shape=self.filters ,dtype='float32'),
           trainable=True)
@@ -95,20 +176,30 @@ class ConvSVD(tf.keras.layers.Layer):
     def get_config(self):
         config = super(ConvSVD, self).get_config().copy()
         config.update({'hidden_filters': self.hidden_filters, 'filters': self.filters, 'kernel_size':self.kernel_size, 'strides':self.strides, 'padding':self.padding,
-        'activation':self.activation})
+        'activation': tf.keras.activations.serialize(self.activation)})
         return config
 
     def call(self, inputs):
-        x = tf.nn.conv2d(input=inputs, filters=self.kernel0, strides=1, padding='SAME')
-        x = tf.nn.conv2d(input=x, filters=self.kernel1, strides=self.strides, padding=self.padding)
+        x = tf.nn.conv2d(input=inputs, filters=self.kernel0, strides=(self.strides[0], 1), padding=self.padding)
+        x = tf.nn.conv2d(input=x, filters=self.kernel1, strides=(1, self.strides[1]), padding=self.padding)
         x = tf.nn.bias_add(x, self.bias)
         return self.activation(x)
 
 @tf.keras.utils.register_keras_serializable()
 class FireLayer(tf.keras.layers.Layer):
-
-    def __init__(self, squeeze_filters, filters, kernel_size=(3,3), strides=1, activation='relu', padding='same',**kwargs):
+    """
+    Fire module of SqueezeNet. A 1x1 convolution squeezes the channels to squeeze_filters and the first half of
+    the filters is a 1x1 expansion of them and the second half a kxk expansion, both with the strides of the
+    layer. The 1x1 expansion takes the centre of every kxk window. The separate kernel convolves the slice of
+    the squeezed inputs with those centres, computed when the layer is built. The fused kernel pads the 1x1
+    kernel to kxk and computes both halves with a single convolution, which is faster for small layers but
+    multiplies the zeroes of the padded kernel.
+    """
+
+    def __init__(self, squeeze_filters, filters, kernel_size=(3,3), strides=1, activation='relu', padding='same', kernel_mode='separate', **kwargs):
         (super(FireLayer, self).__init__)(**kwargs)
+        assert kernel_mode in ['separate', 'fused']
+        self.kernel_mode = kernel_mode
         self.filters = filters 
         self.squeeze_filters = squeeze_filters
         if isinstance(strides, int):
@@ -123,36 +214,88 @@ class FireLayer(tf.keras.layers.Layer):
         self.activation = tf.keras.activations.get(activation)
 
     def build(self, input_shape):
-        _, _, _, channels = input_shape
+        _, height, width, channels = input_shape
         w_init = tf.random_normal_initializer()
         zeros_init = tf.zeros_initializer()
 
         self.kernel_squeeze = tf.Variable(name='kernel_squeeze', initial_value=w_init(shape=(1,1, channels, self.squeeze_filters) , dtype='float32'))
-        self.kernel_expand1x1 = tf.Variable(name='kernel_squeeze', initial_value=w_init(shape=(1,1, self.squeeze_filters, self.filters//2) , dtype='float32'))
-        self.kernel_expand3x3 = tf.Variable(name='kernel_squeeze', initial_value=w_init(shape=(self.kernel_size[0],self.kernel_size[1], self.squeeze_filters, self.filters//2) , dtype='float32'))
+        self.kernel_expand1x1 = tf.Variable(name='kernel_expand1x1', initial_value=w_init(shape=(1,1, self.squeeze_filters, self.filters//2) , dtype='float32'))
+        self.kernel_expand3x3 = tf.Variable(name='kernel_expand3x3', initial_value=w_init(shape=(self.kernel_size[0],self.kernel_size[1], self.squeeze_filters, self.filters//2) , dtype='float32'))
         self.bias = tf.Variable(name='bias', initial_value=zeros_init(shape=self.filters ,dtype='float32'), trainable=True)
+        # Padding that places the 1x1 kernel in the centre of a kxk kernel.
+        centre_h, centre_w = (self.kernel_size[0] - 1) // 2, (self.kernel_size[1] - 1) // 2
+        self.expand1x1_paddings = [[centre_h, self.kernel_size[0] - 1 - centre_h], [centre_w, self.kernel_size[1] - 1 - centre_w], [0, 0], [0, 0]]
+        # Rows and columns of the squeezed inputs with the centres of the kxk windows. SAME padding pads
+        # (output - 1) * stride + k - size pixels, half of them (rounded down) before the first pixel.
+        self.expand1x1_slices = None
+        if height is not None and width is not None:
+            self.expand1x1_slices = []
+            for size, k, stride, centre in zip([height, width], self.kernel_size, self.strides, [centre_h, centre_w]):
+                if self.padding == 'SAME':
+                    output_size = -(-size // stride)
+                    start = centre - max((output_size - 1) * stride + k - size, 0) // 2
+                else:
+                    output_size = -(-(size - k + 1) // stride)
+                    start = centre
+                self.expand1x1_slices.append(slice(start, start + (output_size - 1) * stride + 1))
 
     def get_config(self):
         config = super(FireLayer, self).get_config().copy()
-        config.update({'squeeze_filters': self.squeeze_filters, 'kernel_size': self.kernel_size, 'strides': self.strides, 'activation':self.activation, 'padding': self.padding, 'filters': self.filters})
+        config.update({'squeeze_filters': self.squeeze_filters, 'kernel_size': self.kernel_size, 'strides': self.strides, 'activation': tf.keras.activations.serialize(self.activation), 'padding': self.padding, 'filters': self.filters,
+                       'kernel_mode': self.kernel_mode})
         return config
 
+    def squeeze(self, inputs, kernel_squeeze):
+        # The strides are applied by the expansion.
+        return tf.nn.conv2d(input=inputs, filters=kernel_squeeze, strides=1, padding='VALID')
+
+    def expand_kernel(self, kernel_expand1x1, kernel_expand3x3):
+        """
+        Returns the kxk kernel of both expansions.
+        """
+        return tf.concat([tf.pad(kernel_expand1x1, self.expand1x1_paddings), kernel_expand3x3], axis=-1)
+
+    def expand1x1(self, squeezed, kernel_expand1x1):
+        """
+        Applies the 1x1 expansion to the centres of the kxk windows of the squeezed inputs.
+        """
+        if self.expand1x1_slices is None:
+            return tf.nn.conv2d(input=squeezed, filters=tf.pad(kernel_expand1x1, self.expand1x1_paddings), strides=self.strides, padding=self.padding)
+        rows, columns = self.expand1x1_slices
+        return tf.nn.conv2d(input=squeezed[:, rows, columns], filters=kernel_expand1x1, strides=self.strides, padding='VALID')
+
+    def preactivation(self, inputs, kernel_squeeze, kernel_expand1x1, kernel_expand3x3, bias):
+        """
+        Returns the output of the layer before the activation using the given weights.
+        """
+        x = self.squeeze(inputs, kernel_squeeze)
+        if self.kernel_mode == 'fused':
+            x = tf.nn.conv2d(input=x, filters=self.expand_kernel(kernel_expand1x1, kernel_expand3x3), strides=self.strides, padding=self.padding)
+        else:
+            o3x3 = tf.nn.conv2d(input=x, filters=kernel_expand3x3, strides=self.strides, padding=self.padding)
+            x = tf.concat([self.expand1x1(x, kernel_expand1x1), o3x3], axis=3)
+        return tf.nn.bias_add(x, bias)
+
     def call(self, inputs):
-        x = tf.nn.conv2d(input=inputs, filters=self.kernel_squeeze, strides=self.strides, padding='SAME')
-        o1x1 = tf.nn.conv2d(input=x, filters=self.kernel_expand1x1, strides=self.strides, padding='VALID')
-        o3x3 = tf.nn.conv2d(input=x, filters=self.kernel_expand3x3, strides=self.strides, padding=self.padding)
-        if o1x1.shape != o3x3.shape:
-            o1x1 = tf.keras.layers.Cropping2D(cropping=2)(o1x1)
-        x = tf.keras.layers.concatenate([o1x1, o3x3], axis=3)
-        x = tf.nn.bias_add(x, self.bias)
+        x = self.preactivation(inputs, self.kernel_squeeze, self.kernel_expand1x1, self.kernel_expand3x3, self.bias)
         return self.activation(x)
 
 @tf.keras.utils.register_keras_serializable()
 class MLPConv(tf.keras.layers.Layer):
-
-    def __init__(self, filters, hidden_units, kernel_size, strides=1, padding='VALID', activation='relu', *args, **kwargs):
+    """
+    Convolution whose kernel, reshaped to (kernel_height * kernel_width * channels, filters), is the product of
+    two matrices of rank hidden_units. The conv kernel runs it as a kxk convolution to hidden_units channels
+    followed by a 1x1 convolution. The patches kernel extracts the patches of the input and multiplies them by
+    both matrices, which creates a tensor kernel_height * kernel_width times larger than the input.
+    """
+
+    def __init__(self, filters, hidden_units, kernel_size, strides=1, padding='VALID', activation='relu', kernel_mode='conv', *args, **kwargs):
         (super(MLPConv, self).__init__)(*args, **kwargs)
-        self.kernel_size = kernel_size
+        assert kernel_mode in ['conv', 'patches']
+        if isinstance(kernel_size, int):
+            kernel_size = (kernel_size, kernel_size)
+        self.kernel_size = tuple(kernel_size)
+        self.kernel_mode = kernel_mode
         self.hidden_units = hidden_units
         self.filters = filters
         if isinstance(strides, int):
@@ -167,11 +310,13 @@ class MLPConv(tf.keras.layers.Layer):
     def get_config(self):
         config = super().get_config().copy()
         config.update({'filters':self.filters, 'hidden_units':self.hidden_units,
-        'kernel_size':self.kernel_size, 'strides': self.strides, 'padding': self.padding, 'activation': self.activation})
+        'kernel_size':self.kernel_size, 'strides': self.strides, 'padding': self.padding, 'activation': tf.keras.activations.serialize(self.activation),
+        'kernel_mode': self.kernel_mode})
         return config
 
     def build(self, input_shape):
         _, _, _, channels = input_shape
+        self.channels = channels
         w_init = tf.random_normal_initializer()
         b_init = tf.zeros_initializer()
         self.w_0 = tf.Variable(name='kernel0', initial_value=w_init(shape=(tf.reduce_prod(self.kernel_size) * channels, self.hidden_units), dtype='float32'),
@@ -185,24 +330,122 @@ class MLPConv(tf.keras.layers.Layer):
     def call(self, inputs):
         fh, fw = self.kernel_size
         stride_v, stride_h = self.strides
-        patches = tf.image.extract_patches(images=inputs, sizes=[
-         1, fh, fw, 1],
-          strides=[
-         1, stride_v, stride_h, 1],
-          rates=[
-         1, 1, 1, 1],
-          padding=self.padding)
-        output = tf.matmul(patches, self.w_0)
+        if self.kernel_mode == 'conv':
+            # The patches are flattened as (height, width, channels), so w_0 is the kernel of the kxk convolution.
+            kernel = tf.reshape(self.w_0, [fh, fw, self.channels, self.hidden_units])
+            output = tf.nn.conv2d(inputs, kernel, strides=[1, stride_v, stride_h, 1], padding=self.padding)
+        else:
+            patches = tf.image.extract_patches(images=inputs, sizes=[
+             1, fh, fw, 1],
+              strides=[
+             1, stride_v, stride_h, 1],
+              rates=[
+             1, 1, 1, 1],
+              padding=self.padding)
+            output = tf.matmul(patches, self.w_0)
         output = tf.matmul(output, self.w_1)
         output = tf.nn.bias_add(output, self.bias)
         return self.activation(output)
 
+def pack_connections(connections):
+    """
+    Encodes a list of 0/1 connections as a JSON serializable dictionary with the connections packed in bits.
+    """
+    connections = np.asarray(connections, dtype=np.uint8).ravel()
+    return {'size': int(connections.size), 'bits': base64.b64encode(np.packbits(connections).tobytes()).decode('ascii')}
+
+def unpack_connections(packed):
+    """
+    Inverse of pack_connections.
+    """
+    bits = np.frombuffer(base64.b64decode(packed['bits']), dtype=np.uint8)
+    return np.unpackbits(bits, count=packed['size']).astype(int).tolist()
+
+def connection_groups(connections):
+    """
+    Splits a (channels, filters) mask of connections into independent groups, the connected components of the
+    bipartite graph of the connections. Channels and filters without connections are not in any group.
+    :return: list of (channels, filters) index arrays of every group.
+    """
+    connections = np.asarray(connections) != 0
+    channel_group = np.full(connections.shape[0], -1)
+    groups = []
+    for start in np.flatnonzero(connections.any(axis=1)):
+        if channel_group[start] >= 0:
+            continue
+        channels = np.zeros(connections.shape[0], dtype=bool)
+        channels[start] = True
+        # Alternates between the filters of the channels and the channels of the filters until no new one is found.
+        while True:
+            filters = connections[channels].any(axis=0)
+            new_channels = connections[:, filters].any(axis=1)
+            if np.array_equal(new_channels, channels):
+                break
+            channels = new_channels
+        channel_group[channels] = len(groups)
+        groups.append((np.flatnonzero(channels), np.flatnonzero(filters)))
+    return groups
+
+def block_connections(block_mask, channels, filters):
+    """
+    Expands a (groups, groups) mask of blocks of channels and filters to the list of connections of a
+    SparseConnectionsConv2D layer. Block (i, j) connects the i-th group of channels to the j-th group of filters.
+    """
+    groups = block_mask.shape[0]
+    block = np.ones((channels // groups, filters // groups), dtype=np.uint8)
+    return np.kron(np.asarray(block_mask, dtype=np.uint8), block).ravel()
+
+def connection_blocks(connections, channels, filters, groups):
+    """
+    Inverse of block_connections.
+    :return: (groups, groups) mask of blocks or None if the connections are not the same in every block.
+    """
+    if channels % groups != 0 or filters % groups != 0:
+        return None
+    connections = (np.asarray(connections) != 0).astype(np.uint8)
+    block_mask = np.reshape(connections, [groups, channels // groups, groups, filters // groups]).max(axis=(1, 3))
+    if not np.array_equal(block_connections(block_mask, channels, filters), connections.ravel()):
+        return None
+    return block_mask
+
+def contiguous_group_ranges(groups):
+    """
+    Returns the (first channel, last channel + 1, first filter, last filter + 1) ranges of the groups returned by
+    connection_groups sorted by filter, or None if the ranges of two groups overlap, in which case the groups
+    cannot be convolved separately by slicing the input.
+    """
+    if not groups:
+        return None
+    ranges = sorted((group_channels[0], group_channels[-1] + 1, group_filters[0], group_filters[-1] + 1)
+                    for group_channels, group_filters in groups)
+    for axis in [0, 2]:
+        ranges = sorted(ranges, key=lambda r: r[axis])
+        if any(next_range[axis] < previous_range[axis + 1] for previous_range, next_range in zip(ranges, ranges[1:])):
+            return None
+    return [tuple(int(value) for value in group_range) for group_range in ranges]
+
 @tf.keras.utils.register_keras_serializable()
 class SparseConnectionsConv2D(tf.keras.layers.Conv2D):
+    """
+    Conv2D layer in which only some (input channel, filter) pairs are connected. The connections are stored in a
+    non-trainable (channels, filters) mask, so they can be changed with set_connections while training without
+    tracing the layer again. After training, freeze caches the masked kernel for inference and, if the connections
+    split into independent groups of contiguous channels and filters that need fewer FLOPs than the dense kernel,
+    only convolves the channels of every group with its filters.
+
+    The mask is one of the weights of the layer, so get_weights and set_weights also save and restore the
+    connections. In particular, RestoreBestWeights restores the connections of the best epoch together with the
+    kernel, discarding the connections that AddSparseConnectionsCallback added after it. set_weights does not
+    discard the cached inference kernel, so a frozen layer must be frozen again after its weights are set.
+    """
 
     def __init__(self, sparse_connections, *args, **kwargs):
         (super(SparseConnectionsConv2D, self).__init__)(*args, **kwargs)
+        if isinstance(sparse_connections, dict):
+            sparse_connections = unpack_connections(sparse_connections)
         self.sparse_connections = sparse_connections
+        self.inference_groups = None
+        self.inference_kernel = None
 
     def convolution_op(self, inputs, kernel):
         """
@@ -225,7 +468,8 @@ class SparseConnectionsConv2D(tf.keras.layers.Conv2D):
 
     def get_config(self):
         config = super(SparseConnectionsConv2D, self).get_config().copy()
-        config.update({'sparse_connections': self.sparse_connections})
+        # The connections are stored as a bit mask instead of a list with an int per (channel, filter).
+        config.update({'sparse_connections': pack_connections(self.get_connections())})
         return config
     
     def build(self, input_shape):
@@ -238,37 +482,104 @@ class SparseConnectionsConv2D(tf.keras.layers.Conv2D):
         self.bias = tf.Variable(
             name='bias', initial_value=zeroes_init(shape=(self.filters),dtype='float32'),
             trainable=True)
-
-
-        self.set_connections(self.sparse_connections)
+        self.connections = tf.Variable(
+            name='connections', initial_value=np.reshape(np.asarray(self.sparse_connections, dtype=np.float32), [channels, self.filters]),
+            trainable=False)
 
     def set_connections(self, connections):
         self.sparse_connections = connections
-        self.conn_tensor = tf.constant(self.sparse_connections, dtype='float32')
-        self.conn_tensor = tf.reshape((self.conn_tensor), shape=[self.sparse_kernel.shape[(-2)],self.filters])
-        self.conn_tensor = tf.repeat(tf.expand_dims(self.conn_tensor, axis=0), self.kernel_size[0], axis=0)
-        self.conn_tensor = tf.repeat(tf.expand_dims(self.conn_tensor, axis=0), self.kernel_size[1], axis=0)
+        if self.built:
+            self.connections.assign(np.reshape(np.asarray(connections, dtype=np.float32), self.connections.shape))
+        self.unfreeze()
 
     def get_connections(self):
+        if self.built:
+            return self.connections.numpy().astype(int).ravel().tolist()
         return self.sparse_connections
 
-    def call(self, inputs):
-        kernel = tf.math.multiply(self.conn_tensor, self.sparse_kernel)
-        out = self.convolution_op(inputs, kernel)
+    def get_kernel(self):
+        return self.sparse_kernel * self.connections
+
+    def freeze(self, max_flops_fraction=0.75):
+        """
+        Caches the masked kernel used for inference. If the connections split into groups whose channels and
+        filters are contiguous ranges that do not overlap, and convolving every range of channels with its range of
+        filters needs at most max_flops_fraction of the FLOPs of the dense kernel, the groups are convolved
+        separately. Functions that already traced the layer (e.g. the predict function of a model) must be traced
+        again.
+        :return: fraction of the FLOPs of the dense kernel used for inference.
+        """
+        kernel = self.get_kernel().numpy()
+        self.inference_kernel = tf.constant(kernel)
+        self.inference_groups = None
+        channels, filters = self.connections.shape
+        ranges = contiguous_group_ranges(connection_groups(self.connections.numpy()))
+        if ranges is None:
+            return 1.0
+        flops_fraction = sum((c_end - c_start) * (f_end - f_start) for c_start, c_end, f_start, f_end in ranges) / (channels * filters)
+        if flops_fraction > max_flops_fraction:
+            return 1.0
+
+        # The outputs of the groups are concatenated in the order of their filters, with zeroes for the filters
+        # without connections.
+        self.inference_groups = []
+        last_filter = 0
+        for c_start, c_end, f_start, f_end in ranges:
+            if f_start > last_filter:
+                self.inference_groups.append(f_start - last_filter)
+            self.inference_groups.append((c_start, c_end, tf.constant(kernel[:, :, c_start:c_end, f_start:f_end])))
+            last_filter = f_end
+        if filters > last_filter:
+            self.inference_groups.append(filters - last_filter)
+        return flops_fraction
+
+    def unfreeze(self):
+        """
+        Discards the cached inference kernel, so the layer uses the current kernel and connections again.
+        """
+        self.inference_kernel = None
+        self.inference_groups = None
+
+    def grouped_convolution(self, inputs):
+        outputs = [self.convolution_op(inputs[..., group[0]:group[1]], group[2]) if isinstance(group, tuple) else group
+                   for group in self.inference_groups]
+        output_shape = tf.shape(next(output for output in outputs if not isinstance(output, int)))[:-1]
+        outputs = [tf.zeros(tf.concat([output_shape, [output]], axis=0)) if isinstance(output, int) else output for output in outputs]
+        return tf.concat(outputs, axis=-1)
+
+    def call(self, inputs, training=None):
+        if training or self.inference_kernel is None:
+            out = self.convolution_op(inputs, self.get_kernel())
+        elif self.inference_groups is not None:
+            out = self.grouped_convolution(inputs)
+        else:
+            out = self.convolution_op(inputs, self.inference_kernel)
         out = tf.nn.bias_add(out, self.bias)
         out = tf.nn.relu(out)
         return out
 
 @tf.keras.utils.register_keras_serializable()
 class SparseConvolution2D(tf.keras.layers.Layer):
-
-    def __init__(self, kernel_size, filters, bases, padding='valid', strides=1, activation=None, *args, **kwargs):
+    """
+    Sparse convolution of Liu et al. The input channels are mixed by P, every channel is convolved with its own
+    bases kernels Q and the responses are combined by the sparse tensor S. The convolution with Q is a depthwise
+    convolution with a channel multiplier of bases, whose output channel c * bases + q is the response of channel
+    c to basis q, so S reshaped to (channels * bases, filters) is the kernel of a 1x1 convolution. The sparse
+    kernel multiplies the responses by the non-zero values of S with a sparse matmul. Converting S to a sparse
+    tensor scans all its values, so it is only done by freeze, and the layer uses the dense product while
+    training or until it is frozen.
+    """
+
+    def __init__(self, kernel_size, filters, bases, padding='valid', strides=1, activation=None, kernel_mode='dense', *args, **kwargs):
         (super(SparseConvolution2D, self).__init__)(*args, **kwargs)
+        assert kernel_mode in ['dense', 'sparse']
         self.kernel_size = kernel_size
+        self.kernel_mode = kernel_mode
         self.filters = filters
         self.activation = tf.keras.activations.get(activation)
         self.bases = bases
         self.padding = padding.upper()
+        self.inference_kernel = None
         if isinstance(strides, int):
             self.strides = (strides, strides)
         else:
@@ -301,152 +612,726 @@ class SparseConvolution2D(tf.keras.layers.Layer):
         self.bias = tf.Variable(
             name='bias', initial_value=zeroes(shape=(self.filters),dtype='float32'),
             trainable=True)
+        # Marks the layer as built, so S is not added again when a deserialized model builds it.
+        super(SparseConvolution2D, self).build(input_shape)
 
     def get_config(self):
         config = super(SparseConvolution2D, self).get_config()
-        config.update({'filters':self.filters, 'bases':self.bases,'kernel_size':self.kernel_size, 'padding':self.padding, 'activation':self.activation, 'strides':self.strides})
+        config.update({'filters':self.filters, 'bases':self.bases,'kernel_size':self.kernel_size, 'padding':self.padding, 'activation': tf.keras.activations.serialize(self.activation), 'strides':self.strides,
+                       'kernel_mode': self.kernel_mode})
         return config
 
-    def call(self, inputs):
-        J = tf.matmul(inputs, self.P)
+    def freeze(self):
+        """
+        Caches the transposed 1x1 kernel as a sparse tensor used for inference by the sparse kernel. Functions that
+        already traced the layer must be traced again.
+        :return: fraction of the values of S that are not zero.
+        """
+        kernel = tf.reshape(self.S, [-1, self.filters])
+        if self.kernel_mode == 'sparse':
+            self.inference_kernel = tf.sparse.from_dense(tf.transpose(kernel))
+        return float(tf.math.count_nonzero(kernel)) / kernel.shape.num_elements()
 
-        # Move channels to the first dimension so that it be split first in the map.
-        J = tf.transpose(J, perm=[3,0,1,2])
-        # Add a new dimension so that channel is 1.
-        J = tf.expand_dims(J, axis=-1)
+    def unfreeze(self):
+        """
+        Discards the cached sparse kernel, so the layer uses the current value of S again.
+        """
+        self.inference_kernel = None
 
-        # Add a new dummy channel dimension of size 1 so that bases become number of filters.
-        filters = tf.expand_dims(self.Q, axis=-2)
+    def call(self, inputs, training=None):
+        channels = self.P.shape[0]
+        J = tf.matmul(inputs, self.P)
 
-        tau = tf.vectorized_map(lambda tensors: tf.nn.conv2d(input=tensors[0], filters=tensors[1], strides=self.strides, padding=self.padding) , elems=(J, filters))
+        # (channels, height, width, bases) to the depthwise kernel (height, width, channels, bases).
+        depthwise_kernel = tf.transpose(self.Q, perm=[1, 2, 0, 3])
+        tau = tf.nn.depthwise_conv2d(J, depthwise_kernel, strides=[1, self.strides[0], self.strides[1], 1], padding=self.padding)
 
-        # Batch is second as channel was swapped to the first dimension. channels(c), bases(q), batch(b), height(h), width(w), filters(f).
-        O = tf.einsum('cqf,cbhwq->bhwf', self.S, tau)
+        kernel = tf.reshape(self.S, [channels * self.bases, self.filters])
+        tau_shape = tf.shape(tau)
+        tau = tf.reshape(tau, [-1, channels * self.bases])
+        if not training and self.inference_kernel is not None:
+            O = tf.transpose(tf.sparse.sparse_dense_matmul(self.inference_kernel, tau, adjoint_b=True))
+        else:
+            O = tf.matmul(tau, kernel)
+        O = tf.reshape(O, tf.concat([tau_shape[:3], [self.filters]], axis=0))
         O = tf.nn.bias_add(O, self.bias)
         O = tf.nn.relu(O)
         return O 
     
+def quantize_per_channel(weights, num_bits=8):
+    """
+    Symmetric quantization of a kernel with one scale per output channel (last axis).
+    :return: integer kernel and the float scales such that weights ~ kernel * scales.
+    """
+    q_max = 2 ** (num_bits - 1) - 1
+    max_abs = np.max(np.abs(weights), axis=tuple(range(weights.ndim - 1)))
+    scales = np.where(max_abs > 0, max_abs / q_max, 1.0).astype(np.float32)
+    kernel = np.clip(np.round(weights / scales), -q_max, q_max).astype(np.int8)
+    return kernel, scales
+
+def fake_quantize_inputs(inputs, input_range):
+    """
+    Simulates the 8-bit quantization of the inputs using the range found during calibration.
+    """
+    if input_range is None:
+        return inputs
+    return tf.quantization.fake_quant_with_min_max_args(inputs, min=input_range[0], max=input_range[1], num_bits=8)
+
 @tf.keras.utils.register_keras_serializable()
-class ROIEmbedding(tf.keras.layers.Layer):
-    def __init__(self, n_bins, *args, **kwargs):
-        super(ROIEmbedding, self).__init__(*args, **kwargs)
-        self.n_bins = tf.constant(n_bins)
-        self.embedding_size = tf.math.reduce_sum(
-            tf.math.reduce_prod(n_bins, axis=1))
+class QuantizedDense(tf.keras.layers.Layer):
+    """
+    Dense layer that stores its kernel as int8 with a float scale per unit. The kernel is dequantized when
+    called and, if input_range is given, the inputs are fake quantized to 8 bits. As the int8 kernel is not
+    trainable, the weights are ordered as scales, bias and kernel.
+    """
+
+    def __init__(self, units, activation='relu', input_range=None, **kwargs):
+        (super(QuantizedDense, self).__init__)(**kwargs)
+        self.units = units
+        self.input_range = input_range
+        self.activation = tf.keras.activations.get(activation)
+
+    def build(self, input_shape):
+        _, features = input_shape
+        zeros_init = tf.zeros_initializer()
+        self.kernel_q = tf.Variable(name='kernel_q', initial_value=zeros_init(shape=[features, self.units], dtype='int8'),
+          trainable=False)
+        self.kernel_scale = tf.Variable(name='kernel_scale', initial_value=tf.ones(shape=[self.units], dtype='float32'),
+          trainable=True)
+        self.bias0 = tf.Variable(name='bias0', initial_value=zeros_init(shape=[self.units], dtype='float32'),
+          trainable=True)
+
+    def get_config(self):
+        config = super(QuantizedDense, self).get_config().copy()
+        config.update({'units': self.units, 'input_range': self.input_range,
+          'activation': tf.keras.activations.serialize(self.activation)})
+        return config
+
+    def call(self, inputs):
+        kernel = tf.cast(self.kernel_q, tf.float32) * self.kernel_scale
+        x = tf.matmul(fake_quantize_inputs(inputs, self.input_range), kernel)
+        return self.activation(x + self.bias0)
+
+@tf.keras.utils.register_keras_serializable()
+class QuantizedConv2D(tf.keras.layers.Layer):
+    """
+    Conv2D layer that stores its kernel as int8 with a float scale per filter.
+    """
+
+    def __init__(self, filters, kernel_size, strides=1, padding='valid', activation='relu', input_range=None, **kwargs):
+        (super(QuantizedConv2D, self).__init__)(**kwargs)
+        self.filters = filters
+        if isinstance(kernel_size, int):
+            kernel_size = (kernel_size, kernel_size)
+        self.kernel_size = kernel_size
+        if isinstance(strides, int):
+            strides = (strides, strides)
+        self.strides = strides
+        self.padding = padding.upper()
+        self.input_range = input_range
+        self.activation = tf.keras.activations.get(activation)
 
     def build(self, input_shape):
+        _, _, _, channels = input_shape
+        zeros_init = tf.zeros_initializer()
+        self.kernel_q = tf.Variable(name='kernel_q', initial_value=zeros_init(shape=[self.kernel_size[0], self.kernel_size[1], channels, self.filters], dtype='int8'),
+          trainable=False)
+        self.kernel_scale = tf.Variable(name='kernel_scale', initial_value=tf.ones(shape=[self.filters], dtype='float32'),
+          trainable=True)
+        self.bias = tf.Variable(name='bias', initial_value=zeros_init(shape=[self.filters], dtype='float32'),
+          trainable=True)
 
-        super().build(input_shape)
+    def get_config(self):
+        config = super(QuantizedConv2D, self).get_config().copy()
+        config.update({'filters': self.filters, 'kernel_size': self.kernel_size, 'strides': self.strides,
+          'padding': self.padding, 'input_range': self.input_range,
+          'activation': tf.keras.activations.serialize(self.activation)})
+        return config
 
-    @staticmethod
-    def _pool_roi(feature_map, pool_shape):
-        pooled_height = pool_shape[0]
-        pooled_width = pool_shape[1]
-        # Compute region of interest
-        region_height, region_width = tf.shape(
-            feature_map)[0], tf.shape(feature_map)[1]
+    def call(self, inputs):
+        kernel = tf.cast(self.kernel_q, tf.float32) * self.kernel_scale
+        x = tf.nn.conv2d(input=fake_quantize_inputs(inputs, self.input_range), filters=kernel, strides=self.strides, padding=self.padding)
+        x = tf.nn.bias_add(x, self.bias)
+        return self.activation(x)
 
-        # Divide the region into non-overlapping areas
-        h_step = tf.cast(region_height / pooled_height, tf.int32)
-        w_step = tf.cast(region_width / pooled_width, tf.int32)
+@tf.keras.utils.register_keras_serializable()
+class QuantizedDenseSVD(DenseSVD):
+    """
+    DenseSVD layer whose factors u and n are stored as int8 with a float scale per column.
+    """
 
-        areas = tf.TensorArray(tf.int32, size=pooled_height*pooled_width)
+    def __init__(self, units, hidden_units, activation='relu', input_range=None, **kwargs):
+        (super(QuantizedDenseSVD, self).__init__)(units, hidden_units, activation, **kwargs)
+        self.input_range = input_range
 
-        for i in tf.range(pooled_height):
-            for j in tf.range(pooled_width):
-                areas = areas.write(i*pooled_height+j, [i*h_step,
-                                                        j*w_step,
-                                                        (i+1)*h_step if i +
-                                                        1 < pooled_height else region_height,
-                                                        (j+1)*w_step if j+1 < pooled_width else region_width])
+    def build(self, input_shape):
+        _, features = input_shape
+        zeros_init = tf.zeros_initializer()
+        self.u_q = tf.Variable(name='u_q', initial_value=zeros_init(shape=[features, self.hidden_units], dtype='int8'),
+          trainable=False)
+        self.u_scale = tf.Variable(name='u_scale', initial_value=tf.ones(shape=[self.hidden_units], dtype='float32'),
+          trainable=True)
+        self.n_q = tf.Variable(name='n_q', initial_value=zeros_init(shape=[self.hidden_units, self.units], dtype='int8'),
+          trainable=False)
+        self.n_scale = tf.Variable(name='n_scale', initial_value=tf.ones(shape=[self.units], dtype='float32'),
+          trainable=True)
+        self.bias0 = tf.Variable(name='bias0', initial_value=zeros_init(shape=[self.units], dtype='float32'),
+          trainable=True)
 
-        areas = areas.stack()
+    @property
+    def u(self):
+        return tf.cast(self.u_q, tf.float32) * self.u_scale
 
-        def fn(x): return tf.math.reduce_max(
-            feature_map[x[0]:x[2], x[1]:x[3], :], axis=[0, 1])
+    @property
+    def n(self):
+        return tf.cast(self.n_q, tf.float32) * self.n_scale
 
-        pooled_features = tf.map_fn(fn, areas, fn_output_signature =tf.float32)
+    def get_config(self):
+        config = super(QuantizedDenseSVD, self).get_config().copy()
+        config.update({'input_range': self.input_range})
+        return config
 
-        return tf.reshape(pooled_features, shape=[-1])
+    def call(self, inputs):
+        return super(QuantizedDenseSVD, self).call(fake_quantize_inputs(inputs, self.input_range))
 
-    @staticmethod
-    def _pool_rois(feature_map, n_bins):
+@tf.keras.utils.register_keras_serializable()
+class QuantizedMLPConv(MLPConv):
+    """
+    MLPConv layer whose kernels w_0 and w_1 are stored as int8 with a float scale per column.
+    """
+
+    def __init__(self, filters, hidden_units, kernel_size, strides=1, padding='VALID', activation='relu', input_range=None, **kwargs):
+        (super(QuantizedMLPConv, self).__init__)(filters, hidden_units, kernel_size, strides, padding, activation, **kwargs)
+        self.input_range = input_range
+
+    def build(self, input_shape):
+        _, _, _, channels = input_shape
+        self.channels = channels
+        zeros_init = tf.zeros_initializer()
+        self.w_0_q = tf.Variable(name='kernel0_q', initial_value=zeros_init(shape=(self.kernel_size[0] * self.kernel_size[1] * channels, self.hidden_units), dtype='int8'),
+          trainable=False)
+        self.w_0_scale = tf.Variable(name='kernel0_scale', initial_value=tf.ones(shape=[self.hidden_units], dtype='float32'),
+          trainable=True)
+        self.w_1_q = tf.Variable(name='kernel1_q', initial_value=zeros_init(shape=(self.hidden_units, self.filters), dtype='int8'),
+          trainable=False)
+        self.w_1_scale = tf.Variable(name='kernel1_scale', initial_value=tf.ones(shape=[self.filters], dtype='float32'),
+          trainable=True)
+        self.bias = tf.Variable(name='bias', initial_value=zeros_init(shape=(self.filters,), dtype='float32'),
+          trainable=True)
+
+    @property
+    def w_0(self):
+        return tf.cast(self.w_0_q, tf.float32) * self.w_0_scale
+
+    @property
+    def w_1(self):
+        return tf.cast(self.w_1_q, tf.float32) * self.w_1_scale
+
+    def get_config(self):
+        config = super(QuantizedMLPConv, self).get_config().copy()
+        config.update({'input_range': self.input_range})
+        return config
+
+    def call(self, inputs):
+        return super(QuantizedMLPConv, self).call(fake_quantize_inputs(inputs, self.input_range))
+
+def cluster_index_dtype(num_clusters):
+    """
+    Smallest integer type that can index a codebook of num_clusters centroids.
+    """
+    return 'uint8' if num_clusters <= 256 else 'int32'
+
+def kmeans_1d(weights, num_clusters, iterations=20, keep_zero=False):
+    """
+    Clusters the values of a kernel with k-means. The centroids are initialized linearly between the minimum and
+    maximum value, which keeps the few large weights represented. As the values are scalars, the assignment is a
+    binary search on the midpoints between the sorted centroids.
+    :param weights: kernel of any shape.
+    :param num_clusters: number of centroids, including the zero centroid if keep_zero is True.
+    :param iterations: maximum number of k-means iterations.
+    :param keep_zero: if True, the zero weights (pruned) are assigned to a first centroid fixed to 0.
+    :return: centroids and an int array with the shape of the kernel with the index of the centroid of every weight.
+    """
+    values = weights.ravel().astype(np.float64)
+    if keep_zero:
+        assert num_clusters > 1, 'At least 2 clusters are needed to keep the zero centroid.'
+        cluster_values = values[values != 0.0]
+        k = num_clusters - 1
+    else:
+        cluster_values = values
+        k = num_clusters
+
+    if cluster_values.size == 0:
+        centroids = np.zeros(k)
+    else:
+        centroids = np.linspace(cluster_values.min(), cluster_values.max(), k)
+
+    for _ in range(iterations):
+        assignment = np.searchsorted((centroids[1:] + centroids[:-1]) / 2, cluster_values)
+        sums = np.bincount(assignment, weights=cluster_values, minlength=k)
+        counts = np.bincount(assignment, minlength=k)
+        # Empty clusters keep their centroid.
+        new_centroids = np.sort(np.where(counts > 0, sums / np.maximum(counts, 1), centroids))
+        if np.allclose(new_centroids, centroids):
+            break
+        centroids = new_centroids
+
+    indices = np.searchsorted((centroids[1:] + centroids[:-1]) / 2, values)
+    if keep_zero:
+        centroids = np.concatenate([[0.0], centroids])
+        indices = np.where(values == 0.0, 0, indices + 1)
+
+    return centroids.astype(np.float32), indices.reshape(weights.shape)
+
+@tf.keras.utils.register_keras_serializable()
+class ClusteredDense(tf.keras.layers.Layer):
+    """
+    Dense layer whose weights share num_clusters values. The kernel is stored as a codebook of centroids and the
+    index of the centroid of every weight. Only the centroids and the bias are trainable, so the gradients of all
+    the weights of a cluster are added to its centroid. If keep_zero is True, the first centroid is fixed to 0 so
+    that pruned weights stay pruned. As the indices are not trainable, the weights are ordered as centroids, bias
+    and indices.
+    """
+
+    def __init__(self, units, num_clusters, activation='relu', keep_zero=False, **kwargs):
+        (super(ClusteredDense, self).__init__)(**kwargs)
+        self.units = units
+        self.num_clusters = num_clusters
+        self.keep_zero = keep_zero
+        self.activation = tf.keras.activations.get(activation)
+
+    def build(self, input_shape):
+        _, features = input_shape
+        zeros_init = tf.zeros_initializer()
+        self.centroids = tf.Variable(name='centroids', initial_value=zeros_init(shape=[self.num_clusters], dtype='float32'),
+          trainable=True)
+        self.bias0 = tf.Variable(name='bias0', initial_value=zeros_init(shape=[self.units], dtype='float32'),
+          trainable=True)
+        self.kernel_indices = tf.Variable(name='kernel_indices', initial_value=zeros_init(shape=[features, self.units], dtype=cluster_index_dtype(self.num_clusters)),
+          trainable=False)
+
+    def get_config(self):
+        config = super(ClusteredDense, self).get_config().copy()
+        config.update({'units': self.units, 'num_clusters': self.num_clusters, 'keep_zero': self.keep_zero,
+          'activation': tf.keras.activations.serialize(self.activation)})
+        return config
+
+    def get_codebook(self):
+        if self.keep_zero:
+            return tf.concat([tf.zeros([1]), self.centroids[1:]], axis=0)
+        return self.centroids
+
+    def get_kernel(self):
+        return tf.gather(self.get_codebook(), tf.cast(self.kernel_indices, tf.int32))
+
+    def call(self, inputs):
+        x = tf.matmul(inputs, self.get_kernel())
+        return self.activation(x + self.bias0)
+
+@tf.keras.utils.register_keras_serializable()
+class ClusteredConv2D(tf.keras.layers.Layer):
+    """
+    Conv2D layer whose weights share num_clusters values. See ClusteredDense.
+    """
+
+    def __init__(self, filters, kernel_size, num_clusters, strides=1, padding='valid', activation='relu', keep_zero=False, **kwargs):
+        (super(ClusteredConv2D, self).__init__)(**kwargs)
+        self.filters = filters
+        if isinstance(kernel_size, int):
+            kernel_size = (kernel_size, kernel_size)
+        self.kernel_size = kernel_size
+        if isinstance(strides, int):
+            strides = (strides, strides)
+        self.strides = strides
+        self.padding = padding.upper()
+        self.num_clusters = num_clusters
+        self.keep_zero = keep_zero
+        self.activation = tf.keras.activations.get(activation)
+
+    def build(self, input_shape):
+        _, _, _, channels = input_shape
+        zeros_init = tf.zeros_initializer()
+        self.centroids = tf.Variable(name='centroids', initial_value=zeros_init(shape=[self.num_clusters], dtype='float32'),
+          trainable=True)
+        self.bias = tf.Variable(name='bias', initial_value=zeros_init(shape=[self.filters], dtype='float32'),
+          trainable=True)
+        self.kernel_indices = tf.Variable(name='kernel_indices', initial_value=zeros_init(shape=[self.kernel_size[0], self.kernel_size[1], channels, self.filters], dtype=cluster_index_dtype(self.num_clusters)),
+          trainable=False)
+
+    def get_config(self):
+        config = super(ClusteredConv2D, self).get_config().copy()
+        config.update({'filters': self.filters, 'kernel_size': self.kernel_size, 'strides': self.strides,
+          'padding': self.padding, 'num_clusters': self.num_clusters, 'keep_zero': self.keep_zero,
+          'activation': tf.keras.activations.serialize(self.activation)})
+        return config
+
+    def get_codebook(self):
+        if self.keep_zero:
+            return tf.concat([tf.zeros([1]), self.centroids[1:]], axis=0)
+        return self.centroids
+
+    def get_kernel(self):
+        return tf.gather(self.get_codebook(), tf.cast(self.kernel_indices, tf.int32))
+
+    def call(self, inputs):
+        x = tf.nn.conv2d(input=inputs, filters=self.get_kernel(), strides=self.strides, padding=self.padding)
+        x = tf.nn.bias_add(x, self.bias)
+        return self.activation(x)
+
+def hash_buckets(size, num_buckets, seed=0):
+    """
+    Hashes the positions of a flattened kernel of the given size. The hash is computed from the position and the
+    seed, so it does not need to be stored.
+    :return: bucket of every position and its sign (+1 or -1).
+    """
+    mask = tf.constant(0xFFFFFFFF, dtype=tf.int64)
+    h = tf.range(size, dtype=tf.int64) + tf.constant(seed, dtype=tf.int64) * 0x9E3779B9
+    h = tf.bitwise.bitwise_and(h * 0x85EBCA6B, mask)
+    h = tf.bitwise.bitwise_xor(h, tf.bitwise.right_shift(h, 13))
+    h = tf.bitwise.bitwise_and(h * 0xC2B2AE35, mask)
+    h = tf.bitwise.bitwise_xor(h, tf.bitwise.right_shift(h, 16))
+    buckets = tf.cast(tf.math.floormod(h, num_buckets), tf.int32)
+    signs = tf.cast(tf.bitwise.bitwise_and(tf.bitwise.right_shift(h, 31), 1), tf.float32) * 2.0 - 1.0
+    return buckets, signs
+
+def hashed_kernel_indices(kernel_shape, num_buckets, seed=0):
+    """
+    Returns the index of every position of a hashed kernel in the concatenation of its buckets and their negated
+    values, so the kernel is a single gather. The indices only depend on the shape and the seed.
+    """
+    buckets, signs = hash_buckets(int(np.prod(kernel_shape)), num_buckets, seed)
+    return tf.reshape(buckets + tf.cast(signs < 0, tf.int32) * num_buckets, kernel_shape)
+
+@tf.keras.utils.register_keras_serializable()
+class HashedDense(tf.keras.layers.Layer):
+    """
+    Dense layer whose virtual kernel shares num_buckets weights (HashedNets). Weight i of the kernel is
+    sign(i) * buckets[bucket(i)], where bucket and sign are hashes of its position, so only the buckets are
+    stored.
+    """
+
+    def __init__(self, units, num_buckets, seed=0, activation='relu', **kwargs):
+        (super(HashedDense, self).__init__)(**kwargs)
+        self.units = units
+        self.num_buckets = num_buckets
+        self.seed = seed
+        self.activation = tf.keras.activations.get(activation)
+
+    def build(self, input_shape):
+        self.kernel_shape = [input_shape[-1], self.units]
+        # The hashes are computed once, they are not weights as they are recomputed from the seed.
+        self.hashed_indices = hashed_kernel_indices(self.kernel_shape, self.num_buckets, self.seed)
+        w_init = tf.random_normal_initializer()
+        zeros_init = tf.zeros_initializer()
+        self.buckets = tf.Variable(name='buckets', initial_value=w_init(shape=[self.num_buckets], dtype='float32'),
+          trainable=True)
+        self.bias0 = tf.Variable(name='bias0', initial_value=zeros_init(shape=[self.units], dtype='float32'),
+          trainable=True)
+
+    def get_config(self):
+        config = super(HashedDense, self).get_config().copy()
+        config.update({'units': self.units, 'num_buckets': self.num_buckets, 'seed': self.seed,
+          'activation': tf.keras.activations.serialize(self.activation)})
+        return config
+
+    def get_kernel(self):
+        return tf.gather(tf.concat([self.buckets, -self.buckets], axis=0), self.hashed_indices)
+
+    def call(self, inputs):
+        x = tf.matmul(inputs, self.get_kernel())
+        return self.activation(x + self.bias0)
+
+@tf.keras.utils.register_keras_serializable()
+class HashedConv2D(tf.keras.layers.Layer):
+    """
+    Conv2D layer whose virtual kernel shares num_buckets weights. See HashedDense.
+    """
+
+    def __init__(self, filters, kernel_size, num_buckets, seed=0, strides=1, padding='valid', activation='relu', **kwargs):
+        (super(HashedConv2D, self).__init__)(**kwargs)
+        self.filters = filters
+        if isinstance(kernel_size, int):
+            kernel_size = (kernel_size, kernel_size)
+        self.kernel_size = kernel_size
+        if isinstance(strides, int):
+            strides = (strides, strides)
+        self.strides = strides
+        self.padding = padding.upper()
+        self.num_buckets = num_buckets
+        self.seed = seed
+        self.activation = tf.keras.activations.get(activation)
+
+    def build(self, input_shape):
+        _, _, _, channels = input_shape
+        self.kernel_shape = [self.kernel_size[0], self.kernel_size[1], channels, self.filters]
+        self.hashed_indices = hashed_kernel_indices(self.kernel_shape, self.num_buckets, self.seed)
+        w_init = tf.random_normal_initializer()
+        zeros_init = tf.zeros_initializer()
+        self.buckets = tf.Variable(name='buckets', initial_value=w_init(shape=[self.num_buckets], dtype='float32'),
+          trainable=True)
+        self.bias = tf.Variable(name='bias', initial_value=zeros_init(shape=[self.filters], dtype='float32'),
+          trainable=True)
+
+    def get_config(self):
+        config = super(HashedConv2D, self).get_config().copy()
+        config.update({'filters': self.filters, 'kernel_size': self.kernel_size, 'num_buckets': self.num_buckets,
+          'seed': self.seed, 'strides': self.strides, 'padding': self.padding,
+          'activation': tf.keras.activations.serialize(self.activation)})
+        return config
+
+    def get_kernel(self):
+        return tf.gather(tf.concat([self.buckets, -self.buckets], axis=0), self.hashed_indices)
+
+    def call(self, inputs):
+        x = tf.nn.conv2d(input=inputs, filters=self.get_kernel(), strides=self.strides, padding=self.padding)
+        x = tf.nn.bias_add(x, self.bias)
+        return self.activation(x)
+
+@tf.keras.utils.register_keras_serializable()
+class TuckerConv2D(tf.keras.layers.Layer):
+    """
+    Conv2D layer with a Tucker-2 decomposed kernel. The input channels are projected to input_rank channels
+    by a 1x1 convolution, the core convolution maps them to output_rank channels and a 1x1 convolution
+    projects them to the filters.
+    """
+
+    def __init__(self, filters, input_rank, output_rank, kernel_size, strides=1, padding='valid', activation='relu', **kwargs):
+        (super(TuckerConv2D, self).__init__)(**kwargs)
+        self.filters = filters
+        self.input_rank = input_rank
+        self.output_rank = output_rank
+        if isinstance(kernel_size, int):
+            kernel_size = (kernel_size, kernel_size)
+        self.kernel_size = kernel_size
+        if isinstance(strides, int):
+            strides = (strides, strides)
+        self.strides = strides
+        self.padding = padding.upper()
+        self.activation = tf.keras.activations.get(activation)
+
+    def build(self, input_shape):
+        _, _, _, channels = input_shape
+        w_init = tf.random_normal_initializer()
+        zeros_init = tf.zeros_initializer()
+        self.kernel_in = tf.Variable(name='kernel_in', initial_value=w_init(shape=[1, 1, channels, self.input_rank], dtype='float32'),
+          trainable=True)
+        self.core = tf.Variable(name='core', initial_value=w_init(shape=[self.kernel_size[0], self.kernel_size[1], self.input_rank, self.output_rank], dtype='float32'),
+          trainable=True)
+        self.kernel_out = tf.Variable(name='kernel_out', initial_value=w_init(shape=[1, 1, self.output_rank, self.filters], dtype='float32'),
+          trainable=True)
+        self.bias = tf.Variable(name='bias', initial_value=zeros_init(shape=[self.filters], dtype='float32'),
+          trainable=True)
+
+    def get_config(self):
+        config = super(TuckerConv2D, self).get_config().copy()
+        config.update({'filters': self.filters, 'input_rank': self.input_rank, 'output_rank': self.output_rank,
+          'kernel_size': self.kernel_size, 'strides': self.strides, 'padding': self.padding,
+          'activation': tf.keras.activations.serialize(self.activation)})
+        return config
+
+    def get_kernel(self):
         """
-        Applies region of interest to a single image
+        Returns the kernel of the equivalent Conv2D layer.
         """
-        i0 = tf.constant(1)
-        m = ROIEmbedding._pool_roi(feature_map, n_bins[0])
-        def cond(i, m): return tf.less(i, n_bins.shape[0])
-        def body(i, m): return [
-            i+1, tf.concat([m, ROIEmbedding._pool_roi(feature_map, n_bins[i])], axis=0)]
-        n, m = tf.while_loop(cond, body, loop_vars=[i0, m])
-        # outputs = tf.map_fn(lambda bin_size: ROIEmbedding._pool_roi(feature_map, bin_size[0], bin_size[1]), n_bins)
-        return m
-
-    @tf.function
-    def call(self, x):
+        return tf.einsum('hwrs,cr,sf->hwcf', self.core, self.kernel_in[0, 0], self.kernel_out[0, 0])
 
-        def pool_image(x):
-            return ROIEmbedding._pool_rois(x, tf.constant(self.n_bins))
+    def call(self, inputs):
+        x = tf.nn.conv2d(input=inputs, filters=self.kernel_in, strides=1, padding='VALID')
+        x = tf.nn.conv2d(input=x, filters=self.core, strides=self.strides, padding=self.padding)
+        x = tf.nn.conv2d(input=x, filters=self.kernel_out, strides=1, padding='VALID')
+        x = tf.nn.bias_add(x, self.bias)
+        return self.activation(x)
 
-        pooled_areas = tf.map_fn(pool_image, x)
+@tf.keras.utils.register_keras_serializable()
+class TTDense(tf.keras.layers.Layer):
+    """
+    Dense layer whose kernel is stored in the tensor-train format. The features are factorized as
+    input_modes and the units as output_modes, and core k has shape (tt_ranks[k], input_modes[k],
+    output_modes[k], tt_ranks[k+1]). The input is contracted with one core at a time, so the kernel is
+    never created.
+    """
+
+    def __init__(self, units, input_modes, output_modes, tt_ranks, activation='relu', **kwargs):
+        (super(TTDense, self).__init__)(**kwargs)
+        self.units = units
+        self.input_modes = list(input_modes)
+        self.output_modes = list(output_modes)
+        self.tt_ranks = list(tt_ranks)
+        self.activation = tf.keras.activations.get(activation)
 
-        # Reshape to [None, embedding_size] so that autograph knows the size of the last dimension.
-        return tf.reshape(pooled_areas, shape=[-1, self.embedding_size*x.shape[-1]])
+    def build(self, input_shape):
+        w_init = tf.random_normal_initializer()
+        zeros_init = tf.zeros_initializer()
+        for k, (n, m) in enumerate(zip(self.input_modes, self.output_modes)):
+            setattr(self, f'core{k}', tf.Variable(name=f'core{k}', initial_value=w_init(shape=[self.tt_ranks[k], n, m, self.tt_ranks[k+1]], dtype='float32'),
+              trainable=True))
+        self.bias0 = tf.Variable(name='bias0', initial_value=zeros_init(shape=[self.units], dtype='float32'),
+          trainable=True)
+
+    def get_config(self):
+        config = super(TTDense, self).get_config().copy()
+        config.update({'units': self.units, 'input_modes': self.input_modes, 'output_modes': self.output_modes,
+          'tt_ranks': self.tt_ranks, 'activation': tf.keras.activations.serialize(self.activation)})
+        return config
+
+    @property
+    def cores(self):
+        return [getattr(self, f'core{k}') for k in range(len(self.input_modes))]
+
+    def get_kernel(self):
+        """
+        Returns the (features, units) kernel of the equivalent Dense layer.
+        """
+        kernel = tf.ones([1, 1, 1])
+        for core in self.cores:
+            kernel = tf.einsum('ijr,rnms->injms', kernel, core)
+            shape = tf.shape(kernel)
+            kernel = tf.reshape(kernel, [shape[0] * shape[1], shape[2] * shape[3], shape[4]])
+        return tf.reshape(kernel, [-1, self.units])
+
+    def call(self, inputs):
+        batch_size = tf.shape(inputs)[0]
+        # Shape (batch, contracted outputs, rank, mode, remaining features).
+        x = tf.reshape(inputs, [batch_size, 1, 1, self.input_modes[0], -1])
+        outputs = 1
+        for k, core in enumerate(self.cores):
+            x = tf.einsum('bprnq,rnms->bpmsq', x, core)
+            outputs *= self.output_modes[k]
+            next_mode = self.input_modes[k+1] if k + 1 < len(self.cores) else 1
+            x = tf.reshape(x, [batch_size, outputs, self.tt_ranks[k+1], next_mode, -1])
+        x = tf.reshape(x, [batch_size, self.units])
+        return self.activation(x + self.bias0)
 
 @tf.keras.utils.register_keras_serializable()
-class ROIEmbedding1D(tf.keras.layers.Layer):
+class ROIEmbedding(tf.keras.layers.Layer):
+    """
+    Spatial pyramid pooling. For every (height bins, width bins) level of n_bins, the feature map is split in
+    bins of size // bins rows (columns), the last one taking the remaining rows (columns), and the maximum of
+    every bin and channel is returned. The rows of every bin are max pooled with a segment max over the whole
+    batch and then the columns, so feature maps of any size are pooled without looping over images or bins.
+    """
+
     def __init__(self, n_bins, *args, **kwargs):
-        super(ROIEmbedding1D, self).__init__(*args, **kwargs)
-        self.n_bins = tf.constant(n_bins)
-        self.embedding_size = tf.math.reduce_sum(self.n_bins)
+        super(ROIEmbedding, self).__init__(*args, **kwargs)
+        # Stored as tuples, so Keras does not wrap them.
+        self.n_bins = tuple(tuple(int(bins) for bins in level) for level in n_bins)
+        self.embedding_size = sum(height_bins * width_bins for height_bins, width_bins in self.n_bins)
 
     def build(self, input_shape):
 
         super().build(input_shape)
 
     @staticmethod
-    def _pool_row_n_bin_size(feature_map, pool_width):
+    def bin_ids(size, bins):
+        """
+        Returns the bin of every position of an axis of the given size and whether every bin has any position.
+        """
+        step = size // bins
+        ids = tf.minimum(tf.range(size) // tf.maximum(step, 1), bins - 1)
+        # If there are fewer positions than bins, all of them are in the last bin.
+        ids = tf.where(step > 0, ids, bins - 1)
+        return ids, tf.math.unsorted_segment_max(tf.ones([size]), ids, bins) > 0
 
-        # Compute region of interest
-        region_width = tf.shape(feature_map)[0]
+    @staticmethod
+    def pool_level(x, height_bins, width_bins):
+        """
+        Max pools a batch of feature maps (batch, height, width, channels) in height_bins x width_bins bins.
+        :return: tensor (batch, height_bins * width_bins * channels) with the bins in row-major order.
+        """
+        shape = tf.shape(x)
+        row_ids, rows_used = ROIEmbedding.bin_ids(shape[1], height_bins)
+        column_ids, columns_used = ROIEmbedding.bin_ids(shape[2], width_bins)
+        # Segment ops reduce the first axis: (height, batch, width, channels) to (height_bins, batch, width, channels).
+        x = tf.math.unsorted_segment_max(tf.transpose(x, [1, 0, 2, 3]), row_ids, height_bins)
+        # (width, height_bins, batch, channels) to (width_bins, height_bins, batch, channels).
+        x = tf.math.unsorted_segment_max(tf.transpose(x, [2, 0, 1, 3]), column_ids, width_bins)
+        x = tf.transpose(x, [2, 1, 0, 3])
+        # The maximum of an empty bin is -inf, as in reduce_max.
+        x = tf.where(tf.logical_and(rows_used[:, None, None], columns_used[None, :, None]), x, -np.inf)
+        return tf.reshape(x, [shape[0], height_bins * width_bins * x.shape[-1]])
 
-        # Divide the region into non-overlapping areas
-        w_step = tf.cast(region_width / pool_width, tf.int32)
+    def call(self, x):
+        return tf.concat([self.pool_level(x, height_bins, width_bins) for height_bins, width_bins in self.n_bins], axis=1)
 
-        areas = tf.TensorArray(tf.int32, size=pool_width)
+    def get_config(self):
+        config = super(ROIEmbedding, self).get_config().copy()
+        config.update({'n_bins': [list(level) for level in self.n_bins]})
+        return config
 
-        for i in tf.range(pool_width):
-            areas = areas.write(
-                i, [i*w_step, (i+1)*w_step if i+1 < pool_width else region_width])
+@tf.keras.utils.register_keras_serializable()
+class ROIEmbedding1D(tf.keras.layers.Layer):
+    """
+    Pyramid pooling of sequences (batch, length, channels). For every number of bins of n_bins, the sequence is
+    split in bins of length // bins positions, the last one taking the remaining positions, and the maximum of
+    every bin over its positions and channels is returned. Sequences of different lengths can be given as a
+    RaggedTensor or with a mask, in which case the bins of every sequence are computed from its length. The masked
+    positions can be anywhere in the sequence, the unmasked ones are pooled in their order. All the bins of all the
+    sequences are pooled with a single segment max.
+    """
 
-        areas = areas.stack()
+    def __init__(self, n_bins, *args, **kwargs):
+        super(ROIEmbedding1D, self).__init__(*args, **kwargs)
+        self.n_bins = tuple(int(bins) for bins in n_bins)
+        self.embedding_size = sum(self.n_bins)
+        self.supports_masking = True
 
-        def fn(x): return tf.math.reduce_max(feature_map[x[0]:x[1]])
+    def build(self, input_shape):
 
-        pooled_features = tf.map_fn(fn, areas, fn_output_signature =tf.float32)
-        return pooled_features
+        super().build(input_shape)
 
-    @staticmethod
-    def _pool_row(feature_map, n_bins):
+    def segment_ids(self, lengths, max_length, mask=None):
         """
-        Applies region of interest to a single image
+        Returns the segment of every position of every sequence for every number of bins, with shape
+        (levels, batch, max_length), and whether every segment has any position. The segments of a sequence are
+        consecutive, starting at its index times embedding_size, and the padding positions have segment -1 so they
+        are dropped.
+        :param mask: (batch, max_length) mask of the positions of the sequences. Without a mask, the first lengths
+        positions of every sequence are used.
         """
-        i0 = tf.constant(1)
-        m = ROIEmbedding1D._pool_row_n_bin_size(feature_map, n_bins[0])
-        def cond(i, m): return tf.less(i, n_bins.shape[0])
-        def body(i, m): return [
-            i+1, tf.concat([m, ROIEmbedding1D._pool_row_n_bin_size(feature_map, n_bins[i])], axis=0)]
-        n, m = tf.while_loop(cond, body, loop_vars=[i0, m])
-        return m
-
-    @tf.function
-    def call(self, x):
+        batch_size = tf.shape(lengths)[0]
+        if mask is None:
+            positions = tf.range(max_length)[None, :]
+            valid = positions < lengths[:, None]
+        else:
+            # Position of every unmasked value in its sequence without the masked values.
+            valid = tf.cast(mask, tf.bool)
+            positions = tf.cumsum(tf.cast(valid, tf.int32), axis=1) - 1
+        offsets = tf.range(batch_size)[:, None] * self.embedding_size
+        ids = []
+        level_offset = 0
+        for bins in self.n_bins:
+            step = (lengths // bins)[:, None]
+            level_ids = tf.minimum(positions // tf.maximum(step, 1), bins - 1)
+            # If the sequence has fewer positions than bins, all of them are in the last bin.
+            level_ids = tf.where(step > 0, level_ids, bins - 1)
+            ids.append(tf.where(valid, offsets + level_offset + level_ids, -1))
+            level_offset += bins
+        ids = tf.stack(ids)
+        num_segments = batch_size * self.embedding_size
+        used = tf.math.unsorted_segment_max(tf.ones_like(ids, dtype=tf.float32), ids, num_segments) > 0
+        return ids, used
+
+    def call(self, x, mask=None):
+        if isinstance(x, tf.RaggedTensor):
+            lengths = tf.cast(x.row_lengths(), tf.int32)
+            x = x.to_tensor()
+            mask = None
+        elif mask is not None:
+            lengths = tf.reduce_sum(tf.cast(mask, tf.int32), axis=1)
+        else:
+            lengths = tf.fill([tf.shape(x)[0]], tf.shape(x)[1])
 
-        def pool_row(x):
-            return ROIEmbedding1D._pool_row(x, self.n_bins)
+        ids, used = self.segment_ids(lengths, tf.shape(x)[1], mask)
+        x = tf.reduce_max(x, axis=2)
+        x = tf.math.unsorted_segment_max(tf.tile(x[None], [len(self.n_bins), 1, 1]), ids, tf.size(used))
+        # The maximum of an empty bin is -inf, as in reduce_max.
+        x = tf.where(used, x, -np.inf)
+        return tf.reshape(x, [-1, self.embedding_size])
 
-        pooled_areas = tf.map_fn(pool_row, x)
+    def compute_mask(self, inputs, mask=None):
+        return None
 
-        # Reshape to [None, embedding_size] so that autograph knows the size of the last dimension.
-        return tf.reshape(pooled_areas, shape=[-1, self.embedding_size])
+    def get_config(self):
+        config = super(ROIEmbedding1D, self).get_config().copy()
+        config.update({'n_bins': list(self.n_bins)})
+        return config
@@ -6,14 +6,18 @@ import importlib
 import CompressionLibrary.CompressionTechniques as CompressionTechniques
 from CompressionLibrary.CompressionTechniques import *
 from CompressionLibrary.custom_callbacks import RestoreBestWeights
-from CompressionLibrary.utils import calculate_model_weights, extract_model_parts, create_model_from_parts
+from CompressionLibrary.storage import compressed_size
+from CompressionLibrary.cost_model import dry_run
+from CompressionLibrary.xla import compile_model, recompile_model
+from CompressionLibrary.reward_functions import latency_rewards
+from CompressionLibrary.utils import calculate_model_weights, calculate_model_bytes, calculate_model_flops, calculate_model_latency, extract_model_parts, create_model_from_parts
 import logging
 import copy
 
 class ModelCompressionEnv():
     def __init__(self, reward_func, compressors_list, create_model_func, compr_params,
                  train_ds, validation_ds, test_ds, state_ds,
-                 layer_name_list, input_shape, current_state_source='layer_input', next_state_source='layer_output', verbose=0, tuning_mode='layer',tuning_epochs=5, num_feature_maps=128, tuning_batch_size=32, strategy=None):
+                 layer_name_list, input_shape, current_state_source='layer_input', next_state_source='layer_output', verbose=0, tuning_mode='layer',tuning_epochs=5, num_feature_maps=128, tuning_batch_size=32, strategy=None, report_storage=False, measure_latency=False, jit_compile=False):
 
         self.reward_func = reward_func
         self._episode_ended = False
@@ -34,6 +38,12 @@ class ModelCompressionEnv():
         self.tuning_batch_size = tuning_batch_size
         self.tuning_epochs = tuning_epochs
         self.strategy = strategy
+        self.report_storage = report_storage
+        self.measure_latency = measure_latency
+        if reward_func in latency_rewards and not measure_latency:
+            self.logger.info(f'{reward_func.__name__} uses the latency of the models, so it is measured.')
+            self.measure_latency = True
+        self.jit_compile = jit_compile
         self.tuning_mode = tuning_mode
         self.callbacks = []
         self.current_batch = None
@@ -43,6 +53,8 @@ class ModelCompressionEnv():
         self.optimizer = tf.keras.optimizers.Adam(1e-5)
         self.loss_object = tf.keras.losses.SparseCategoricalCrossentropy()
         self.train_metric = tf.keras.metrics.SparseCategoricalAccuracy()
+        if self.jit_compile:
+            self.compile_with_jit()
         self.chosen_actions = []
 
         compressors = [name for name, cls in
@@ -58,9 +70,9 @@ class ModelCompressionEnv():
             temp_comp = class_(model=self.model, dataset=self.train_ds, optimizer=self.optimizer, loss=self.loss_object, metrics=self.train_metric,
                                fine_tuning=False, input_shape=self.input_shape)
 
-            if temp_comp.target_layer_type == 'conv':
+            if temp_comp.target_layer_type in ['conv', 'any']:
                 self.conv_compressors.append(compressor)
-            elif temp_comp.target_layer_type == 'dense':
+            if temp_comp.target_layer_type in ['dense', 'any']:
                 self.dense_compressors.append(compressor)
             del temp_comp
 
@@ -88,6 +100,12 @@ class ModelCompressionEnv():
 
         self.weights_before = int(np.sum([K.count_params(w) for w in self.model.trainable_weights]))
         self.weights_previous_it = self.weights_before
+        self.bytes_before = calculate_model_bytes(self.model)
+        self.bytes_previous_it = self.bytes_before
+        self.flops_before = calculate_model_flops(self.model)
+        self.flops_previous_it = self.flops_before
+        self.latency_before = self.get_model_latency()
+        self.latency_previous_it = self.latency_before
         
         if self.strategy:
             self.logger.debug('Strategy found. Using strategy to evaluate.')
@@ -97,7 +115,7 @@ class ModelCompressionEnv():
                 optimizer2 = tf.keras.optimizers.Adam(1e-5)
                 loss2 = tf.keras.losses.SparseCategoricalCrossentropy()
                 metric2 = tf.keras.metrics.SparseCategoricalAccuracy()
-                self.model = create_model_from_parts(layers, configs, weights, optimizer2, loss2, metric2, input_shape=self.input_shape)
+                self.model = create_model_from_parts(layers, configs, weights, optimizer2, loss2, metric2, input_shape=self.input_shape, jit_compile=self.jit_compile)
                 self.logger.debug('Evaluating model using test set.')
                 test_loss, self.test_acc_before = self.model.evaluate(self.test_ds, verbose=self.verbose)
                 self.logger.info(f'Test accuracy is {self.test_acc_before} and loss {test_loss}')
@@ -139,6 +157,32 @@ class ModelCompressionEnv():
 
         return max(filters)
 
+    def compile_with_jit(self):
+        """
+        Compiles the model created by create_model_func again with XLA if all its layers can be compiled. Only XLA
+        changes, the model keeps the optimizer, loss and metrics it was compiled with. A model that was not compiled
+        is compiled with the optimizer, loss and metric of the environment.
+        """
+        if self.model.optimizer is None:
+            compile_model(self.model, self.optimizer, self.loss_object, self.train_metric, jit_compile=True)
+        else:
+            recompile_model(self.model, jit_compile=True)
+
+    def get_model_latency(self):
+        """
+        Returns the CPU latency of the current model if measure_latency is True, otherwise None.
+        """
+        if self.measure_latency:
+            return calculate_model_latency(self.model)
+        return None
+
+    def dry_run(self, plan):
+        """
+        Estimates the weights, bytes and FLOPs of the current model after applying a plan without compressing it.
+        See cost_model.dry_run.
+        """
+        return dry_run(self.model, plan)
+
     def observation_space(self):
         return self.conv_shape, self.dense_shape
 
@@ -279,6 +323,8 @@ class ModelCompressionEnv():
         self.logger.debug('---RESTARTING ENVIRONMENT---')
         
         self.model = self.create_model_func()
+        if self.jit_compile:
+            self.compile_with_jit()
         self.layer_name_list = self.original_layer_name_list.copy()
         self.callbacks = []
         self._layer_counter = 0
@@ -289,6 +335,12 @@ class ModelCompressionEnv():
         
         self.weights_before = int(np.sum([K.count_params(w) for w in self.model.trainable_weights]))
         self.weights_previous_it = self.weights_before
+        self.bytes_before = calculate_model_bytes(self.model)
+        self.bytes_previous_it = self.bytes_before
+        self.flops_before = calculate_model_flops(self.model)
+        self.flops_previous_it = self.flops_before
+        self.latency_before = self.get_model_latency()
+        self.latency_previous_it = self.latency_before
         self.chosen_actions = []
 
         return self._state
@@ -341,7 +393,7 @@ class EnvDiscreteUniqueActions(ModelCompressionEnv):
             
             class_ = getattr(CompressionTechniques, compressors[action])
 
-            compressor = class_(model=self.model, dataset=self.train_ds, optimizer=self.optimizer, loss=self.loss_object, metrics=self.train_metric, fine_tuning=False, input_shape=self.input_shape, tuning_verbose=self.verbose, callbacks=self.callbacks)
+            compressor = class_(model=self.model, dataset=self.train_ds, optimizer=self.optimizer, loss=self.loss_object, metrics=self.train_metric, fine_tuning=False, input_shape=self.input_shape, tuning_verbose=self.verbose, callbacks=self.callbacks, jit_compile=self.jit_compile)
 
             compressor.callbacks = self.callbacks
 
@@ -382,7 +434,7 @@ class EnvDiscreteUniqueActions(ModelCompressionEnv):
 
 
         if (self.tuning_mode == 'layer' or self._episode_ended) and train_layers:
-            rbw = RestoreBestWeights(acc_before = self.val_acc_before, reward_func=self.reward_func, weights_before=self.weights_before, verbose=1)
+            rbw = RestoreBestWeights(acc_before = self.val_acc_before, reward_func=self.reward_func, weights_before=self.weights_before, bytes_before=self.bytes_before, flops_before=self.flops_before, latency_before=self.latency_before, verbose=1)
             temp_cb = copy.copy(self.callbacks)
             temp_cb.append(rbw)
 
@@ -398,7 +450,7 @@ class EnvDiscreteUniqueActions(ModelCompressionEnv):
                     optimizer2 = tf.keras.optimizers.Adam(1e-5)
                     loss2 = tf.keras.losses.SparseCategoricalCrossentropy()
                     metric2 = tf.keras.metrics.SparseCategoricalAccuracy()
-                    self.model = create_model_from_parts(layers, configs, weights, optimizer2, loss2, metric2, input_shape=self.input_shape)
+                    self.model = create_model_from_parts(layers, configs, weights, optimizer2, loss2, metric2, input_shape=self.input_shape, jit_compile=self.jit_compile)
                     for layer in self.model.layers:
                         if layer.name in train_layers:
                             layer.trainable = True
@@ -441,18 +493,33 @@ class EnvDiscreteUniqueActions(ModelCompressionEnv):
         self.logger.info(f'Val loss: {val_loss}\t Val acc:{val_acc_after}')
         self.logger.info(f'Test loss: {test_loss}\t Test acc:{test_acc_after}')
         weights_after = calculate_model_weights(self.model)
+        bytes_after = calculate_model_bytes(self.model)
+        flops_after = calculate_model_flops(self.model)
+        latency_after = self.get_model_latency()
 
         stats = {'weights_before': self.weights_previous_it, 
                  'weights_after': weights_after, 
+                 'bytes_before': self.bytes_previous_it,
+                 'bytes_after': bytes_after,
+                 'flops_before': self.flops_previous_it,
+                 'flops_after': flops_after,
+                 'latency_before': self.latency_previous_it,
+                 'latency_after': latency_after,
                  'accuracy_before': self.test_acc_before,
                  'accuracy_after': test_acc_after}
         
         reward_step = self.reward_func(stats)
         stats['weights_before'] = self.weights_before
+        stats['bytes_before'] = self.bytes_before
+        stats['flops_before'] = self.flops_before
+        stats['latency_before'] = self.latency_before
         reward_all_steps = self.reward_func(stats)
         # reward_step = 1 - (weights_after / self.weights_previous_it) + test_acc_after - 0.9 * self.test_acc_before
         # reward_all_steps = 1 - (weights_after / self.weights_before) + test_acc_after - 0.9 * self.test_acc_before
         self.weights_previous_it = weights_after
+        self.bytes_previous_it = bytes_after
+        self.flops_previous_it = flops_after
+        self.latency_previous_it = latency_after
 
         self.logger.info(f'Reward for step is {reward_step}. The reward for all steps is {reward_all_steps}.')
 
@@ -461,6 +528,14 @@ class EnvDiscreteUniqueActions(ModelCompressionEnv):
         info['weights_original'] = self.weights_before
         info['weights_before_step'] = self.weights_previous_it
         info['weights_after'] = weights_after
+        info['bytes_original'] = self.bytes_before
+        info['bytes_after'] = bytes_after
+        info['flops_original'] = self.flops_before
+        info['flops_after'] = flops_after
+        info['latency_original'] = self.latency_before
+        info['latency_after'] = latency_after
+        if self.report_storage:
+            info['disk_bytes_after'] = compressed_size(self.model)
         info['val_acc_before'] = self.val_acc_before
         info['val_acc_after'] = val_acc_after
         info['actions'] = self.chosen_actions
@@ -510,7 +585,7 @@ class ModelCompressionSVDEnvContinous(ModelCompressionEnv):
             
             class_ = getattr(CompressionTechniques, compressors[0])
 
-            compressor = class_(model=self.model, dataset=self.train_ds, optimizer=self.optimizer, loss=self.loss_object, metrics=self.train_metric, fine_tuning=False, input_shape=self.input_shape, tuning_verbose=self.verbose, callbacks=self.callbacks)
+            compressor = class_(model=self.model, dataset=self.train_ds, optimizer=self.optimizer, loss=self.loss_object, metrics=self.train_metric, fine_tuning=False, input_shape=self.input_shape, tuning_verbose=self.verbose, callbacks=self.callbacks, jit_compile=self.jit_compile)
 
             compressor.callbacks = self.callbacks
 
@@ -547,14 +622,14 @@ class ModelCompressionSVDEnvContinous(ModelCompressionEnv):
                     optimizer2 = tf.keras.optimizers.Adam(1e-5)
                     loss2 = tf.keras.losses.SparseCategoricalCrossentropy()
                     metric2 = tf.keras.metrics.SparseCategoricalAccuracy()
-                    self.model = create_model_from_parts(layers, configs, weights, optimizer2, loss2, metric2, input_shape=self.input_shape)
+                    self.model = create_model_from_parts(layers, configs, weights, optimizer2, loss2, metric2, input_shape=self.input_shape, jit_compile=self.jit_compile)
 
                     # for layer in self.model.layers:
                     #     if layer.name == layer_name:
                     #         layer.trainable = True
                     #     else:
                     #         layer.trainable = False
-                    rbw = RestoreBestWeights(acc_before = self.val_acc_before, weights_before=self.weights_before, verbose=1)
+                    rbw = RestoreBestWeights(acc_before = self.val_acc_before, weights_before=self.weights_before, bytes_before=self.bytes_before, flops_before=self.flops_before, latency_before=self.latency_before, verbose=1)
                     self.model.fit(self.train_ds, epochs=self.tuning_epochs, callbacks=[rbw], validation_data=self.validation_ds, verbose=self.verbose)
                     # for layer in self.model.layers:
                     #     layer.trainable = True
@@ -564,7 +639,7 @@ class ModelCompressionSVDEnvContinous(ModelCompressionEnv):
                 #         layer.trainable = True
                 #     else:
                 #         layer.trainable = False
-                rbw = RestoreBestWeights(acc_before = self.val_acc_before, weights_before=self.weights_before, verbose=1)
+                rbw = RestoreBestWeights(acc_before = self.val_acc_before, weights_before=self.weights_before, bytes_before=self.bytes_before, flops_before=self.flops_before, latency_before=self.latency_before, verbose=1)
                 self.model.fit(self.train_ds, epochs=self.tuning_epochs, callbacks=[rbw], validation_data=self.validation_ds, verbose=self.verbose)
                 # for layer in self.model.layers:
                 #     layer.trainable = True
@@ -580,7 +655,7 @@ class ModelCompressionSVDEnvContinous(ModelCompressionEnv):
                     optimizer2 = tf.keras.optimizers.Adam(1e-5)
                     loss2 = tf.keras.losses.SparseCategoricalCrossentropy()
                     metric2 = tf.keras.metrics.SparseCategoricalAccuracy()
-                    self.model = create_model_from_parts(layers, configs, weights, optimizer2, loss2, metric2, input_shape=self.input_shape)
+                    self.model = create_model_from_parts(layers, configs, weights, optimizer2, loss2, metric2, input_shape=self.input_shape, jit_compile=self.jit_compile)
                     test_loss, test_acc_after = self.model.evaluate(self.test_ds, verbose=self.verbose)
                     val_loss, val_acc_after = self.model.evaluate(self.validation_ds, verbose=self.verbose)
             else:
@@ -592,9 +667,13 @@ class ModelCompressionSVDEnvContinous(ModelCompressionEnv):
                     val_acc_after = self.val_acc_before
 
         weights_after = calculate_model_weights(self.model)
+        bytes_after = calculate_model_bytes(self.model)
+        flops_after = calculate_model_flops(self.model)
+        latency_after = self.get_model_latency()
 
         if self._episode_ended:
-            stats = {'weights_before': self.weights_before, 'weights_after':weights_after, 'accuracy_after': test_acc_after, 'accuracy_before': self.test_acc_before}
+            stats = {'weights_before': self.weights_before, 'weights_after':weights_after, 'bytes_before': self.bytes_before, 'bytes_after': bytes_after,
+                     'flops_before': self.flops_before, 'flops_after': flops_after, 'latency_before': self.latency_before, 'latency_after': latency_after, 'accuracy_after': test_acc_after, 'accuracy_before': self.test_acc_before}
             reward = self.reward_func(stats)
         else: 
             reward = 0
@@ -609,6 +688,14 @@ class ModelCompressionSVDEnvContinous(ModelCompressionEnv):
         info['weights_original'] = self.weights_before
         info['weights_before_step'] = weights_before
         info['weights_after'] = weights_after
+        info['bytes_original'] = self.bytes_before
+        info['bytes_after'] = bytes_after
+        info['flops_original'] = self.flops_before
+        info['flops_after'] = flops_after
+        info['latency_original'] = self.latency_before
+        info['latency_after'] = latency_after
+        if self.report_storage:
+            info['disk_bytes_after'] = compressed_size(self.model)
         info['val_acc_before'] = self.val_acc_before
         info['val_acc_after'] = val_acc_after
         info['actions'] = self.chosen_actions
@@ -659,7 +746,7 @@ class ModelCompressionSVDIntEnv(ModelCompressionEnv):
             
             class_ = getattr(CompressionTechniques, compressors[0])
 
-            compressor = class_(model=self.model, dataset=self.train_ds, optimizer=self.optimizer, loss=self.loss_object, metrics=self.train_metric, fine_tuning=False, input_shape=self.input_shape, tuning_verbose=self.verbose, callbacks=self.callbacks)
+            compressor = class_(model=self.model, dataset=self.train_ds, optimizer=self.optimizer, loss=self.loss_object, metrics=self.train_metric, fine_tuning=False, input_shape=self.input_shape, tuning_verbose=self.verbose, callbacks=self.callbacks, jit_compile=self.jit_compile)
 
             compressor.callbacks = self.callbacks
 
@@ -705,14 +792,14 @@ class ModelCompressionSVDIntEnv(ModelCompressionEnv):
                     optimizer2 = tf.keras.optimizers.Adam(1e-5)
                     loss2 = tf.keras.losses.SparseCategoricalCrossentropy()
                     metric2 = tf.keras.metrics.SparseCategoricalAccuracy()
-                    self.model = create_model_from_parts(layers, configs, weights, optimizer2, loss2, metric2, input_shape=self.input_shape)
+                    self.model = create_model_from_parts(layers, configs, weights, optimizer2, loss2, metric2, input_shape=self.input_shape, jit_compile=self.jit_compile)
 
                     for layer in self.model.layers:
                         if layer.name in train_layers:
                             layer.trainable = True
                         else:
                             layer.trainable = False
-                    rbw = RestoreBestWeights(acc_before = self.val_acc_before, reward_func=self.reward_func,weights_before=self.weights_before, verbose=1)
+                    rbw = RestoreBestWeights(acc_before = self.val_acc_before, reward_func=self.reward_func,weights_before=self.weights_before, bytes_before=self.bytes_before, flops_before=self.flops_before, latency_before=self.latency_before, verbose=1)
                     self.model.fit(self.train_ds, epochs=self.tuning_epochs, callbacks=[rbw], validation_data=self.validation_ds, verbose=self.verbose)
                     for layer in self.model.layers:
                         layer.trainable = True
@@ -722,7 +809,7 @@ class ModelCompressionSVDIntEnv(ModelCompressionEnv):
                         layer.trainable = True
                     else:
                         layer.trainable = False
-                rbw = RestoreBestWeights(acc_before = self.val_acc_before, reward_func=self, weights_before=self.weights_before, verbose=1)
+                rbw = RestoreBestWeights(acc_before = self.val_acc_before, reward_func=self, weights_before=self.weights_before, bytes_before=self.bytes_before, flops_before=self.flops_before, latency_before=self.latency_before, verbose=1)
                 self.model.fit(self.train_ds, epochs=self.tuning_epochs, callbacks=[rbw], validation_data=self.validation_ds, verbose=self.verbose)
                 for layer in self.model.layers:
                     layer.trainable = True
@@ -738,7 +825,7 @@ class ModelCompressionSVDIntEnv(ModelCompressionEnv):
                     optimizer2 = tf.keras.optimizers.Adam(1e-5)
                     loss2 = tf.keras.losses.SparseCategoricalCrossentropy()
                     metric2 = tf.keras.metrics.SparseCategoricalAccuracy()
-                    self.model = create_model_from_parts(layers, configs, weights, optimizer2, loss2, metric2, input_shape=self.input_shape)
+                    self.model = create_model_from_parts(layers, configs, weights, optimizer2, loss2, metric2, input_shape=self.input_shape, jit_compile=self.jit_compile)
                     test_loss, test_acc_after = self.model.evaluate(self.test_ds, verbose=self.verbose)
                     val_loss, val_acc_after = self.model.evaluate(self.validation_ds, verbose=self.verbose)
             else:
@@ -753,12 +840,21 @@ class ModelCompressionSVDIntEnv(ModelCompressionEnv):
             val_acc_after = None
 
         weights_after = calculate_model_weights(self.model)
+        bytes_after = calculate_model_bytes(self.model)
+        flops_after = calculate_model_flops(self.model)
+        latency_after = self.get_model_latency()
 
  
         if self._episode_ended:
             stats = {
                 'weights_before': self.weights_before, 
                 'weights_after': weights_after, 
+                'bytes_before': self.bytes_before, 
+                'bytes_after': bytes_after, 
+                'flops_before': self.flops_before, 
+                'flops_after': flops_after, 
+                'latency_before': self.latency_before, 
+                'latency_after': latency_after, 
                 'accuracy_after': test_acc_after, 
                 'accuracy_before': self.test_acc_before}
 
@@ -775,6 +871,14 @@ class ModelCompressionSVDIntEnv(ModelCompressionEnv):
         info['weights_original'] = self.weights_before
         info['weights_before_step'] = weights_before
         info['weights_after'] = weights_after
+        info['bytes_original'] = self.bytes_before
+        info['bytes_after'] = bytes_after
+        info['flops_original'] = self.flops_before
+        info['flops_after'] = flops_after
+        info['latency_original'] = self.latency_before
+        info['latency_after'] = latency_after
+        if self.report_storage:
+            info['disk_bytes_after'] = compressed_size(self.model)
         info['actions'] = self.chosen_actions
         info['reward'] = reward
         
@@ -0,0 +1,225 @@
+import os
+import sys
+import json
+import logging
+import subprocess
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+# Registers the custom layers so that the exported models can be loaded.
+import CompressionLibrary.custom_layers
+from CompressionLibrary.custom_layers import SparseConnectionsConv2D, SparseConvolution2D
+from CompressionLibrary.benchmark import time_function
+from CompressionLibrary.model_passes import fuse_factorized_layers, convert_sparse_connections
+from CompressionLibrary.xla import unsupported_layers
+
+# Exports a (compressed) Keras model for deployment and measures its CPU latency. export_model writes
+#   export_dir/saved_model   SavedModel with a serving signature that accepts any batch size
+#   export_dir/model.tflite  TFLite flatbuffer
+# Before exporting, the factorized layers that are faster with a single kernel are fused. The TFLite converter
+# folds the constants of the graph; the SavedModel is optimized by Grappler (constant folding, arithmetic and
+# layout optimizations) when it is loaded.
+
+
+def directory_size(path):
+    """
+    Returns the number of bytes of the files of a directory or of a file.
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, file_name)) for root, _, files in os.walk(path) for file_name in files)
+
+
+def export_saved_model(model, path, jit_compile=False):
+    """
+    Saves the inference graph of a model as a SavedModel with a serving signature that accepts any batch size.
+    :param jit_compile: the serving signature is compiled with XLA when it is called.
+    """
+    input_spec = tf.TensorSpec((None,) + tuple(model.input_shape[1:]), tf.float32, name='inputs')
+    serve = tf.function(lambda x: model(x, training=False), input_signature=[input_spec], jit_compile=jit_compile)
+    tf.saved_model.save(model, path, signatures={'serving_default': serve})
+    return directory_size(path)
+
+
+def export_tflite(saved_model_path, path, quantize=False):
+    """
+    Converts a SavedModel to a TFLite flatbuffer. Layers without a builtin TFLite op fall back to the TensorFlow
+    ops, which need the Flex delegate at runtime.
+    :param quantize: applies the default post-training dynamic range quantization.
+    :return: number of bytes of the flatbuffer.
+    """
+    logger = logging.getLogger(__name__)
+    converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_path)
+    if quantize:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    try:
+        flatbuffer = converter.convert()
+    except Exception as e:
+        logger.warning(f'Conversion with builtin ops failed ({e}), using TensorFlow ops.')
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+        flatbuffer = converter.convert()
+
+    with open(path, 'wb') as f:
+        f.write(flatbuffer)
+    return len(flatbuffer)
+
+
+def export_model(model, export_dir, fuse=True, fuse_criterion='flops', grouped_connections=False, tflite=True, quantize=False,
+                 jit_compile=False, input_shape=None):
+    """
+    Exports a model as a SavedModel and a TFLite flatbuffer.
+    :param model: Keras model, e.g. env.model or a model of the ModelStore.
+    :param export_dir: directory of the exported files.
+    :param fuse: fuses the factorized layers when it makes them faster (see model_passes.fuse_factorized_layers).
+    :param fuse_criterion: 'flops' to estimate or 'latency' to measure which layers are faster.
+    :param grouped_connections: converts the layers with block connections to grouped Conv2D layers (see
+    model_passes.convert_sparse_connections).
+    :param tflite: also converts the model to TFLite.
+    :param quantize: applies dynamic range quantization to the TFLite model.
+    :param jit_compile: compiles the serving signature of the SavedModel with XLA if all the layers can be compiled.
+    :return: dictionary with the paths and sizes in bytes of the exported files, the fused and grouped layers and
+    the weights of the model before and after the passes.
+    """
+    logger = logging.getLogger(__name__)
+    weights_before = model.count_params()
+    fused = {}
+    if fuse:
+        model, fused = fuse_factorized_layers(model, criterion=fuse_criterion, input_shape=input_shape)
+        logger.info(f'Fused layers {list(fused.keys())}.')
+    grouped = {}
+    if grouped_connections:
+        model, grouped = convert_sparse_connections(model, input_shape=input_shape)
+        logger.info(f'Converted layers {list(grouped.keys())} to grouped convolutions.')
+
+    os.makedirs(export_dir, exist_ok=True)
+    saved_model_path = os.path.join(export_dir, 'saved_model')
+    # The exported graph uses the cached inference kernels of the layers with sparse connections and of the sparse
+    # convolutions. The layers are unfrozen afterwards, as they may be shared with a model that is still trained.
+    frozen_layers = [layer for layer in model.layers if isinstance(layer, (SparseConnectionsConv2D, SparseConvolution2D))]
+    for layer in frozen_layers:
+        logger.info(f'Layer {layer.name} uses {layer.freeze():.2f} of the FLOPs of its dense kernel.')
+    if jit_compile:
+        unsupported = unsupported_layers(model)
+        if unsupported:
+            logger.info(f'Layers {unsupported} cannot be compiled with XLA, exporting without it.')
+            jit_compile = False
+    try:
+        saved_model_bytes = export_saved_model(model, saved_model_path, jit_compile)
+    finally:
+        for layer in frozen_layers:
+            layer.unfreeze()
+    result = {'saved_model_path': saved_model_path, 'saved_model_bytes': saved_model_bytes, 'fused_layers': fused,
+              'grouped_layers': grouped, 'weights_before': weights_before, 'weights_after': model.count_params(),
+              'jit_compile': jit_compile}
+    if tflite:
+        tflite_path = os.path.join(export_dir, 'model.tflite')
+        result['tflite_path'] = tflite_path
+        result['tflite_bytes'] = export_tflite(saved_model_path, tflite_path, quantize)
+    return result
+
+
+def benchmark_tflite(path, batch_sizes=(1,), threads=(1,), warmup=5, repeats=50):
+    """
+    Measures the latency of a TFLite model for every batch size and number of threads.
+    :return: list of dictionaries with the batch size, threads and latency statistics of time_function.
+    """
+    results = []
+    for num_threads in threads:
+        interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+        input_details = interpreter.get_input_details()[0]
+        for batch_size in batch_sizes:
+            interpreter.resize_tensor_input(input_details['index'], [batch_size] + list(input_details['shape'][1:]))
+            interpreter.allocate_tensors()
+            inputs = np.random.uniform(size=[batch_size] + list(input_details['shape'][1:])).astype(input_details['dtype'])
+            interpreter.set_tensor(input_details['index'], inputs)
+            latency = time_function(interpreter.invoke, warmup=warmup, repeats=repeats)
+            results.append(dict(latency, format='tflite', batch_size=batch_size, threads=num_threads))
+    return results
+
+
+def _benchmark_saved_model(path, batch_sizes, num_threads, warmup, repeats):
+    tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    serve = tf.saved_model.load(path).signatures['serving_default']
+    input_spec = list(serve.structured_input_signature[1].values())[0]
+    results = []
+    with tf.device('/CPU:0'):
+        for batch_size in batch_sizes:
+            inputs = tf.random.uniform((batch_size,) + tuple(input_spec.shape[1:]), dtype=input_spec.dtype)
+            latency = time_function(serve, inputs, warmup=warmup, repeats=repeats)
+            results.append(dict(latency, format='saved_model', batch_size=batch_size, threads=num_threads))
+    return results
+
+
+def benchmark_saved_model(path, batch_sizes=(1,), threads=(1,), warmup=5, repeats=50):
+    """
+    Measures the CPU latency of a SavedModel for every batch size and number of threads. The number of threads
+    can only be set before TensorFlow is initialized, so every number of threads is measured in a new Python
+    process.
+    :return: list of dictionaries with the batch size, threads and latency statistics of time_function.
+    """
+    env = dict(os.environ, TF_CPP_MIN_LOG_LEVEL='2')
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([package_dir] + [p for p in [os.environ.get('PYTHONPATH')] if p])
+    results = []
+    for num_threads in threads:
+        args = json.dumps({'path': path, 'batch_sizes': list(batch_sizes), 'num_threads': num_threads,
+                           'warmup': warmup, 'repeats': repeats})
+        process = subprocess.run([sys.executable, '-m', 'CompressionLibrary.export', args], env=env,
+                                 capture_output=True, text=True, check=True)
+        results += json.loads(process.stdout.strip().splitlines()[-1])
+    return results
+
+
+def benchmark_export(export, batch_sizes=(1,), threads=(1,), warmup=5, repeats=50):
+    """
+    Measures the latency of the files written by export_model.
+    :return: DataFrame with a row per format, batch size and threads, with the latency and the throughput in
+    samples per second.
+    """
+    results = benchmark_saved_model(export['saved_model_path'], batch_sizes, threads, warmup, repeats)
+    if 'tflite_path' in export:
+        results += benchmark_tflite(export['tflite_path'], batch_sizes, threads, warmup, repeats)
+    df = pd.DataFrame(results)
+    df['throughput'] = df['batch_size'] / df['p50_ms'] * 1000
+    df['bytes'] = df['format'].map({'saved_model': export['saved_model_bytes'], 'tflite': export.get('tflite_bytes')})
+    return df
+
+
+def compare_models(original_model, compressed_model, export_dir, batch_sizes=(1, 8, 32), threads=(1, 4),
+                   warmup=5, repeats=50, save_name=None, **export_kwargs):
+    """
+    Exports the original and the compressed model and compares their latency, throughput and size.
+    :param export_dir: directory in which the models are exported to export_dir/original and export_dir/compressed.
+    :param save_name: path of a CSV file to save the report.
+    :param export_kwargs: arguments of export_model.
+    :return: DataFrame with the measurements of both models and the speedup and size ratio of the compressed model
+    against the original one for the same format, batch size and threads.
+    """
+    logger = logging.getLogger(__name__)
+    dfs = []
+    for name, model in [('original', original_model), ('compressed', compressed_model)]:
+        export = export_model(model, os.path.join(export_dir, name), **export_kwargs)
+        df = benchmark_export(export, batch_sizes, threads, warmup, repeats)
+        df['model'] = name
+        dfs.append(df)
+
+    keys = ['format', 'batch_size', 'threads']
+    original = dfs[0].set_index(keys)
+    report = pd.concat(dfs, ignore_index=True)
+    report = report.join(original[['p50_ms', 'bytes']], on=keys, rsuffix='_original')
+    report['speedup'] = report['p50_ms_original'] / report['p50_ms']
+    report['size_ratio'] = report['bytes'] / report['bytes_original']
+    report = report.drop(columns=['p50_ms_original', 'bytes_original'])
+    report = report[['model'] + keys + [column for column in report.columns if column not in ['model'] + keys]]
+
+    logger.info(f'\n{report[["model"] + keys + ["p50_ms", "throughput", "speedup", "size_ratio"]]}')
+    if save_name is not None:
+        os.makedirs(os.path.dirname(save_name) or '.', exist_ok=True)
+        report.to_csv(save_name, index=False)
+    return report
+
+
+if __name__ == '__main__':
+    # Worker of benchmark_saved_model. Prints the measurements as JSON in the last line of the output.
+    print(json.dumps(_benchmark_saved_model(**json.loads(sys.argv[1]))))
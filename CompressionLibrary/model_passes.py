@@ -0,0 +1,281 @@
+import math
+import tensorflow as tf
+import numpy as np
+import logging
+from CompressionLibrary.custom_layers import SparseDense, DenseSVD, TTDense, ConvSVD, TuckerConv2D, MLPConv
+from CompressionLibrary.custom_layers import SparseConnectionsConv2D, connection_blocks, QuantizedDenseSVD, QuantizedMLPConv
+from CompressionLibrary.cost_model import layer_cost, get_layer_config, current_layer_cost
+from CompressionLibrary.benchmark import layer_latency
+
+
+def rebuild_model(model, new_layers: dict, input_shape=None):
+    """
+    Creates a new model in which every layer whose name is a key of new_layers is replaced by its value. The
+    model must be sequential, as the ones used by the compressors.
+    :param model: Keras model.
+    :param new_layers: dictionary that maps the name of a layer to the layer (or list of layers) that replaces it.
+    :param input_shape: input shape without the batch dimension. Taken from the model if None.
+    :return: Keras model.
+    """
+    if input_shape is None:
+        input_shape = model.input_shape[1:]
+    inputs = tf.keras.layers.Input(shape=input_shape)
+    if isinstance(model.layers[0], tf.keras.layers.InputLayer):
+        start = 1
+    else:
+        start = 0
+    x = inputs
+    for layer in model.layers[start:]:
+        if layer.name in new_layers:
+            replacement = new_layers[layer.name]
+            if isinstance(replacement, list):
+                for new_layer in replacement:
+                    x = new_layer(x)
+            else:
+                x = replacement(x)
+        else:
+            x = layer(x)
+
+    return tf.keras.Model(inputs, x)
+
+
+def kernel_density(kernel):
+    return np.count_nonzero(kernel) / kernel.size
+
+
+def dense_to_sparse(layer, kernel_mode='sparse_matmul'):
+    """
+    Creates a SparseDense layer with the same name and output as a Dense layer.
+    """
+    kernel, bias = layer.get_weights()[0], layer.get_weights()[1:]
+    indices, values = SparseDense.from_kernel(kernel)
+    config = layer.get_config()
+    new_layer = SparseDense(units=config['units'], nnz=values.shape[0], activation=config['activation'],
+                            kernel_mode=kernel_mode, use_bias=config['use_bias'], name=layer.name)
+    new_layer(layer.input)
+    new_layer.set_weights([values] + bias + [indices])
+    return new_layer
+
+
+def sparse_to_dense(layer):
+    """
+    Creates a Dense layer with the same name and output as a SparseDense layer.
+    """
+    config = layer.get_config()
+    new_layer = tf.keras.layers.Dense(units=config['units'], activation=config['activation'], use_bias=config['use_bias'],
+                                      name=layer.name)
+    new_layer(layer.input)
+    new_layer.set_weights([layer.to_kernel()] + ([layer.bias0.numpy()] if layer.use_bias else []))
+    return new_layer
+
+
+def convert_sparse_layers(model, density_threshold=0.1, kernel_mode='sparse_matmul', input_shape=None):
+    """
+    Stores the kernel of a Dense layer as a SparseDense layer when its density (fraction of non-zero weights)
+    is at most density_threshold, and converts a SparseDense layer back to Dense when its density is above it.
+    The break-even density depends on the shape of the layer and the CPU; it can be measured with
+    benchmark_sparse_dense.py.
+    :param model: Keras model.
+    :param density_threshold: maximum density for a layer to be stored as sparse.
+    :param kernel_mode: kernel used by the SparseDense layers.
+    :return: new model and dictionary with the density of every converted layer.
+    """
+    logger = logging.getLogger(__name__)
+    new_layers = {}
+    converted = {}
+    for layer in model.layers:
+        if isinstance(layer, tf.keras.layers.Dense):
+            density = kernel_density(layer.get_weights()[0])
+            if density <= density_threshold:
+                logger.debug(f'Converting {layer.name} to sparse as it has a density of {density}.')
+                new_layers[layer.name] = dense_to_sparse(layer, kernel_mode)
+                converted[layer.name] = density
+        elif isinstance(layer, SparseDense):
+            density = layer.density()
+            if density > density_threshold:
+                logger.debug(f'Converting {layer.name} to dense as it has a density of {density}.')
+                new_layers[layer.name] = sparse_to_dense(layer)
+                converted[layer.name] = density
+
+    if not new_layers:
+        return model, converted
+
+    return rebuild_model(model, new_layers, input_shape), converted
+
+
+def fused_layer(layer):
+    """
+    Creates the Dense or Conv2D layer that computes the same output as a factorized layer (DenseSVD, TTDense,
+    ConvSVD, TuckerConv2D or MLPConv) with a single kernel. Quantized factorized layers are not fused, as the
+    fused kernel would be stored as float.
+    :return: new layer with the same name or None if the layer is not factorized.
+    """
+    if isinstance(layer, (QuantizedDenseSVD, QuantizedMLPConv)):
+        return None
+    if isinstance(layer, (DenseSVD, TTDense)):
+        if isinstance(layer, DenseSVD):
+            u, n, bias = layer.get_weights()
+            kernel = u @ n
+        else:
+            kernel, bias = layer.get_kernel().numpy(), layer.bias0.numpy()
+        new_layer = tf.keras.layers.Dense(units=layer.units, activation=layer.activation, name=layer.name)
+    elif isinstance(layer, (ConvSVD, TuckerConv2D, MLPConv)):
+        channels = layer.input_shape[-1]
+        if isinstance(layer, ConvSVD):
+            vertical, horizontal, bias = layer.get_weights()
+            kernel = np.einsum('hcr,wrf->hwcf', vertical[:, 0], horizontal[0])
+        elif isinstance(layer, TuckerConv2D):
+            kernel, bias = layer.get_kernel().numpy(), layer.bias.numpy()
+        else:
+            w_0, w_1, bias = layer.get_weights()
+            # The patches are flattened as (height, width, channels).
+            kernel = np.reshape(w_0 @ w_1, [layer.kernel_size[0], layer.kernel_size[1], channels, layer.filters])
+        new_layer = tf.keras.layers.Conv2D(filters=layer.filters, kernel_size=kernel.shape[:2], strides=layer.strides,
+                                           padding=layer.padding.lower(), activation=layer.activation, name=layer.name)
+    else:
+        return None
+
+    new_layer(layer.input)
+    new_layer.set_weights([kernel, bias])
+    return new_layer
+
+
+def fuse_factorized_layers(model, criterion='flops', always=False, batch_size=1, input_shape=None):
+    """
+    Replaces every factorized layer by a layer with a single kernel when it is faster. A factorization of rank r
+    of an M x N kernel only needs fewer weights and FLOPs than the kernel if (M + N) * r < M * N, and even below
+    that rank, two small products can be slower on CPU than a single one. Fusing also removes the intermediate
+    tensor of the factorization.
+    :param model: Keras model.
+    :param criterion: 'flops' compares the FLOPs estimated by the cost model, 'latency' measures the CPU latency
+    of both layers with benchmark.layer_latency.
+    :param always: fuse the layers even if they are slower, e.g. for runtimes without efficient small matmuls.
+    :param batch_size: batch size of the latency measurements.
+    :return: new model and dictionary with the weights, bytes and FLOPs (and latency if measured) before and
+    after fusing of every fused layer, so the weights of the new model are those of the model minus the
+    difference of the fused layers.
+    """
+    assert criterion in ['flops', 'latency']
+    logger = logging.getLogger(__name__)
+    new_layers = {}
+    fused = {}
+    for layer in model.layers:
+        new_layer = fused_layer(layer)
+        if new_layer is None:
+            continue
+        before, after = current_layer_cost(layer), current_layer_cost(new_layer)
+        if criterion == 'latency':
+            before['latency'] = layer_latency(layer, batch_size)
+            after['latency'] = layer_latency(new_layer, batch_size)
+        if always or after[criterion] <= before[criterion]:
+            logger.debug(f'Fusing {layer.name}, {criterion} goes from {before[criterion]} to {after[criterion]}.')
+            new_layers[layer.name] = new_layer
+            fused[layer.name] = {'before': before, 'after': after}
+
+    if not new_layers:
+        return model, fused
+
+    return rebuild_model(model, new_layers, input_shape), fused
+
+
+def block_shifts(block_mask):
+    """
+    Returns the shifts k for which some block (i, (i + k) mod groups) of a mask of blocks is connected.
+    """
+    groups = block_mask.shape[0]
+    return [k for k in range(groups) if any(block_mask[i, (i + k) % groups] for i in range(groups))]
+
+
+def find_connection_blocks(layer):
+    """
+    Finds the number of groups for which the connections of a SparseConnectionsConv2D layer are made of whole
+    (channels group, filters group) blocks and the grouped convolutions of their shifts need the fewest FLOPs.
+    :return: groups and (groups, groups) mask of the blocks, or None if there are no such groups.
+    """
+    channels, filters = layer.connections.shape
+    connections = layer.get_connections()
+    best = None
+    for groups in range(2, math.gcd(channels, filters) + 1):
+        block_mask = connection_blocks(connections, channels, filters, groups)
+        if block_mask is None:
+            continue
+        # Fraction of the dense FLOPs and number of convolutions.
+        cost = (len(block_shifts(block_mask)) / groups, len(block_shifts(block_mask)))
+        if best is None or cost < best[0]:
+            best = (cost, groups, block_mask)
+    if best is None:
+        return None
+    return best[1], best[2]
+
+
+def sparse_connections_to_grouped(layer):
+    """
+    Creates grouped Conv2D layers with the same output as a SparseConnectionsConv2D layer whose connections are
+    made of blocks. The blocks (i, (i + k) mod groups) of a shift k are the groups of a grouped convolution of the
+    input whose channel groups are rolled by k, so the layer is the sum of a grouped convolution per shift with
+    connected blocks.
+    :return: Conv2D layer if only the block diagonal is connected, Keras model with a grouped Conv2D per shift if
+    several shifts are connected, or None if the connections are not made of blocks or every shift is connected.
+    """
+    blocks = find_connection_blocks(layer)
+    if blocks is None:
+        return None
+    groups, block_mask = blocks
+    shifts = block_shifts(block_mask)
+    if len(shifts) == groups:
+        return None
+
+    kernel, bias = layer.get_kernel().numpy(), layer.bias.numpy()
+    kh, kw, channels, filters = kernel.shape
+    group_channels, group_filters = channels // groups, filters // groups
+    conv_kwargs = {'filters': filters, 'kernel_size': (kh, kw), 'strides': layer.strides, 'padding': layer.padding,
+                   'dilation_rate': layer.dilation_rate, 'groups': groups}
+    if shifts == [0]:
+        new_layer = tf.keras.layers.Conv2D(activation='relu', name=layer.name, **conv_kwargs)
+        new_layer(layer.input)
+        new_layer.set_weights([np.concatenate([kernel[:, :, i*group_channels:(i+1)*group_channels, i*group_filters:(i+1)*group_filters]
+                                               for i in range(groups)], axis=-1), bias])
+        return new_layer
+
+    inputs = tf.keras.layers.Input(layer.input_shape[1:])
+    outputs = []
+    for k in shifts:
+        # After rolling the channels by k groups, the j-th group of channels is the (j - k)-th group of the input.
+        group_kernel = np.concatenate([kernel[:, :, ((j-k) % groups)*group_channels:((j-k) % groups + 1)*group_channels, j*group_filters:(j+1)*group_filters]
+                                       for j in range(groups)], axis=-1)
+        x = tf.roll(inputs, shift=k * group_channels, axis=-1) if k > 0 else inputs
+        conv = tf.keras.layers.Conv2D(use_bias=not outputs, name=f'{layer.name}_shift{k}', **conv_kwargs)
+        outputs.append(conv(x))
+        conv.set_weights([group_kernel, bias] if len(outputs) == 1 else [group_kernel])
+    x = tf.keras.layers.Add()(outputs)
+    x = tf.keras.layers.Activation('relu')(x)
+    return tf.keras.Model(inputs, x, name=layer.name)
+
+
+def convert_sparse_connections(model, input_shape=None):
+    """
+    Replaces every SparseConnectionsConv2D layer whose connections are made of blocks by grouped Conv2D layers
+    (see sparse_connections_to_grouped). Grouped convolutions on CPU need a recent TensorFlow.
+    :param model: Keras model.
+    :return: new model and dictionary with the number of groups and the fraction of the FLOPs of the dense
+    kernel of every converted layer.
+    """
+    logger = logging.getLogger(__name__)
+    new_layers = {}
+    converted = {}
+    for layer in model.layers:
+        if not isinstance(layer, SparseConnectionsConv2D):
+            continue
+        new_layer = sparse_connections_to_grouped(layer)
+        if new_layer is None:
+            continue
+        groups = find_connection_blocks(layer)[0]
+        convs = [new_layer] if isinstance(new_layer, tf.keras.layers.Conv2D) else [l for l in new_layer.layers if isinstance(l, tf.keras.layers.Conv2D)]
+        converted[layer.name] = (groups, len(convs) / groups)
+        logger.debug(f'Converting {layer.name} to {len(convs)} convolutions with {groups} groups.')
+        new_layers[layer.name] = new_layer
+
+    if not new_layers:
+        return model, converted
+
+    return rebuild_model(model, new_layers, input_shape), converted
@@ -0,0 +1,125 @@
+import os
+import json
+import hashlib
+import logging
+from CompressionLibrary.storage import save_compressed, load_compressed
+
+# Content-addressed cache of compressed models. A compressed model is identified by the hash of the model it was
+# compressed from (architecture and weights) and the plan that was applied to it, a list of
+# (layer_name, compressor, params) as in cost_model.dry_run. Every entry is stored as
+#   root/<key[:2]>/<key>.mcrl   model saved with storage.save_compressed
+#   root/<key[:2]>/<key>.json   base model hash, plan and the info given when it was stored (e.g. its stats)
+
+
+def model_hash(model):
+    """
+    Returns the SHA-256 of the architecture and the weights of a Keras model.
+    """
+    digest = hashlib.sha256(model.to_json().encode('utf-8'))
+    for weight in model.weights:
+        value = weight.numpy()
+        digest.update(f'{weight.name}:{value.dtype.str}:{value.shape}'.encode('utf-8'))
+        digest.update(value.tobytes())
+    return digest.hexdigest()
+
+
+def _json_default(value):
+    # Numpy arrays and scalars are stored as lists and numbers. Other values (datasets, callbacks, etc.) have no
+    # canonical JSON, and keying them by their type would give the same key to plans with different values, so
+    # they are rejected and must be passed to the compressors outside the plan (e.g. to apply_plan).
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError(f'Value of type {type(value).__name__} in a plan is not JSON serializable.')
+
+
+def plan_to_json(plan):
+    """
+    Returns the canonical JSON of a plan, so equal plans have the same key.
+    :raises TypeError: if a param is not JSON serializable.
+    """
+    steps = []
+    for layer_name, compressor, params in plan:
+        if not isinstance(compressor, str):
+            compressor = compressor.__name__
+        steps.append([layer_name, compressor, params])
+    return json.dumps(steps, sort_keys=True, default=_json_default)
+
+
+class ModelStore:
+    """
+    On-disk store of compressed models keyed by (base model hash, plan).
+    """
+
+    def __init__(self, root='./data/model_store'):
+        self.root = root
+        self.logger = logging.getLogger(__name__)
+
+    def key(self, base_model, plan):
+        """
+        :param base_model: Keras model or its hash returned by model_hash. Passing the hash avoids reading the
+        weights of the base model on every lookup.
+        :param plan: list of (layer_name, compressor, params).
+        """
+        base_hash = base_model if isinstance(base_model, str) else model_hash(base_model)
+        return hashlib.sha256((base_hash + plan_to_json(plan)).encode('utf-8')).hexdigest()
+
+    def path(self, key, extension='.mcrl'):
+        return os.path.join(self.root, key[:2], key + extension)
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, base_model, plan):
+        """
+        Returns the compressed model, which is not compiled, or None if it is not in the store.
+        """
+        key = self.key(base_model, plan)
+        if key not in self:
+            return None
+        self.logger.debug(f'Loading compressed model {key}.')
+        return load_compressed(self.path(key))
+
+    def get_info(self, base_model, plan):
+        """
+        Returns the metadata of an entry or None if it is not in the store.
+        """
+        path = self.path(self.key(base_model, plan), '.json')
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def put(self, base_model, plan, compressed_model, info=None):
+        """
+        Stores a compressed model. The files are written to a temporary file and renamed, so concurrent
+        readers never see a partial entry.
+        :param info: optional JSON serializable dictionary stored with the entry.
+        :return: key of the entry.
+        """
+        base_hash = base_model if isinstance(base_model, str) else model_hash(base_model)
+        key = self.key(base_hash, plan)
+        os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+
+        metadata = {'base_model': base_hash, 'plan': json.loads(plan_to_json(plan)), 'info': info}
+        for extension, write in [('.json', lambda f: f.write(json.dumps(metadata, default=_json_default).encode('utf-8'))),
+                                 ('.mcrl', lambda f: save_compressed(compressed_model, f))]:
+            path = self.path(key, extension)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                write(f)
+            os.replace(tmp_path, path)
+
+        self.logger.debug(f'Stored compressed model {key}.')
+        return key
+
+    def entries(self):
+        """
+        Yields the metadata of every entry of the store.
+        """
+        if not os.path.isdir(self.root):
+            return
+        for directory in sorted(os.listdir(self.root)):
+            for file_name in sorted(os.listdir(os.path.join(self.root, directory))):
+                if file_name.endswith('.json'):
+                    with open(os.path.join(self.root, directory, file_name)) as f:
+                        yield dict(json.load(f), key=file_name[:-len('.json')])
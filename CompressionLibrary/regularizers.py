@@ -1,6 +1,7 @@
 import tensorflow as tf
 
 
+@tf.keras.utils.register_keras_serializable()
 class L1L2SRegularizer(tf.keras.regularizers.Regularizer):
 
     def __init__(self, l1=0.0, l2=0.0):
@@ -11,4 +11,18 @@ def reward_MnasNet(stats: dict) -> float:
    return stats['accuracy_after'] * (1 - (stats['weights_after']/stats['weights_before']))
 
 def reward_MnasNet_penalty(stats: dict) -> float:
-   return stats['accuracy_after'] * (1 - (stats['weights_after']/stats['weights_before'])) if stats['accuracy_after'] > 0.9 * stats['accuracy_before'] else 0.0
\ No newline at end of file
+   return stats['accuracy_after'] * (1 - (stats['weights_after']/stats['weights_before'])) if stats['accuracy_after'] > 0.9 * stats['accuracy_before'] else 0.0
+
+def reward_MnasNet_bytes(stats: dict) -> float:
+   return stats['accuracy_after'] * (1 - (stats['bytes_after']/stats['bytes_before']))
+
+def reward_MnasNet_flops(stats: dict) -> float:
+   return stats['accuracy_after'] * (1 - (stats['flops_after']/stats['flops_before']))
+
+def reward_MnasNet_latency(stats: dict) -> float:
+   if stats.get('latency_before') is None or stats.get('latency_after') is None:
+      raise ValueError('reward_MnasNet_latency needs the latency of the models, create the environment with measure_latency=True.')
+   return stats['accuracy_after'] * (1 - (stats['latency_after']/stats['latency_before']))
+
+# Rewards that use the latency of the models, which the environments only measure if measure_latency is True.
+latency_rewards = (reward_MnasNet_latency,)
@@ -0,0 +1,192 @@
+import io
+import json
+import struct
+import zlib
+import numpy as np
+import tensorflow as tf
+import logging
+# Registers the custom layers so that the models can be created from their config.
+import CompressionLibrary.custom_layers
+
+# File format:
+#   MAGIC | version (uint8) | header length (uint32) | JSON header | tensor payloads
+# The header has the architecture of the model (model.to_json()) and, for every weight in the order of
+# model.weights, its dtype, shape, encoding and the position of its payload relative to the end of the header.
+# Integer tensors (cluster indices, int8 kernels, sparse indices) are bit packed with the number of bits needed
+# by their range. Every payload is then compressed with DEFLATE, which Huffman codes the symbols.
+MAGIC = b'MCRL'
+VERSION = 1
+_PREFIX = struct.Struct('<4sBI')
+
+
+# Number of values packed or unpacked at a time. It is a multiple of 8, so every chunk starts at a byte and the
+# temporary bit matrices have at most 64 bytes per value of the chunk instead of per value of the tensor.
+_CHUNK_VALUES = 1 << 16
+
+
+def pack_bits(values, bits):
+    """
+    Packs non-negative integers using bits bits per value, from the least significant bit of every value.
+    """
+    values = values.ravel()
+    chunks = []
+    for start in range(0, values.size, _CHUNK_VALUES):
+        chunk = values[start:start + _CHUNK_VALUES]
+        if bits <= 8:
+            bit_matrix = np.unpackbits(chunk.astype(np.uint8)[:, None], axis=1, bitorder='little')[:, :bits]
+        else:
+            chunk = chunk.astype(np.uint64)
+            bit_matrix = np.empty((chunk.size, bits), dtype=np.uint8)
+            for bit in range(bits):
+                bit_matrix[:, bit] = (chunk >> np.uint64(bit)) & np.uint64(1)
+        chunks.append(np.packbits(bit_matrix.ravel()).tobytes())
+    return b''.join(chunks)
+
+
+def unpack_bits(buffer, bits, count):
+    """
+    Inverse of pack_bits.
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    values = np.empty(count, dtype=np.uint8 if bits <= 8 else np.uint64)
+    for start in range(0, count, _CHUNK_VALUES):
+        size = min(_CHUNK_VALUES, count - start)
+        chunk = data[start * bits // 8:(start * bits + size * bits + 7) // 8]
+        bit_matrix = np.unpackbits(chunk, count=size * bits).reshape(size, bits)
+        if bits <= 8:
+            values[start:start + size] = np.packbits(bit_matrix, axis=1, bitorder='little')[:, 0]
+        else:
+            chunk_values = np.zeros(size, dtype=np.uint64)
+            for bit in range(bits):
+                chunk_values |= bit_matrix[:, bit].astype(np.uint64) << np.uint64(bit)
+            values[start:start + size] = chunk_values
+    return values
+
+
+def encode_tensor(array, compression_level=9):
+    """
+    Encodes a tensor as bytes.
+    :return: metadata needed to decode it and the payload.
+    """
+    array = np.asarray(array)
+    meta = {'dtype': array.dtype.str, 'shape': list(array.shape), 'encoding': 'raw'}
+    if np.issubdtype(array.dtype, np.integer) and array.size > 0:
+        offset = int(array.min())
+        bits = max(1, (int(array.max()) - offset).bit_length())
+        if bits < array.dtype.itemsize * 8:
+            meta.update({'encoding': 'bitpack', 'bits': bits, 'offset': offset})
+            data = pack_bits(array.astype(np.int64) - offset, bits)
+            return meta, zlib.compress(data, compression_level)
+
+    return meta, zlib.compress(array.tobytes(), compression_level)
+
+
+def decode_tensor(meta, payload):
+    """
+    Inverse of encode_tensor.
+    """
+    data = zlib.decompress(payload)
+    dtype = np.dtype(meta['dtype'])
+    count = int(np.prod(meta['shape']))
+    if meta['encoding'] == 'bitpack':
+        values = unpack_bits(data, meta['bits'], count).astype(np.int64) + meta['offset']
+        return values.astype(dtype).reshape(meta['shape'])
+    return np.frombuffer(data, dtype=dtype, count=count).reshape(meta['shape'])
+
+
+def save_compressed(model, file, compression_level=9):
+    """
+    Saves the architecture and the weights of a model in the compressed format.
+    :param model: Keras model. Its layers must be serializable.
+    :param file: path or binary file-like object.
+    :param compression_level: DEFLATE level of the payloads.
+    :return: number of bytes written.
+    """
+    logger = logging.getLogger(__name__)
+    tensors = []
+    payloads = []
+    position = 0
+    for weight in model.weights:
+        meta, payload = encode_tensor(weight.numpy(), compression_level)
+        meta.update({'name': weight.name, 'position': position, 'length': len(payload)})
+        logger.debug(f'Weight {weight.name} uses {weight.shape.num_elements() * weight.dtype.size} bytes and {len(payload)} compressed.')
+        tensors.append(meta)
+        payloads.append(payload)
+        position += len(payload)
+
+    header = json.dumps({'model': model.to_json(), 'tensors': tensors}).encode('utf-8')
+    contents = [_PREFIX.pack(MAGIC, VERSION, len(header)), header] + payloads
+
+    if isinstance(file, (str, bytes)) or hasattr(file, '__fspath__'):
+        with open(file, 'wb') as f:
+            for content in contents:
+                f.write(content)
+    else:
+        for content in contents:
+            file.write(content)
+
+    return sum(len(content) for content in contents)
+
+
+class CompressedArchive:
+    """
+    Reads a file saved with save_compressed. Only the header is read when it is opened, every tensor is read and
+    decoded when it is requested, so a model can be loaded without keeping all the decoded weights in memory.
+    """
+
+    def __init__(self, file):
+        if isinstance(file, (str, bytes)) or hasattr(file, '__fspath__'):
+            self.file = open(file, 'rb')
+            self.owns_file = True
+        else:
+            self.file = file
+            self.owns_file = False
+        magic, version, header_length = _PREFIX.unpack(self.file.read(_PREFIX.size))
+        if magic != MAGIC:
+            raise ValueError('File is not a compressed model.')
+        if version != VERSION:
+            raise ValueError(f'Version {version} of the format is not supported.')
+        self.header = json.loads(self.file.read(header_length).decode('utf-8'))
+        self.data_start = _PREFIX.size + header_length
+        self.tensors = self.header['tensors']
+
+    def __len__(self):
+        return len(self.tensors)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.owns_file:
+            self.file.close()
+
+    def get_tensor(self, index):
+        meta = self.tensors[index]
+        self.file.seek(self.data_start + meta['position'])
+        return decode_tensor(meta, self.file.read(meta['length']))
+
+    def load_model(self):
+        model = tf.keras.models.model_from_json(self.header['model'])
+        if len(model.weights) != len(self.tensors):
+            raise ValueError(f'Model has {len(model.weights)} weights but the file has {len(self.tensors)}.')
+        for index, weight in enumerate(model.weights):
+            weight.assign(self.get_tensor(index))
+        return model
+
+
+def load_compressed(file):
+    """
+    Loads a model saved with save_compressed.
+    """
+    with CompressedArchive(file) as archive:
+        return archive.load_model()
+
+
+def compressed_size(model, compression_level=9):
+    """
+    Returns the number of bytes of the model saved with save_compressed.
+    """
+    return save_compressed(model, io.BytesIO(), compression_level)
@@ -3,7 +3,12 @@ import tensorflow as tf
 from functools import partial
 import numpy as np
 import pandas as pd
-from CompressionLibrary.custom_layers import SparseSVD, SparseConnectionsConv2D, SparseConvolution2D
+from CompressionLibrary.custom_layers import SparseSVD, SparseConnectionsConv2D, SparseConvolution2D, SparseDense
+from CompressionLibrary.benchmark import variables_bytes, model_latency
+from CompressionLibrary.cost_model import model_flops
+from CompressionLibrary.xla import compile_model
+from CompressionLibrary.custom_layers import QuantizedDense, QuantizedConv2D, QuantizedDenseSVD, QuantizedMLPConv, ClusteredDense, ClusteredConv2D
+from CompressionLibrary.custom_layers import HashedDense, HashedConv2D
 import tensorflow.keras.backend as K
 import logging
 
@@ -129,7 +134,19 @@ def calculate_model_weights(model):
     # Set layer to trainable to calculate number of parameters.
     layer.trainable = True
     
-    if 'DeepComp' in layer.name:
+    if isinstance(layer, SparseDense):
+      # The indices are not counted, and layers without bias only have values and indices.
+      weights_after = layer.values.shape.num_elements() + (layer.units if layer.use_bias else 0)
+    elif isinstance(layer, (QuantizedDense, QuantizedConv2D, QuantizedDenseSVD, QuantizedMLPConv)):
+      # The int8 kernels are not trainable and the scales are not counted as weights.
+      weights_after = int(np.sum([K.count_params(w) for w in layer.weights if 'scale' not in w.name]))
+    elif isinstance(layer, (ClusteredDense, ClusteredConv2D)):
+      # Weights are ordered as centroids, bias and indices.
+      weights_after = np.count_nonzero(layer.get_kernel().numpy()) + K.count_params(layer.weights[1])
+    elif isinstance(layer, (HashedDense, HashedConv2D)):
+      # Only the buckets and the bias are stored, the virtual kernel is computed from them.
+      weights_after = layer.num_buckets + K.count_params(layer.weights[1])
+    elif 'DeepComp' in layer.name:
       weights, _ = layer.get_weights()
       num_zeroes = tf.math.count_nonzero(tf.abs(weights) == 0.0).numpy()
       weights_before = np.sum([K.count_params(w) for w in layer.trainable_weights])
@@ -163,6 +180,44 @@ def calculate_model_weights(model):
   logger.debug(f'Model has {total_weights} weights.')
   return total_weights
 
+def calculate_model_bytes(model):
+  """
+  Returns the number of bytes used to store the weights of the model, taking into account their data type.
+  Unlike calculate_model_weights, it counts what is actually stored (e.g. int8 kernels, sparse indices or the
+  zeroes of pruned kernels).
+  """
+  total_bytes = 0
+  logger = logging.getLogger(__name__)
+  for layer in model.layers:
+    layer_bytes = variables_bytes(layer)
+    logger.debug(f'Layer {layer.name} uses {layer_bytes} bytes.')
+    total_bytes += layer_bytes
+
+  logger.debug(f'Model uses {total_bytes} bytes.')
+  return total_bytes
+
+def calculate_model_flops(model):
+  """
+  Returns the FLOPs of a forward pass of one sample through the model.
+  """
+  total_flops, layers_flops = model_flops(model)
+  logger = logging.getLogger(__name__)
+  for layer_name, flops in layers_flops.items():
+    logger.debug(f'Layer {layer_name} uses {flops} FLOPs.')
+  logger.debug(f'Model uses {total_flops} FLOPs.')
+  return total_flops
+
+def calculate_model_latency(model, batch_size=1):
+  """
+  Returns the CPU latency of the model in milliseconds, measured per layer and cached by layer config.
+  """
+  total_latency, layers_latency = model_latency(model, batch_size)
+  logger = logging.getLogger(__name__)
+  for layer_name, latency in layers_latency.items():
+    logger.debug(f'Layer {layer_name} takes {latency} ms.')
+  logger.debug(f'Model takes {total_latency} ms.')
+  return total_latency
+
 def extract_model_parts(model):
   layers = []
   configs = []
@@ -175,7 +230,7 @@ def extract_model_parts(model):
   assert len(layers)== len(configs) and len(layers) == len(weights)
   return layers, configs, weights
 
-def create_model_from_parts(layers, configs, weights,optimizer, loss, metric, input_shape=(224,224,3)):
+def create_model_from_parts(layers, configs, weights,optimizer, loss, metric, input_shape=(224,224,3), jit_compile=False):
   first_conv_idx = 0
   if not isinstance(layers[0], tf.keras.layers.Conv2D):
     first_conv_idx = 1
@@ -192,7 +247,7 @@ def create_model_from_parts(layers, configs, weights,optimizer, loss, metric, in
     new_layer.set_weights(weights[first_conv_idx+idx])
 
   model = tf.keras.Model(input, x)
-  model.compile(optimizer, loss, metric)
+  compile_model(model, optimizer, loss, metric, jit_compile)
   return model
 
 
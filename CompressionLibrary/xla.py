@@ -0,0 +1,86 @@
+import json
+import logging
+import tensorflow as tf
+
+# Opt-in XLA compilation of the models. Keras compiles the train, test and predict steps of a model with XLA when
+# it is compiled with jit_compile=True, which fuses the chains of small ops of the factorized layers, but the whole
+# step fails if a single layer uses an op without an XLA kernel (sparse ops, ops whose output shape depends on the
+# values of a tensor, etc.). compile_model first checks that every layer can be compiled and otherwise compiles the
+# model without XLA. Checking a layer compiles it, so the results are cached by the type, config and input shape of
+# the layers and the models created in every episode of the environments are only checked once.
+
+# Whether a layer can be compiled with XLA, indexed by its signature.
+_jit_cache = {}
+
+
+def layer_signature(layer):
+    """
+    Returns a key that is equal for layers of the same type, config (without the name) and input shape.
+    """
+    config = layer.get_config().copy()
+    config.pop('name', None)
+    return type(layer).__name__, json.dumps(config, sort_keys=True, default=str), json.dumps(layer.input_shape)
+
+
+def layer_supports_jit(layer, batch_size=2):
+    """
+    Returns whether the forward pass of a built layer and its gradients can be compiled with XLA. The layer is
+    called with training=False, so layers with state (e.g. BatchNormalization) are not modified.
+    """
+    if isinstance(layer, tf.keras.layers.InputLayer):
+        return True
+
+    key = layer_signature(layer)
+    if key not in _jit_cache:
+        # Layers with several inputs have a list of shapes. Unknown dimensions other than the batch are set to 8.
+        input_shapes = layer.input_shape if isinstance(layer.input_shape, list) else [layer.input_shape]
+        inputs = [tf.random.uniform((batch_size,) + tuple(8 if dim is None else dim for dim in shape[1:]))
+                  for shape in input_shapes]
+        if not isinstance(layer.input_shape, list):
+            inputs = inputs[0]
+
+        @tf.function(jit_compile=True)
+        def forward_backward(x):
+            with tf.GradientTape() as tape:
+                tape.watch(x)
+                outputs = layer(x, training=False)
+            return tape.gradient(outputs, [x, layer.trainable_weights])
+
+        try:
+            with tf.device('/CPU:0'):
+                forward_backward(inputs)
+            _jit_cache[key] = True
+        except Exception as e:
+            logging.getLogger(__name__).debug(f'Layer {layer.name} cannot be compiled with XLA: {e}')
+            _jit_cache[key] = False
+    return _jit_cache[key]
+
+
+def unsupported_layers(model):
+    """
+    Returns the names of the layers of a model that cannot be compiled with XLA.
+    """
+    return [layer.name for layer in model.layers if not layer_supports_jit(layer)]
+
+
+def compile_model(model, optimizer, loss, metrics, jit_compile=False):
+    """
+    Compiles a Keras model, with XLA if jit_compile is True and every layer can be compiled.
+    :return: whether the model was compiled with XLA.
+    """
+    if jit_compile:
+        unsupported = unsupported_layers(model)
+        if unsupported:
+            logging.getLogger(__name__).info(f'Layers {unsupported} cannot be compiled with XLA, compiling {model.name} without it.')
+            jit_compile = False
+    model.compile(optimizer=optimizer, loss=loss, metrics=metrics, jit_compile=jit_compile)
+    return jit_compile
+
+
+def recompile_model(model, jit_compile=True):
+    """
+    Compiles a compiled Keras model again, with XLA if jit_compile is True and every layer can be compiled,
+    keeping the optimizer, loss and metrics it was compiled with.
+    :return: whether the model was compiled with XLA.
+    """
+    return compile_model(model, model.optimizer, model.loss, model.compiled_metrics._user_metrics, jit_compile)
@@ -0,0 +1,34 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import tensorflow as tf
+
+from CompressionLibrary.utils import load_and_normalize_dataset, create_lenet_model
+from CompressionLibrary.CompressionTechniques import InsertDenseSVD, InsertSVDConv, apply_plan
+from CompressionLibrary.export import compare_models
+
+# Exports LeNet and a compressed version of it as SavedModel and TFLite and compares their CPU latency,
+# throughput and size for several batch sizes and numbers of threads.
+
+save_name = './data/stats/benchmark_export.csv'
+export_dir = './data/export/lenet_mnist'
+
+dataset_name = 'mnist'
+batch_size = 32
+plan = [('conv2d_1', InsertSVDConv, {}), ('dense', InsertDenseSVD, {})]
+batch_sizes = (1, 8, 32)
+threads = (1, 2, 4)
+
+if __name__ == '__main__':
+    train_ds, valid_ds, test_ds, input_shape, num_classes = load_and_normalize_dataset(dataset_name, batch_size)
+    optimizer = tf.keras.optimizers.Adam(1e-5)
+    loss_object = tf.keras.losses.SparseCategoricalCrossentropy()
+    train_metric = tf.keras.metrics.SparseCategoricalAccuracy()
+
+    model = create_lenet_model(dataset_name, train_ds, valid_ds)
+    compressed_model = apply_plan(model, plan, dataset=train_ds, optimizer=optimizer, loss=loss_object,
+                                  metrics=train_metric, fine_tuning=False, input_shape=input_shape)
+
+    report = compare_models(model, compressed_model, export_dir, batch_sizes=batch_sizes, threads=threads,
+                            save_name=save_name)
+    print(report.to_string())
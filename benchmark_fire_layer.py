@@ -0,0 +1,63 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import tensorflow as tf
+import pandas as pd
+
+from CompressionLibrary.benchmark import time_function
+from CompressionLibrary.custom_layers import FireLayer
+
+# Compares the latency of the separate and fused kernels of FireLayer against the previous implementation, which
+# created Keras layers when called, and against the Conv2D layer it replaces. The previous implementation applied
+# the strides twice, so it is only compared (and checked against FireLayer) with stride 1.
+
+save_name = './data/stats/benchmark_fire_layer.csv'
+
+# (height, width, channels, filters, strides) of LeNet and VGG16 convolutions.
+layer_shapes = [(28, 28, 1, 6, 1), (14, 14, 6, 16, 1), (112, 112, 64, 128, 1), (56, 56, 128, 256, 1),
+                (28, 28, 256, 512, 1), (56, 56, 128, 256, 2)]
+kernel_size = (3, 3)
+batch_sizes = [1, 8]
+repeats = 20
+
+
+def separate_expansions(layer, inputs):
+    """
+    Previous FireLayer forward pass, without the Cropping2D layer that was only created for 5x5 VALID kernels.
+    """
+    x = tf.nn.conv2d(inputs, layer.kernel_squeeze, strides=layer.strides, padding='SAME')
+    o3x3 = tf.nn.conv2d(x, layer.kernel_expand3x3, strides=layer.strides, padding=layer.padding)
+    o1x1 = tf.nn.conv2d(x, layer.kernel_expand1x1, strides=layer.strides, padding='VALID')
+    x = tf.concat([o1x1, o3x3], axis=3)
+    return layer.activation(tf.nn.bias_add(x, layer.bias))
+
+
+results = []
+for height, width, channels, filters, strides in layer_shapes:
+    x = tf.random.normal(shape=(1, height, width, channels))
+    fire = FireLayer(squeeze_filters=max(1, filters // 4), filters=filters, kernel_size=kernel_size, strides=strides)
+    fused_fire = FireLayer.from_config(dict(fire.get_config(), kernel_mode='fused'))
+    conv = tf.keras.layers.Conv2D(filters, kernel_size, strides=strides, padding='same', activation='relu')
+    for layer in [fire, fused_fire, conv]:
+        layer(x)
+    fused_fire.set_weights(fire.get_weights())
+    functions = {'fire_separate': tf.function(fire), 'fire_fused': tf.function(fused_fire), 'conv2d': tf.function(conv)}
+    if strides == 1:
+        functions['fire_previous'] = tf.function(lambda inputs: separate_expansions(fire, inputs))
+
+    for batch_size in batch_sizes:
+        x = tf.random.normal(shape=(batch_size, height, width, channels))
+        tf.debugging.assert_near(functions['fire_separate'](x), functions['fire_fused'](x), rtol=1e-4, atol=1e-3)
+        if strides == 1:
+            tf.debugging.assert_near(functions['fire_separate'](x), functions['fire_previous'](x), rtol=1e-4, atol=1e-3)
+        for name, fn in functions.items():
+            row = {'height': height, 'width': width, 'channels': channels, 'filters': filters, 'strides': strides,
+                   'batch_size': batch_size, 'layer': name}
+            row.update(time_function(fn, x, repeats=repeats))
+            results.append(row)
+            print(row)
+
+df = pd.DataFrame(results)
+os.makedirs(os.path.dirname(save_name), exist_ok=True)
+df.to_csv(save_name, index=False)
+print(df.pivot_table(index=['height', 'channels', 'filters', 'strides', 'batch_size'], columns='layer', values='p50_ms'))
@@ -0,0 +1,70 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+from datetime import datetime
+import tensorflow as tf
+import pandas as pd
+
+from CompressionLibrary.utils import load_and_normalize_dataset, create_lenet_model
+from CompressionLibrary.CompressionTechniques import DepthwiseSeparableConvolution, FireLayerCompression
+
+# Measures how many fine-tuning epochs the least squares initialization of DepthwiseSeparableConvolution and
+# FireLayerCompression saves against a random initialization. After compressing a layer, the model is fine-tuned
+# one epoch at a time until its validation accuracy is within tolerance of the accuracy of the original model.
+
+save_name = './data/stats/benchmark_layer_initialization.csv'
+
+dataset_name = 'mnist'
+batch_size = 32
+layer_names = ['conv2d', 'conv2d_1']
+compressors = [DepthwiseSeparableConvolution, FireLayerCompression]
+initializations = ['random', 'least_squares']
+max_epochs = 10
+tolerance = 0.01
+
+train_ds, valid_ds, test_ds, input_shape, num_classes = load_and_normalize_dataset(dataset_name, batch_size)
+optimizer = tf.keras.optimizers.Adam(1e-5)
+loss_object = tf.keras.losses.SparseCategoricalCrossentropy()
+train_metric = tf.keras.metrics.SparseCategoricalAccuracy()
+
+model = create_lenet_model(dataset_name, train_ds, valid_ds)
+_, original_accuracy = model.evaluate(valid_ds, verbose=0)
+target_accuracy = original_accuracy - tolerance
+print(f'Original accuracy is {original_accuracy}.')
+
+results = []
+for layer_name in layer_names:
+    for compressor_class in compressors:
+        for initialization in initializations:
+            compressor = compressor_class(model=model, dataset=train_ds, optimizer=optimizer, loss=loss_object, metrics=train_metric,
+                                          fine_tuning=False, input_shape=input_shape)
+            start_time = datetime.now()
+            compressor.compress_layer(layer_name, initialization=initialization, calibration_dataset=train_ds)
+            compression_time = (datetime.now() - start_time).total_seconds()
+
+            compressed_model = compressor.get_model()
+            _, accuracy = compressed_model.evaluate(valid_ds, verbose=0)
+            row = {'layer': layer_name, 'compressor': compressor_class.__name__, 'initialization': initialization,
+                   'compression_secs': compression_time, 'reconstruction_mse': compressor.reconstruction_mse,
+                   'initial_accuracy': accuracy, 'epochs_to_target': None}
+            for epoch in range(1, max_epochs + 1):
+                if accuracy >= target_accuracy:
+                    row['epochs_to_target'] = epoch - 1
+                    break
+                compressed_model.fit(train_ds, epochs=1, verbose=0)
+                _, accuracy = compressed_model.evaluate(valid_ds, verbose=0)
+            else:
+                if accuracy >= target_accuracy:
+                    row['epochs_to_target'] = max_epochs
+            row['final_accuracy'] = accuracy
+            results.append(row)
+            print(row)
+
+df = pd.DataFrame(results)
+os.makedirs(os.path.dirname(save_name), exist_ok=True)
+df.to_csv(save_name, index=False)
+epochs = df.pivot_table(index=['layer', 'compressor'], columns='initialization', values='epochs_to_target')
+# Layers that did not reach the target count as max_epochs + 1.
+epochs = epochs.reindex(columns=initializations).fillna(max_epochs + 1)
+epochs['epochs_saved'] = epochs['random'] - epochs['least_squares']
+print(epochs)
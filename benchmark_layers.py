@@ -0,0 +1,145 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import sys
+import json
+import platform
+import subprocess
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+# Micro-benchmarks of the custom layers against the Dense or Conv2D layer (or the pooling layer) they replace, on
+# the shapes of LeNet and VGG16 layers. Every layer is timed for inference (forward) and training (forward and
+# gradients of the inputs and weights) for every batch size and number of threads, and the peak memory allocated
+# by TensorFlow during the measurement is recorded. The number of threads can only be set before TensorFlow is
+# initialized, so every number of threads is measured in a new Python process:
+#   python benchmark_layers.py                 runs the suite and saves the results as CSV and JSON
+#   python benchmark_layers.py '<json args>'   worker that measures one number of threads
+# The JSON file also has the versions and the machine, so results of different commits can be compared.
+
+save_name = './data/stats/benchmark_layers.csv'
+
+# (features, units) of dense layers, (height, width, channels, filters) of 3x3 convolutions and the shape of the
+# feature maps embedded by ROIEmbedding and ROIEmbedding1D (as a sequence of pixels).
+architectures = {
+    'lenet': {'dense': (400, 120), 'conv': (14, 14, 6, 16), 'feature_map': (10, 10, 16)},
+    'vgg16': {'dense': (4096, 4096), 'conv': (56, 56, 128, 128), 'feature_map': (14, 14, 512)},
+}
+batch_sizes = [1, 8, 32]
+threads = [1, 4]
+warmup = 3
+repeats = 20
+
+
+def create_layers(shapes):
+    """
+    Returns a dictionary with the name of every layer and its (layer, input shape, name of the baseline layer).
+    """
+    import tensorflow as tf
+    from CompressionLibrary.custom_layers import DenseSVD, SparseSVD, ConvSVD, FireLayer, MLPConv, \
+        SparseConnectionsConv2D, SparseConvolution2D, ROIEmbedding, ROIEmbedding1D, block_connections
+
+    features, units = shapes['dense']
+    rank = max(1, min(features, units) // 4)
+    height, width, channels, filters = shapes['conv']
+    conv_shape = (height, width, channels)
+    groups = 4 if channels % 4 == 0 and filters % 4 == 0 else 2
+    map_height, map_width, map_channels = shapes['feature_map']
+    n_bins = [(1, 1), (2, 2), (4, 4)]
+
+    return {
+        'Dense': (tf.keras.layers.Dense(units, activation='relu'), (features,), None),
+        'DenseSVD': (DenseSVD(units, rank), (features,), 'Dense'),
+        'SparseSVD': (SparseSVD(units, rank, rank // 2), (features,), 'Dense'),
+        'Conv2D': (tf.keras.layers.Conv2D(filters, 3, padding='same', activation='relu'), conv_shape, None),
+        'ConvSVD': (ConvSVD(max(1, filters // 4), filters, (3, 3), 1, padding='same'), conv_shape, 'Conv2D'),
+        'FireLayer': (FireLayer(max(1, filters // 4), filters), conv_shape, 'Conv2D'),
+        'MLPConv': (MLPConv(filters, max(1, filters // 4), 3, padding='SAME'), conv_shape, 'Conv2D'),
+        'SparseConnectionsConv2D': (SparseConnectionsConv2D(block_connections(np.eye(groups), channels, filters),
+                                                            filters=filters, kernel_size=3, padding='same'),
+                                    conv_shape, 'Conv2D'),
+        'SparseConvolution2D': (SparseConvolution2D((3, 3), filters, 2, padding='same', activation='relu'), conv_shape, 'Conv2D'),
+        'GlobalMaxPooling2D': (tf.keras.layers.GlobalMaxPooling2D(), shapes['feature_map'], None),
+        'ROIEmbedding': (ROIEmbedding(n_bins), shapes['feature_map'], 'GlobalMaxPooling2D'),
+        'GlobalMaxPooling1D': (tf.keras.layers.GlobalMaxPooling1D(), (map_height * map_width, map_channels), None),
+        'ROIEmbedding1D': (ROIEmbedding1D([1, 2, 4]), (map_height * map_width, map_channels), 'GlobalMaxPooling1D'),
+    }
+
+
+def measure_threads(num_threads):
+    """
+    Worker that measures every layer of every architecture with a number of threads.
+    :return: list of dictionaries with the latency statistics of time_function and the peak memory in bytes.
+    """
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    from CompressionLibrary.benchmark import time_function
+    from CompressionLibrary.custom_layers import SparseConnectionsConv2D
+
+    results = []
+    with tf.device('/CPU:0'):
+        for architecture, shapes in architectures.items():
+            for name, (layer, input_shape, baseline) in create_layers(shapes).items():
+                layer(tf.zeros((1,) + input_shape))
+                if isinstance(layer, SparseConnectionsConv2D):
+                    layer.freeze()
+
+                def forward_backward(x, layer=layer):
+                    with tf.GradientTape() as tape:
+                        tape.watch(x)
+                        loss = tf.reduce_sum(layer(x, training=True))
+                    return tape.gradient(loss, [x] + layer.trainable_weights)
+
+                functions = {'forward': tf.function(lambda x, layer=layer: layer(x, training=False)),
+                             'forward_backward': tf.function(forward_backward)}
+                for batch_size in batch_sizes:
+                    x = tf.random.uniform((batch_size,) + input_shape)
+                    for mode, fn in functions.items():
+                        memory_before = tf.config.experimental.get_memory_info('CPU:0')['current']
+                        tf.config.experimental.reset_memory_stats('CPU:0')
+                        row = {'architecture': architecture, 'layer': name, 'baseline': baseline,
+                               'input_shape': 'x'.join(str(dim) for dim in input_shape), 'weights': layer.count_params(),
+                               'batch_size': batch_size, 'threads': num_threads, 'mode': mode}
+                        row.update(time_function(fn, x, warmup=warmup, repeats=repeats))
+                        row['peak_memory_bytes'] = tf.config.experimental.get_memory_info('CPU:0')['peak'] - memory_before
+                        results.append(row)
+                        print(row, file=sys.stderr)
+    return results
+
+
+def environment():
+    import tensorflow as tf
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {'date': datetime.now().isoformat(), 'commit': commit, 'tensorflow': tf.__version__,
+            'python': platform.python_version(), 'machine': platform.machine(), 'processor': platform.processor(),
+            'cpu_count': os.cpu_count()}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        # Worker. Prints the measurements as JSON in the last line of the output.
+        print(json.dumps(measure_threads(**json.loads(sys.argv[1]))))
+        sys.exit()
+
+    results = []
+    for num_threads in threads:
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), json.dumps({'num_threads': num_threads})],
+                                 stdout=subprocess.PIPE, text=True, check=True)
+        results += json.loads(process.stdout.strip().splitlines()[-1])
+
+    df = pd.DataFrame(results)
+    keys = ['architecture', 'batch_size', 'threads', 'mode']
+    baselines = df.set_index(keys + ['layer'])['p50_ms']
+    df['speedup'] = [baselines.get(tuple(row[keys]) + (row['baseline'],), np.nan) / row['p50_ms'] if row['baseline'] else 1.0
+                     for _, row in df.iterrows()]
+
+    os.makedirs(os.path.dirname(save_name), exist_ok=True)
+    df.to_csv(save_name, index=False)
+    with open(os.path.splitext(save_name)[0] + '.json', 'w') as f:
+        json.dump({'environment': environment(), 'results': df.replace({np.nan: None}).to_dict('records')}, f, indent=1)
+    print(df.pivot_table(index=['architecture', 'layer', 'baseline'], columns=['mode', 'threads', 'batch_size'], values='speedup'))
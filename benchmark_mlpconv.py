@@ -0,0 +1,51 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import tensorflow as tf
+import pandas as pd
+
+from CompressionLibrary.benchmark import time_function
+from CompressionLibrary.custom_layers import MLPConv
+
+# Compares the conv and patches kernels of MLPConv. Besides the latency, it reports the bytes of the largest
+# intermediate tensor of each kernel, the patches for the patches kernel and the hidden feature map for the conv
+# kernel, which is the extra peak memory of the layer.
+
+save_name = './data/stats/benchmark_mlpconv.csv'
+
+# (height, width, channels, filters) of LeNet and VGG16 convolutions.
+layer_shapes = [(14, 14, 6, 16), (112, 112, 64, 128), (56, 56, 128, 256), (28, 28, 256, 512), (14, 14, 512, 512)]
+hidden_units_fraction = 0.25
+kernel_size = (3, 3)
+batch_sizes = [1, 8]
+repeats = 20
+
+results = []
+for height, width, channels, filters in layer_shapes:
+    hidden_units = max(1, int(filters * hidden_units_fraction))
+    x = tf.random.normal(shape=(1, height, width, channels))
+    layers = {kernel_mode: MLPConv(filters, hidden_units, kernel_size, padding='SAME', kernel_mode=kernel_mode)
+              for kernel_mode in ['patches', 'conv']}
+    for layer in layers.values():
+        layer(x)
+    layers['conv'].set_weights(layers['patches'].get_weights())
+
+    for batch_size in batch_sizes:
+        x = tf.random.normal(shape=(batch_size, height, width, channels))
+        expected = layers['patches'](x)
+        for kernel_mode, layer in layers.items():
+            fn = tf.function(layer)
+            tf.debugging.assert_near(fn(x), expected, rtol=1e-4, atol=1e-3)
+            intermediate_size = kernel_size[0] * kernel_size[1] * channels if kernel_mode == 'patches' else hidden_units
+            row = {'height': height, 'width': width, 'channels': channels, 'filters': filters,
+                   'hidden_units': hidden_units, 'batch_size': batch_size, 'kernel_mode': kernel_mode,
+                   'intermediate_bytes': batch_size * height * width * intermediate_size * 4}
+            row.update(time_function(fn, x, repeats=repeats))
+            results.append(row)
+            print(row)
+
+df = pd.DataFrame(results)
+os.makedirs(os.path.dirname(save_name), exist_ok=True)
+df.to_csv(save_name, index=False)
+print(df.pivot_table(index=['height', 'channels', 'filters', 'batch_size'], columns='kernel_mode',
+                     values=['p50_ms', 'intermediate_bytes']))
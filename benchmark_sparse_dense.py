@@ -0,0 +1,55 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import tensorflow as tf
+import numpy as np
+import pandas as pd
+
+from CompressionLibrary.benchmark import time_function, variables_bytes
+from CompressionLibrary.model_passes import dense_to_sparse
+
+# Compares the latency and the memory of the weights of a Dense layer against a SparseDense layer with
+# both kernels at typical densities after DeepCompression.
+
+save_name = './data/stats/benchmark_sparse_dense.csv'
+
+# (features, units) of LeNet and VGG16 dense layers.
+layer_shapes = [(400, 120), (120, 84), (4096, 4096)]
+densities = [1.0, 0.5, 0.3, 0.1, 0.05, 0.01]
+batch_sizes = [1, 32]
+repeats = 30
+
+results = []
+for features, units in layer_shapes:
+    for density in densities:
+        kernel = np.random.normal(size=(features, units)).astype(np.float32)
+        kernel[np.random.uniform(size=kernel.shape) > density] = 0.0
+        bias = np.zeros(units, dtype=np.float32)
+
+        inputs = tf.keras.layers.Input((features,))
+        dense = tf.keras.layers.Dense(units, activation='relu')
+        dense(inputs)
+        dense.set_weights([kernel, bias])
+        layers = {'dense': dense}
+        layers['sparse_matmul'] = dense_to_sparse(dense, kernel_mode='sparse_matmul')
+        # The gather kernel materializes a (batch, nnz) tensor, so it is only useful for very sparse layers.
+        if density <= 0.3:
+            layers['gather'] = dense_to_sparse(dense, kernel_mode='gather')
+
+        for batch_size in batch_sizes:
+            x = tf.random.normal(shape=(batch_size, features))
+            expected = dense(x)
+            for name, layer in layers.items():
+                fn = tf.function(layer)
+                tf.debugging.assert_near(fn(x), expected, atol=1e-3)
+                latency = time_function(fn, x, repeats=repeats)
+                row = {'features': features, 'units': units, 'density': density, 'batch_size': batch_size,
+                       'layer': name, 'weights_bytes': variables_bytes(layer)}
+                row.update(latency)
+                results.append(row)
+                print(row)
+
+df = pd.DataFrame(results)
+os.makedirs(os.path.dirname(save_name), exist_ok=True)
+df.to_csv(save_name, index=False)
+print(df.pivot_table(index=['features', 'units', 'density', 'batch_size'], columns='layer', values='p50_ms'))
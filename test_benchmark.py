@@ -0,0 +1,33 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import tensorflow as tf
+
+from CompressionLibrary.benchmark import layer_latency, model_latency, _latency_cache
+
+
+def test_model_latency_with_several_inputs():
+    inputs = tf.keras.layers.Input((8, 8, 4))
+    x = tf.keras.layers.Conv2D(4, 3, padding='same', name='conv')(inputs)
+    x = tf.keras.layers.Add(name='add')([inputs, x])
+    outputs = tf.keras.layers.Concatenate(name='concatenate')([x, tf.keras.layers.Conv2D(2, 1, name='conv_1')(x)])
+    model = tf.keras.Model(inputs, outputs)
+
+    total, layers_latency = model_latency(model, warmup=1, repeats=2)
+    assert set(layers_latency) == {layer.name for layer in model.layers}
+    assert layers_latency['add'] > 0 and layers_latency['concatenate'] > 0
+    assert total == sum(layers_latency.values())
+
+
+def test_layer_latency_keyed_by_every_input():
+    add = tf.keras.layers.Add()
+    add([tf.keras.layers.Input((4,)), tf.keras.layers.Input((4,))])
+    concatenate = tf.keras.layers.Concatenate()
+    concatenate([tf.keras.layers.Input((4,)), tf.keras.layers.Input((6,))])
+    other_concatenate = tf.keras.layers.Concatenate()
+    other_concatenate([tf.keras.layers.Input((4,)), tf.keras.layers.Input((2,))])
+
+    cache_size = len(_latency_cache)
+    for layer in [add, concatenate, other_concatenate]:
+        layer_latency(layer, warmup=1, repeats=2)
+    assert len(_latency_cache) == cache_size + 3
@@ -0,0 +1,188 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import logging
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from CompressionLibrary import CompressionTechniques
+from CompressionLibrary.CompressionTechniques import DataAwareDenseSVD, DataAwareMLPCompression, FilterPruning, InsertDenseTT, \
+    PostTrainingQuantization, SparseConvolutionCompression, TuckerDecomposition, apply_plan, minimize_loss
+from CompressionLibrary.cost_model import dry_run
+from CompressionLibrary.custom_layers import DenseSVD, MLPConv, QuantizedConv2D, QuantizedDense, QuantizedDenseSVD, \
+    QuantizedMLPConv, SparseConvolution2D, TTDense, TuckerConv2D
+from CompressionLibrary.utils import calculate_model_bytes
+
+
+def create_model():
+    inputs = tf.keras.layers.Input((8, 8, 4))
+    x = tf.keras.layers.Conv2D(4, 3, padding='same', name='conv2d')(inputs)
+    x = tf.keras.layers.Conv2D(4, 3, padding='same', name='conv2d_1')(x)
+    x = tf.keras.layers.Flatten(name='flatten')(x)
+    return tf.keras.Model(inputs, tf.keras.layers.Dense(3, activation='softmax', name='dense')(x))
+
+
+def test_apply_plan_compresses_layers_together(monkeypatch):
+    calls = []
+    find_pqs_batch = SparseConvolutionCompression.find_pqs_batch
+
+    def counted_find_pqs_batch(self, kernels, bases):
+        calls.append(len(kernels))
+        return find_pqs_batch(self, kernels, bases)
+
+    monkeypatch.setattr(SparseConvolutionCompression, 'find_pqs_batch', counted_find_pqs_batch)
+    dataset = tf.data.Dataset.from_tensor_slices((np.zeros((4, 8, 8, 4), np.float32), np.zeros(4))).batch(2)
+    params = {'new_layer_iterations': 2, 'new_layer_iterations_sparse': 2}
+    plan = [('conv2d', SparseConvolutionCompression, params), ('conv2d_1', 'SparseConvolutionCompression', params)]
+    model = apply_plan(create_model(), plan, dataset=dataset, optimizer=tf.keras.optimizers.Adam(),
+                       loss=tf.keras.losses.SparseCategoricalCrossentropy(), metrics=['accuracy'], input_shape=(8, 8, 4))
+
+    assert calls == [2]
+    assert sum(isinstance(layer, SparseConvolution2D) for layer in model.layers) == 2
+
+
+def test_minimize_loss_runs_every_iteration_by_default():
+    variable = tf.Variable(1.0)
+    _, iterations = minimize_loss(lambda x: tf.square(x), [variable], 300, learning_rate=1.0, patience=10)
+    assert iterations == 300
+    _, iterations = minimize_loss(lambda x: tf.square(x), [variable], 300, learning_rate=1.0, patience=10, tolerance=1e-4)
+    assert iterations < 300
+
+
+def pruning_model(pooling, shortcut=False):
+    inputs = tf.keras.layers.Input((8, 8, 3))
+    x = tf.keras.layers.Conv2D(6, 3, padding='same', name='conv')(inputs)
+    x = tf.keras.layers.BatchNormalization(name='batch_normalization')(x)
+    if shortcut:
+        x = tf.keras.layers.Add(name='add')([x, tf.keras.layers.Conv2D(6, 1, name='shortcut')(inputs)])
+    x = pooling(x)
+    if len(x.shape) > 2:
+        x = tf.keras.layers.Flatten(name='flatten')(x)
+    return tf.keras.Model(inputs, tf.keras.layers.Dense(3, name='dense')(x))
+
+
+def filter_pruning(model):
+    return FilterPruning(model=model, optimizer=tf.keras.optimizers.Adam(), loss=tf.keras.losses.MeanSquaredError(),
+                         metrics=[], input_shape=(8, 8, 3), dataset=None)
+
+
+@pytest.mark.parametrize('pooling', [tf.keras.layers.MaxPooling2D(name='pooling'),
+                                     tf.keras.layers.GlobalAveragePooling2D(name='pooling')])
+def test_filter_pruning_keeps_outputs(pooling):
+    model = pruning_model(pooling)
+    rng = np.random.default_rng(0)
+    model.set_weights([rng.normal(size=w.shape).astype(np.float32) for w in model.get_weights()])
+    # The filters that will be pruned have no weights and their normalized outputs are zero, so they do not
+    # change the outputs of the model.
+    pruned = [1, 2, 4]
+    conv, batch_normalization = model.get_layer('conv'), model.get_layer('batch_normalization')
+    kernel, bias = conv.get_weights()
+    kernel[..., pruned] = 0.0
+    bias[pruned] = 0.0
+    conv.set_weights([kernel, bias])
+    gamma, beta, mean, variance = batch_normalization.get_weights()
+    gamma[pruned], beta[pruned], variance = 0.0, 0.0, np.abs(variance)
+    batch_normalization.set_weights([gamma, beta, mean, variance])
+    x = rng.normal(size=(4, 8, 8, 3)).astype(np.float32)
+    outputs = model(x)
+
+    estimate = dry_run(model, [('conv', 'FilterPruning', {'percentage': 0.5})])
+    compressor = filter_pruning(model)
+    compressor.compress_layer('conv', percentage=0.5)
+    pruned_model = compressor.model
+    assert pruned_model.get_layer('conv/Pruned').filters == 3
+    assert pruned_model.get_layer('dense').input_shape[-1] == model.get_layer('dense').input_shape[-1] // 2
+    assert estimate['after']['weights'] == pruned_model.count_params()
+    np.testing.assert_allclose(pruned_model(x), outputs, rtol=1e-5, atol=1e-5)
+
+
+def test_filter_pruning_rejects_shared_filters():
+    model = pruning_model(tf.keras.layers.MaxPooling2D(name='pooling'), shortcut=True)
+    with pytest.raises(ValueError):
+        dry_run(model, [('conv', 'FilterPruning', {'percentage': 0.5})])
+    with pytest.raises(ValueError):
+        filter_pruning(model).compress_layer('conv', percentage=0.5)
+
+
+@pytest.mark.parametrize('compressor_class', [DataAwareDenseSVD, DataAwareMLPCompression])
+def test_data_aware_svd_only_compares_with_svd_when_logged(compressor_class, monkeypatch, caplog):
+    calls = []
+    svd = CompressionTechniques.truncated_svd
+    monkeypatch.setattr(CompressionTechniques, 'truncated_svd', lambda *args: calls.append(args) or svd(*args))
+    compressor = compressor_class(model=create_model(), optimizer=tf.keras.optimizers.Adam(), loss=tf.keras.losses.MeanSquaredError(),
+                                  metrics=[], input_shape=(8, 8, 4), dataset=None)
+    weights = np.random.default_rng(0).normal(size=(36, 4))
+    monkeypatch.setattr(compressor, 'input_covariance', lambda *args, **kwargs: (np.eye(36), 36))
+    layer = compressor.model.get_layer('conv2d')
+
+    with caplog.at_level(logging.INFO, logger=CompressionTechniques.__name__):
+        compressor.decompose(layer, weights, 2)
+    assert calls == []
+    with caplog.at_level(logging.DEBUG, logger=CompressionTechniques.__name__):
+        compressor.decompose(layer, weights, 2)
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize('create_layer, input_shape', [
+    (lambda: tf.keras.layers.Dense(128, activation='relu', name='layer'), (256,)),
+    (lambda: tf.keras.layers.Conv2D(32, 3, padding='same', activation='relu', name='layer'), (8, 8, 16)),
+    (lambda: DenseSVD(128, 32, name='layer'), (256,)),
+    (lambda: MLPConv(32, 16, 3, padding='SAME', name='layer'), (8, 8, 16)),
+])
+def test_post_training_quantization(create_layer, input_shape):
+    inputs = tf.keras.layers.Input(input_shape)
+    model = tf.keras.Model(inputs, create_layer()(inputs))
+    rng = np.random.default_rng(0)
+    model.set_weights([rng.normal(size=w.shape).astype(np.float32) for w in model.get_weights()])
+    x = rng.normal(size=(8,) + input_shape).astype(np.float32)
+    outputs = model(x).numpy()
+    dataset = tf.data.Dataset.from_tensor_slices((x, outputs)).batch(4)
+
+    compressor = PostTrainingQuantization(model=model, optimizer=tf.keras.optimizers.Adam(), loss=tf.keras.losses.MeanSquaredError(),
+                                          metrics=[], input_shape=input_shape, dataset=dataset)
+    compressor.compress_layer('layer')
+    quantized_model = compressor.model
+    assert isinstance(quantized_model.layers[-1], (QuantizedDense, QuantizedConv2D, QuantizedDenseSVD, QuantizedMLPConv))
+
+    # The kernels and the inputs have 8 bits, so the error is around 1% of the range of the outputs.
+    error = np.abs(quantized_model(x).numpy() - outputs)
+    assert error.max() < 0.03 * np.abs(outputs).max()
+    assert error.mean() < 0.02 * np.abs(outputs).mean()
+    # The kernels use a byte instead of 4, only the biases and the scales are stored as floats.
+    assert calculate_model_bytes(model) / calculate_model_bytes(quantized_model) > 3.5
+
+
+@pytest.mark.parametrize('strides, padding', [(1, 'valid'), (2, 'same')])
+def test_tucker_decomposition_at_full_rank(strides, padding):
+    inputs = tf.keras.layers.Input((9, 9, 5))
+    model = tf.keras.Model(inputs, tf.keras.layers.Conv2D(7, 3, strides=strides, padding=padding, name='conv')(inputs))
+    x = np.random.default_rng(0).normal(size=(2, 9, 9, 5)).astype(np.float32)
+    outputs = model(x).numpy()
+
+    compressor = TuckerDecomposition(model=model, optimizer=tf.keras.optimizers.Adam(), loss=tf.keras.losses.MeanSquaredError(),
+                                     metrics=[], input_shape=(9, 9, 5), dataset=None)
+    # The HOSVD with all the singular values of both unfoldings is exact.
+    compressor.compress_layer('conv', input_rank=5, output_rank=7)
+    layer = compressor.model.layers[-1]
+    assert isinstance(layer, TuckerConv2D) and (layer.input_rank, layer.output_rank) == (5, 7)
+    np.testing.assert_allclose(compressor.model(x), outputs, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize('features, units, num_modes', [(24, 12, 3), (30, 20, 2)])
+def test_tensor_train_at_full_rank(features, units, num_modes):
+    inputs = tf.keras.layers.Input((features,))
+    model = tf.keras.Model(inputs, tf.keras.layers.Dense(units, name='dense')(inputs))
+    rng = np.random.default_rng(0)
+    model.set_weights([rng.normal(size=w.shape).astype(np.float32) for w in model.get_weights()])
+    x = rng.normal(size=(4, features)).astype(np.float32)
+    outputs = model(x).numpy()
+
+    compressor = InsertDenseTT(model=model, optimizer=tf.keras.optimizers.Adam(), loss=tf.keras.losses.MeanSquaredError(),
+                               metrics=[], input_shape=(features,), dataset=None)
+    # The ranks are limited by the size of the unfoldings, where the TT-SVD is exact.
+    compressor.compress_layer('dense', num_modes=num_modes, tt_rank=features * units)
+    layer = compressor.model.layers[-1]
+    assert isinstance(layer, TTDense) and len(layer.cores) == num_modes
+    np.testing.assert_allclose(layer.get_kernel(), model.get_layer('dense').kernel, rtol=1e-4, atol=1e-4)
+    np.testing.assert_allclose(compressor.model(x), outputs, rtol=1e-4, atol=1e-4)
@@ -0,0 +1,89 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from CompressionLibrary.custom_layers import SparseConnectionsConv2D, TTDense, TuckerConv2D, block_connections
+from CompressionLibrary.cost_model import dry_run, model_flops, num_elements
+from CompressionLibrary.model_passes import convert_sparse_connections
+
+
+def sparse_connections_model(block_mask, channels=8, filters=16):
+    inputs = tf.keras.layers.Input((12, 12, channels))
+    layer = SparseConnectionsConv2D(block_connections(block_mask, channels, filters), filters=filters, kernel_size=3,
+                                    padding='same', name='sparse_conv')
+    return tf.keras.Model(inputs, layer(inputs)), layer
+
+
+def masked_flops(layer):
+    """
+    FLOPs of the kernel of a SparseConnectionsConv2D layer without its disconnected (channel, filter) pairs.
+    """
+    kh, kw = layer.kernel_size
+    return 2 * num_elements(layer.output_shape[1:3]) * kh * kw * int(np.sum(layer.get_connections()))
+
+
+def test_grouped_conv2d_flops():
+    model, layer = sparse_connections_model(np.eye(4))
+    new_model, converted = convert_sparse_connections(model)
+    assert converted['sparse_conv'][0] == 4
+    assert isinstance(new_model.get_layer('sparse_conv'), tf.keras.layers.Conv2D)
+    assert model_flops(new_model)[1]['sparse_conv'] == masked_flops(layer)
+
+
+def test_shifted_grouped_conv2d_flops():
+    model, layer = sparse_connections_model(np.eye(4) + np.roll(np.eye(4), 1, axis=1))
+    new_model, _ = convert_sparse_connections(model)
+    nested_model = new_model.get_layer('sparse_conv')
+    assert isinstance(nested_model, tf.keras.Model)
+    # The grouped convolutions of both shifts are summed by an Add layer.
+    add_flops = num_elements(layer.output_shape[1:])
+    assert model_flops(new_model)[1]['sparse_conv'] == masked_flops(layer) + add_flops
+
+
+def test_sparse_connections_default_target():
+    inputs = tf.keras.layers.Input((12, 12, 8))
+    model = tf.keras.Model(inputs, tf.keras.layers.Conv2D(16, 3, name='conv')(inputs))
+    default = dry_run(model, [('conv', 'SparseConnectionsCompression', {})])
+    explicit = dry_run(model, [('conv', 'SparseConnectionsCompression', {'target_perc': 0.75})])
+    assert default['after'] == explicit['after']
+    assert default['after']['weights'] == model.count_params() - 8 * 16 // 4 * 3 * 3
+
+
+def counted_flops(layer, inputs, monkeypatch):
+    """
+    Calls a built layer and counts 2 FLOPs per multiply-add of the einsums and convolutions it runs.
+    """
+    flops = []
+    einsum, conv2d = tf.einsum, tf.nn.conv2d
+
+    def counting_einsum(equation, *operands):
+        sizes = {}
+        for subscripts, operand in zip(equation.split('->')[0].split(','), operands):
+            sizes.update(zip(subscripts, operand.shape))
+        flops.append(2 * num_elements(sizes.values()))
+        return einsum(equation, *operands)
+
+    def counting_conv2d(input, filters, **kwargs):
+        outputs = conv2d(input=input, filters=filters, **kwargs)
+        flops.append(2 * num_elements(outputs.shape[1:3]) * num_elements(filters.shape))
+        return outputs
+
+    monkeypatch.setattr(tf, 'einsum', counting_einsum)
+    monkeypatch.setattr(tf.nn, 'conv2d', counting_conv2d)
+    layer(inputs)
+    return sum(flops)
+
+
+@pytest.mark.parametrize('layer, input_shape', [
+    (TuckerConv2D(12, 3, 5, 3, name='layer'), (10, 10, 8)),
+    (TuckerConv2D(12, 4, 2, (3, 2), strides=2, padding='same', name='layer'), (11, 9, 6)),
+    (TTDense(12, [3, 4], [4, 3], [1, 5, 1], name='layer'), (12,)),
+    (TTDense(30, [2, 3, 4], [5, 3, 2], [1, 4, 6, 1], name='layer'), (24,)),
+])
+def test_factorized_layer_flops(layer, input_shape, monkeypatch):
+    inputs = tf.keras.layers.Input(input_shape)
+    model = tf.keras.Model(inputs, layer(inputs))
+    assert model_flops(model)[1]['layer'] == counted_flops(layer, tf.zeros((1,) + input_shape), monkeypatch)
@@ -0,0 +1,243 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import json
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from CompressionLibrary import custom_layers
+from CompressionLibrary.custom_layers import MLPConv, SparseConnectionsConv2D, SparseConvolution2D, ROIEmbedding, \
+    ROIEmbedding1D, block_connections
+
+
+def outputs_and_gradients(layer, inputs):
+    with tf.GradientTape() as tape:
+        tape.watch(inputs)
+        outputs = layer(inputs)
+        loss = tf.reduce_sum(outputs * tf.random.stateless_normal(outputs.shape, seed=[0, 1]))
+    return outputs, tape.gradient(loss, [inputs] + layer.trainable_weights)
+
+
+@pytest.mark.parametrize('padding', ['SAME', 'VALID'])
+@pytest.mark.parametrize('strides', [1, 2])
+def test_mlpconv_kernel_modes(padding, strides):
+    inputs = tf.random.stateless_normal((2, 13, 11, 5), seed=[1, 2])
+    conv = MLPConv(8, 3, (3, 2), strides=strides, padding=padding, activation='linear', kernel_mode='conv')
+    patches = MLPConv.from_config(dict(conv.get_config(), kernel_mode='patches'))
+    conv(inputs)
+    patches(inputs)
+    patches.set_weights(conv.get_weights())
+
+    conv_outputs, conv_gradients = outputs_and_gradients(conv, inputs)
+    patches_outputs, patches_gradients = outputs_and_gradients(patches, inputs)
+    np.testing.assert_allclose(conv_outputs, patches_outputs, rtol=1e-5, atol=1e-5)
+    for conv_gradient, patches_gradient in zip(conv_gradients, patches_gradients):
+        np.testing.assert_allclose(conv_gradient, patches_gradient, rtol=1e-4, atol=1e-4)
+
+
+def test_sparse_convolution_kernel_modes():
+    inputs = tf.random.stateless_normal((2, 9, 9, 4), seed=[3, 4])
+    dense = SparseConvolution2D((3, 3), 6, 2, padding='same', kernel_mode='dense')
+    sparse = SparseConvolution2D.from_config(dict(dense.get_config(), kernel_mode='sparse'))
+    dense(inputs)
+    sparse(inputs)
+    weights = [np.random.normal(size=weight.shape).astype(np.float32) for weight in dense.get_weights()]
+    # Only some values of S are not zero.
+    weights[2][np.random.uniform(size=weights[2].shape) > 0.3] = 0.0
+    dense.set_weights(weights)
+    sparse.set_weights(weights)
+
+    assert sparse.freeze() == pytest.approx(np.mean(weights[2] != 0))
+    assert sparse.inference_kernel is not None
+    np.testing.assert_allclose(dense(inputs), sparse(inputs), rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(dense(inputs), sparse(inputs, training=True), rtol=1e-5, atol=1e-5)
+    sparse.unfreeze()
+    np.testing.assert_allclose(dense(inputs), sparse(inputs), rtol=1e-5, atol=1e-5)
+
+
+def bin_slices(size, bins):
+    """
+    Slices of the bins of the previous implementation of ROIEmbedding, which pooled every bin of every image in a
+    loop. The last bin takes the remaining positions.
+    """
+    step = size // bins
+    return [slice(i * step, (i + 1) * step if i + 1 < bins else size) for i in range(bins)]
+
+
+def roi_embedding_reference(x, n_bins):
+    outputs = []
+    for feature_map in x:
+        pooled = []
+        for height_bins, width_bins in n_bins:
+            for rows in bin_slices(feature_map.shape[0], height_bins):
+                for columns in bin_slices(feature_map.shape[1], width_bins):
+                    area = feature_map[rows, columns].reshape(-1, feature_map.shape[-1])
+                    pooled.append(area.max(axis=0) if area.size else np.full(feature_map.shape[-1], -np.inf))
+        outputs.append(np.concatenate(pooled))
+    return np.stack(outputs)
+
+
+@pytest.mark.parametrize('height, width', [(8, 8), (7, 10), (3, 5)])
+def test_roi_embedding(height, width):
+    # Square and non-square bins, bins that do not divide the feature map and more bins than rows.
+    n_bins = [(1, 1), (2, 3), (4, 4), (3, 2)]
+    x = np.random.normal(size=(3, height, width, 5)).astype(np.float32)
+    layer = ROIEmbedding(n_bins)
+    np.testing.assert_array_equal(layer(x), roi_embedding_reference(x, n_bins))
+    np.testing.assert_array_equal(tf.function(layer)(x), roi_embedding_reference(x, n_bins))
+
+
+def roi_embedding_1d_reference(sequences, n_bins):
+    outputs = []
+    for sequence in sequences:
+        pooled = []
+        for bins in n_bins:
+            for positions in bin_slices(len(sequence), bins):
+                pooled.append(sequence[positions].max() if sequence[positions].size else -np.inf)
+        outputs.append(pooled)
+    return np.asarray(outputs, dtype=np.float32)
+
+
+def test_roi_embedding_1d():
+    n_bins = [1, 2, 3, 5]
+    x = np.random.normal(size=(4, 11, 3)).astype(np.float32)
+    layer = ROIEmbedding1D(n_bins)
+    np.testing.assert_array_equal(layer(x), roi_embedding_1d_reference(x, n_bins))
+
+
+def test_roi_embedding_1d_lengths():
+    n_bins = [1, 2, 3, 5]
+    x = np.random.normal(size=(4, 11, 3)).astype(np.float32)
+    # Padding at the end, at the start and in the middle of the sequences, and a sequence shorter than the bins.
+    mask = np.ones((4, 11), dtype=bool)
+    mask[0, 7:] = False
+    mask[1, :4] = False
+    mask[2, [1, 5, 6, 9]] = False
+    mask[3, 3:] = False
+    sequences = [sequence[sequence_mask] for sequence, sequence_mask in zip(x, mask)]
+    expected = roi_embedding_1d_reference(sequences, n_bins)
+
+    layer = ROIEmbedding1D(n_bins)
+    np.testing.assert_array_equal(layer(x, mask=tf.constant(mask)), expected)
+    np.testing.assert_array_equal(layer(tf.ragged.constant([sequence.tolist() for sequence in sequences], ragged_rank=1)), expected)
+    masked = tf.keras.layers.Masking(mask_value=np.inf)(np.where(mask[..., None], x, np.inf))
+    np.testing.assert_array_equal(layer(masked), expected)
+
+
+def test_sparse_connections_set_connections_does_not_retrace():
+    inputs = tf.random.stateless_normal((2, 8, 8, 4), seed=[5, 6])
+    layer = SparseConnectionsConv2D(block_connections(np.eye(2), 4, 6), filters=6, kernel_size=3, padding='same')
+    layer(inputs)
+    forward = tf.function(lambda x: layer(x, training=True))
+    before = forward(inputs)
+    layer.set_connections(np.ones(4 * 6, dtype=int).tolist())
+    after = forward(inputs)
+    assert forward.experimental_get_tracing_count() == 1
+    np.testing.assert_allclose(after, layer(inputs, training=True), rtol=1e-5, atol=1e-5)
+    assert not np.allclose(before, after)
+
+
+@pytest.mark.parametrize('block_mask', [np.eye(2), np.eye(3) + np.roll(np.eye(3), 1, axis=1), np.ones((2, 2))])
+def test_sparse_connections_freeze(block_mask):
+    # Independent groups, connections that cannot be split in groups and a dense layer.
+    inputs = tf.random.stateless_normal((2, 8, 8, 6), seed=[7, 8])
+    layer = SparseConnectionsConv2D(block_connections(block_mask, 6, 12), filters=12, kernel_size=3, padding='same')
+    unfrozen = layer(inputs)
+    layer.freeze()
+    assert layer.inference_kernel is not None
+    np.testing.assert_allclose(layer(inputs), unfrozen, rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(layer(inputs, training=True), unfrozen, rtol=1e-5, atol=1e-5)
+    layer.unfreeze()
+    assert layer.inference_kernel is None and layer.inference_groups is None
+    np.testing.assert_allclose(layer(inputs), unfrozen, rtol=1e-5, atol=1e-5)
+
+
+def test_sparse_connections_weights_include_connections():
+    inputs = tf.random.stateless_normal((2, 8, 8, 4), seed=[9, 10])
+    layer = SparseConnectionsConv2D(block_connections(np.eye(2), 4, 6), filters=6, kernel_size=3, padding='same')
+    layer(inputs)
+    weights = layer.get_weights()
+    connections = layer.get_connections()
+    layer.set_connections(np.ones(4 * 6, dtype=int).tolist())
+    layer.set_weights(weights)
+    assert layer.get_connections() == connections
+
+
+@pytest.mark.parametrize('layer, input_shape', [(custom_layers.HashedDense(10, 16, seed=3), (12,)),
+                                                (custom_layers.HashedConv2D(6, 3, 16, seed=3), (8, 8, 4))])
+def test_hashed_kernel(layer, input_shape):
+    layer(tf.zeros((1,) + input_shape))
+    assert len(layer.weights) == 2
+    # Weight i of the kernel is sign(i) * buckets[bucket(i)].
+    buckets, signs = custom_layers.hash_buckets(int(np.prod(layer.kernel_shape)), layer.num_buckets, layer.seed)
+    expected = np.reshape(layer.buckets.numpy()[buckets.numpy()] * signs.numpy(), layer.kernel_shape)
+    np.testing.assert_array_equal(layer.get_kernel(), expected)
+
+
+# An instance and the input shape of every custom layer, for the serialization round-trip.
+serializable_layers = {
+    'DenseSVD': (lambda: custom_layers.DenseSVD(10, 4), (12,)),
+    'SparseDense': (lambda: custom_layers.SparseDense(10, 30), (12,)),
+    'SparseDenseWithoutBias': (lambda: custom_layers.SparseDense(10, 30, use_bias=False, kernel_mode='gather'), (12,)),
+    'SparseSVD': (lambda: custom_layers.SparseSVD(10, 4, 2), (12,)),
+    'ConvSVD': (lambda: custom_layers.ConvSVD(3, 6, (3, 3), 1, padding='same'), (8, 8, 4)),
+    'FireLayer': (lambda: custom_layers.FireLayer(2, 6), (8, 8, 4)),
+    'MLPConv': (lambda: custom_layers.MLPConv(6, 3, 3, padding='SAME'), (8, 8, 4)),
+    'SparseConnectionsConv2D': (lambda: custom_layers.SparseConnectionsConv2D(
+        block_connections(np.eye(2), 4, 6), filters=6, kernel_size=3, padding='same'), (8, 8, 4)),
+    'SparseConvolution2D': (lambda: custom_layers.SparseConvolution2D((3, 3), 6, 2, padding='same', kernel_mode='sparse'), (8, 8, 4)),
+    'QuantizedDense': (lambda: custom_layers.QuantizedDense(10, input_range=(-3.0, 3.0)), (12,)),
+    'QuantizedConv2D': (lambda: custom_layers.QuantizedConv2D(6, 3, padding='same', input_range=(-3.0, 3.0)), (8, 8, 4)),
+    'QuantizedDenseSVD': (lambda: custom_layers.QuantizedDenseSVD(10, 4, input_range=(-3.0, 3.0)), (12,)),
+    'QuantizedMLPConv': (lambda: custom_layers.QuantizedMLPConv(6, 3, 3, padding='SAME', input_range=(-3.0, 3.0)), (8, 8, 4)),
+    'ClusteredDense': (lambda: custom_layers.ClusteredDense(10, 4), (12,)),
+    'ClusteredConv2D': (lambda: custom_layers.ClusteredConv2D(6, 3, 4, padding='same'), (8, 8, 4)),
+    'HashedDense': (lambda: custom_layers.HashedDense(10, 16, seed=3), (12,)),
+    'HashedConv2D': (lambda: custom_layers.HashedConv2D(6, 3, 16, seed=3, padding='same'), (8, 8, 4)),
+    'TuckerConv2D': (lambda: custom_layers.TuckerConv2D(6, 2, 3, 3, padding='same'), (8, 8, 4)),
+    'TTDense': (lambda: custom_layers.TTDense(12, [3, 4], [3, 4], [1, 2, 1]), (12,)),
+    'ROIEmbedding': (lambda: ROIEmbedding([(1, 1), (2, 3)]), (8, 8, 4)),
+    'ROIEmbedding1D': (lambda: ROIEmbedding1D([1, 3]), (11, 4)),
+}
+
+
+def random_weights(layer, rng):
+    """
+    Random values for the trainable and int8 (quantized) weights of a layer. The other non-trainable weights
+    (indices, connections, etc.) keep their values.
+    """
+    weights = []
+    for variable in layer.weights:
+        weight = variable.numpy()
+        if weight.dtype == np.int8:
+            weight = rng.integers(-127, 128, size=weight.shape).astype(np.int8)
+        elif variable.trainable:
+            weight = rng.normal(size=weight.shape).astype(weight.dtype)
+        weights.append(weight)
+    return weights
+
+
+def test_every_custom_layer_has_a_round_trip_test():
+    registered = {name for name, cls in vars(custom_layers).items()
+                  if isinstance(cls, type) and issubclass(cls, tf.keras.layers.Layer)
+                  and tf.keras.utils.get_registered_object(tf.keras.utils.get_registered_name(cls)) is cls}
+    assert registered <= {type(create()).__name__ for create, _ in serializable_layers.values()}
+
+
+@pytest.mark.parametrize('name', list(serializable_layers))
+def test_custom_layer_serialization_round_trip(name):
+    create, input_shape = serializable_layers[name]
+    inputs = tf.random.stateless_normal((2,) + input_shape, seed=[11, 12])
+    layer = create()
+    layer(inputs)
+    layer.set_weights(random_weights(layer, np.random.default_rng(0)))
+
+    # The config goes through JSON as when a model is saved, and the layer is found by its registered name.
+    config = json.loads(json.dumps(tf.keras.layers.serialize(layer)))
+    new_layer = tf.keras.layers.deserialize(config)
+    assert type(new_layer) is type(layer)
+    assert json.dumps(new_layer.get_config()) == json.dumps(layer.get_config())
+    new_layer(inputs)
+    new_layer.set_weights(layer.get_weights())
+    np.testing.assert_allclose(new_layer(inputs), layer(inputs), rtol=1e-5, atol=1e-5)
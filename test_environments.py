@@ -0,0 +1,52 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from CompressionLibrary.environments import ModelCompressionEnv
+from CompressionLibrary.reward_functions import reward_MnasNet, reward_MnasNet_latency
+
+
+def create_model():
+    inputs = tf.keras.layers.Input((8, 8, 3))
+    x = tf.keras.layers.Conv2D(4, 3, activation='relu', name='conv2d')(inputs)
+    x = tf.keras.layers.Flatten(name='flatten')(x)
+    model = tf.keras.Model(inputs, tf.keras.layers.Dense(3, activation='softmax', name='dense')(x))
+    model.compile(optimizer=tf.keras.optimizers.SGD(0.1), loss=tf.keras.losses.SparseCategoricalCrossentropy(),
+                  metrics=['accuracy'])
+    return model
+
+
+def create_env(reward_func=reward_MnasNet, **kwargs):
+    rng = np.random.default_rng(0)
+    dataset = tf.data.Dataset.from_tensor_slices((rng.normal(size=(8, 8, 8, 3)).astype(np.float32),
+                                                  rng.integers(0, 3, size=8))).batch(4)
+    return ModelCompressionEnv(reward_func, [], create_model, {}, dataset, dataset, dataset, dataset, ['conv2d', 'dense'],
+                               (8, 8, 3), current_state_source='layer_weights', next_state_source='layer_weights', **kwargs)
+
+
+@pytest.mark.parametrize('reward_func, measure_latency', [(reward_MnasNet, False), (reward_MnasNet_latency, True)])
+def test_latency_is_measured_for_latency_rewards(reward_func, measure_latency):
+    env = create_env(reward_func)
+    assert env.measure_latency == measure_latency
+    assert (env.latency_before is not None) == measure_latency
+
+
+def test_latency_reward_without_latency():
+    stats = {'accuracy_after': 0.9, 'latency_before': None, 'latency_after': None}
+    with pytest.raises(ValueError):
+        reward_MnasNet_latency(stats)
+
+
+def test_jit_compile_keeps_the_compiled_optimizer():
+    env = create_env(jit_compile=True)
+    models = [env.model]
+    env.reset()
+    models.append(env.model)
+    for model in models:
+        assert isinstance(model.optimizer, tf.keras.optimizers.SGD)
+        assert isinstance(model.loss, tf.keras.losses.SparseCategoricalCrossentropy)
+        assert model.compiled_metrics._user_metrics == ['accuracy']
+        assert model._jit_compile
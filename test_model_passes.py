@@ -0,0 +1,69 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from CompressionLibrary.custom_layers import ConvSVD, DenseSVD, MLPConv, QuantizedDenseSVD, SparseDense, TTDense, TuckerConv2D
+from CompressionLibrary.model_passes import convert_sparse_layers, fuse_factorized_layers, fused_layer
+from CompressionLibrary.cost_model import layer_cost, get_layer_config
+from CompressionLibrary.utils import calculate_model_weights
+
+
+@pytest.mark.parametrize('use_bias', [True, False])
+def test_convert_sparse_layers(use_bias):
+    inputs = tf.keras.layers.Input((20,))
+    model = tf.keras.Model(inputs, tf.keras.layers.Dense(10, use_bias=use_bias, name='dense')(inputs))
+    weights = model.get_weights()
+    weights[0][np.random.uniform(size=weights[0].shape) > 0.1] = 0.0
+    if use_bias:
+        weights[1] = np.random.normal(size=weights[1].shape).astype(np.float32)
+    model.set_weights(weights)
+    x = np.random.normal(size=(4, 20)).astype(np.float32)
+
+    sparse_model, converted = convert_sparse_layers(model, density_threshold=0.5)
+    assert 'dense' in converted
+    layer = sparse_model.get_layer('dense')
+    assert isinstance(layer, SparseDense) and layer.use_bias == use_bias
+    assert layer_cost(get_layer_config(layer))['weights'] == np.count_nonzero(weights[0]) + (10 if use_bias else 0)
+    assert calculate_model_weights(sparse_model) == np.count_nonzero(weights[0]) + (10 if use_bias else 0)
+    np.testing.assert_allclose(sparse_model(x), model(x), rtol=1e-5, atol=1e-5)
+
+    dense_model, converted = convert_sparse_layers(sparse_model, density_threshold=0.0)
+    assert 'dense' in converted
+    assert dense_model.get_layer('dense').use_bias == use_bias
+    np.testing.assert_allclose(dense_model(x), model(x), rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('create_layer, input_shape', [
+    (lambda: DenseSVD(12, 4, name='layer'), (20,)),
+    (lambda: TTDense(12, [4, 5], [3, 4], [1, 3, 1], name='layer'), (20,)),
+    (lambda: ConvSVD(3, 6, (3, 3), 1, padding='same', name='layer'), (9, 9, 4)),
+    (lambda: ConvSVD(3, 6, (3, 2), 2, padding='valid', name='layer'), (9, 9, 4)),
+    (lambda: TuckerConv2D(6, 2, 3, 3, strides=2, padding='same', name='layer'), (9, 9, 4)),
+    (lambda: MLPConv(6, 3, (3, 2), strides=2, padding='VALID', name='layer'), (9, 9, 4)),
+])
+def test_fused_layer(create_layer, input_shape):
+    inputs = tf.keras.layers.Input(input_shape)
+    model = tf.keras.Model(inputs, create_layer()(inputs))
+    rng = np.random.default_rng(0)
+    model.set_weights([rng.normal(size=w.shape).astype(np.float32) for w in model.get_weights()])
+    x = rng.normal(size=(2,) + input_shape).astype(np.float32)
+
+    layer = model.get_layer('layer')
+    new_layer = fused_layer(layer)
+    assert type(new_layer) in (tf.keras.layers.Dense, tf.keras.layers.Conv2D)
+    np.testing.assert_allclose(new_layer(x), layer(x), rtol=1e-4, atol=1e-4)
+
+    fused_model, fused = fuse_factorized_layers(model, always=True)
+    assert list(fused) == ['layer']
+    assert fused_model.get_layer('layer').count_params() == fused['layer']['after']['weights']
+    np.testing.assert_allclose(fused_model(x), model(x), rtol=1e-4, atol=1e-4)
+
+
+def test_quantized_layers_are_not_fused():
+    inputs = tf.keras.layers.Input((20,))
+    model = tf.keras.Model(inputs, QuantizedDenseSVD(12, 4, name='layer')(inputs))
+    assert fused_layer(model.get_layer('layer')) is None
+    assert fuse_factorized_layers(model, always=True) == (model, {})
@@ -0,0 +1,44 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from CompressionLibrary.model_store import ModelStore, model_hash
+
+
+def small_model():
+    inputs = tf.keras.layers.Input((6,))
+    return tf.keras.Model(inputs, tf.keras.layers.Dense(4, name='dense')(inputs))
+
+
+def test_plan_keys():
+    store = ModelStore()
+    base_hash = model_hash(small_model())
+    plan = [('dense', 'DeepCompression', {'threshold': 0.01})]
+    assert store.key(base_hash, plan) == store.key(base_hash, [('dense', 'DeepCompression', {'threshold': 0.01})])
+    assert store.key(base_hash, plan) != store.key(base_hash, [('dense', 'DeepCompression', {'threshold': 0.02})])
+    assert store.key(base_hash, [('dense', 'DeepCompression', {'threshold': np.float32(0.5)})]) == \
+        store.key(base_hash, [('dense', 'DeepCompression', {'threshold': 0.5})])
+
+
+def test_plan_with_values_that_are_not_serializable():
+    # Two different datasets would otherwise give the same key.
+    plan = [('dense', 'DeepCompression', {'dataset': tf.data.Dataset.range(3)})]
+    with pytest.raises(TypeError):
+        ModelStore().key(model_hash(small_model()), plan)
+
+
+def test_put_and_get(tmp_path):
+    store = ModelStore(str(tmp_path))
+    base_model, compressed_model = small_model(), small_model()
+    plan = [('dense', 'DeepCompression', {'threshold': 0.01})]
+    assert store.get(base_model, plan) is None
+    store.put(base_model, plan, compressed_model, info={'accuracy': 0.5})
+
+    loaded = store.get(base_model, plan)
+    x = np.random.normal(size=(3, 6)).astype(np.float32)
+    np.testing.assert_allclose(loaded(x), compressed_model(x), rtol=1e-6)
+    assert store.get_info(base_model, plan)['info'] == {'accuracy': 0.5}
+    assert [entry['key'] for entry in store.entries()] == [store.key(base_model, plan)]
@@ -0,0 +1,68 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import io
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from CompressionLibrary import storage
+from CompressionLibrary.custom_layers import ClusteredDense, QuantizedConv2D
+from CompressionLibrary.storage import decode_tensor, encode_tensor, load_compressed, pack_bits, save_compressed, \
+    unpack_bits
+
+
+def reference_pack_bits(values, bits):
+    """
+    Previous implementation of pack_bits, which built the bit matrix of the whole tensor.
+    """
+    values = values.ravel().astype(np.uint64)
+    bit_matrix = (values[:, None] >> np.arange(bits, dtype=np.uint64)) & 1
+    return np.packbits(bit_matrix.astype(np.uint8).ravel()).tobytes()
+
+
+@pytest.mark.parametrize('bits', [1, 3, 5, 8, 11, 16, 33])
+def test_pack_bits(bits, monkeypatch):
+    # Small chunks, so values of several chunks are packed, the last one incomplete.
+    monkeypatch.setattr(storage, '_CHUNK_VALUES', 64)
+    values = np.random.default_rng(bits).integers(0, 2 ** bits, size=203, dtype=np.uint64)
+    packed = pack_bits(values, bits)
+    assert packed == reference_pack_bits(values, bits)
+    assert len(packed) == (values.size * bits + 7) // 8
+    np.testing.assert_array_equal(unpack_bits(packed, bits, values.size), values)
+
+
+@pytest.mark.parametrize('array', [
+    np.random.default_rng(0).integers(0, 12, size=(7, 9)).astype(np.int32),
+    np.random.default_rng(1).integers(-127, 128, size=(3, 3, 4, 5)).astype(np.int8),
+    np.random.default_rng(2).integers(-1000, 3000, size=(50,)).astype(np.int64),
+    np.full((4, 4), 7, dtype=np.int32),
+    np.random.default_rng(3).normal(size=(6, 5)).astype(np.float32),
+    np.zeros((0, 3), dtype=np.int32),
+])
+def test_encode_tensor(array):
+    meta, payload = encode_tensor(array)
+    decoded = decode_tensor(meta, payload)
+    assert decoded.dtype == array.dtype
+    np.testing.assert_array_equal(decoded, array)
+
+
+def test_save_and_load_compressed():
+    inputs = tf.keras.layers.Input((8, 8, 3))
+    x = QuantizedConv2D(4, 3, padding='same', input_range=(-3.0, 3.0), name='conv')(inputs)
+    x = tf.keras.layers.Flatten()(x)
+    model = tf.keras.Model(inputs, ClusteredDense(5, 13, name='dense')(x))
+    rng = np.random.default_rng(0)
+    # The int8 kernel and the cluster indices have values of 4 bits.
+    model.set_weights([rng.integers(0, 13, size=w.shape).astype(w.dtype) if np.issubdtype(w.dtype, np.integer)
+                       else rng.normal(size=w.shape).astype(w.dtype) for w in model.get_weights()])
+
+    file = io.BytesIO()
+    size = save_compressed(model, file)
+    assert size == len(file.getvalue())
+    file.seek(0)
+    loaded = load_compressed(file)
+    for weight, loaded_weight in zip(model.weights, loaded.weights):
+        np.testing.assert_array_equal(weight.numpy(), loaded_weight.numpy())
+    x = rng.normal(size=(2, 8, 8, 3)).astype(np.float32)
+    np.testing.assert_allclose(loaded(x), model(x), rtol=1e-6)
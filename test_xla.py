@@ -0,0 +1,58 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import numpy as np
+import tensorflow as tf
+
+from CompressionLibrary.xla import compile_model, layer_supports_jit, recompile_model, unsupported_layers
+
+
+class NumpySquare(tf.keras.layers.Layer):
+    """
+    Squares its inputs with numpy. tf.numpy_function runs Python code, so it cannot be compiled with XLA.
+    """
+
+    def call(self, inputs):
+        outputs = tf.numpy_function(np.square, [inputs], inputs.dtype, stateful=False)
+        # numpy_function has no gradient, the inputs are added so that the previous layers have one.
+        return tf.ensure_shape(outputs, inputs.shape) + 0.0 * inputs
+
+
+def create_model(numpy=False):
+    inputs = tf.keras.layers.Input((6,))
+    x = tf.keras.layers.Dense(4, name='dense')(inputs)
+    if numpy:
+        x = NumpySquare(name='numpy')(x)
+    return tf.keras.Model(inputs, tf.keras.layers.Dense(2, name='output')(x))
+
+
+def fit(model):
+    x = np.random.default_rng(0).normal(size=(8, 6)).astype(np.float32)
+    return model.fit(x, np.zeros((8, 2), np.float32), batch_size=4, verbose=0).history['loss']
+
+
+def test_compile_model():
+    model = create_model()
+    assert compile_model(model, tf.keras.optimizers.SGD(), 'mse', ['mae'], jit_compile=True)
+    assert model._jit_compile
+    assert len(fit(model)) == 1
+
+
+def test_compile_model_without_xla_support():
+    model = create_model(numpy=True)
+    assert not layer_supports_jit(model.get_layer('numpy'))
+    assert layer_supports_jit(model.get_layer('dense'))
+    assert unsupported_layers(model) == ['numpy']
+    # The whole model falls back to compiling without XLA, so it can still be trained.
+    assert not compile_model(model, tf.keras.optimizers.SGD(), 'mse', ['mae'], jit_compile=True)
+    assert not model._jit_compile
+    assert np.isfinite(fit(model)).all()
+
+
+def test_recompile_model():
+    model = create_model()
+    optimizer = tf.keras.optimizers.SGD()
+    model.compile(optimizer=optimizer, loss='mse', metrics=['mae'])
+    assert recompile_model(model)
+    assert model.optimizer is optimizer and model.loss == 'mse' and model.compiled_metrics._user_metrics == ['mae']
+    assert 'mae' in model.evaluate(np.zeros((4, 6)), np.zeros((4, 2)), verbose=0, return_dict=True)